@@ -0,0 +1,90 @@
+"""
+Сравнение записи EXIF: старый путь (Pillow, decode + encode quality=95)
+и splice сегмента APP1 в байты JPEG.
+
+    python -m benchmarks.bench_exif --count 3000
+"""
+import argparse
+import io
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import piexif
+from PIL import Image
+
+from scripts.metadata import add_photo_metadata, inject_photo_exif, photo_exif_bytes
+
+DATE = 1600000000
+
+
+def make_jpegs(folder, count, size):
+    # Шум + градиент, чтобы размер файла был похож на реальные фото, а не на заливку
+    base = Image.effect_noise(size, 64).convert('RGB')
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, f'photo{i}.jpg')
+        base.rotate(random.randint(0, 359)).save(path, quality=random.randint(80, 92))
+        paths.append(path)
+    return paths
+
+
+def pillow_reencode(path):
+    with Image.open(path) as img:
+        img.save(path, exif=photo_exif_bytes(DATE), quality=95)
+
+
+def run(label, paths, func):
+    bytes_before = sum(os.path.getsize(p) for p in paths)
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    for path in paths:
+        func(path)
+    wall = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    bytes_after = sum(os.path.getsize(p) for p in paths)
+
+    print(f"{label:<24} wall {wall:7.2f} с  cpu {cpu:7.2f} с  "
+          f"{len(paths) / wall:8.1f} фото/с  размер {bytes_before / 1048576:.1f} -> {bytes_after / 1048576:.1f} МБ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=3000)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=960)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_exif_')
+    try:
+        source = os.path.join(workdir, 'source')
+        os.makedirs(source)
+        paths = make_jpegs(source, args.count, (args.width, args.height))
+
+        for label, func in (
+            ('pillow re-encode', pillow_reencode),
+            ('splice (файл)', lambda p: add_photo_metadata(p, DATE)),
+            ('splice (буфер)', lambda p: inject_photo_exif(open(p, 'rb').read(), DATE)),
+        ):
+            target = os.path.join(workdir, 'run')
+            shutil.copytree(source, target)
+            run(label, [os.path.join(target, os.path.basename(p)) for p in paths], func)
+
+            # Проверка, что EXIF действительно читается
+            sample = os.path.join(target, os.path.basename(paths[0]))
+            data = open(sample, 'rb').read()
+            if label == 'splice (буфер)':
+                data = inject_photo_exif(data, DATE)
+            assert piexif.load(data)['Exif'][piexif.ExifIFD.DateTimeOriginal]
+            with Image.open(io.BytesIO(data)) as img:
+                img.verify()
+
+            shutil.rmtree(target)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Бенчмарк без живого аккаунта: mock VK API + CDN (benchmarks.mock_vk) в
+отдельном процессе, каждый сценарий — в своём процессе, чтобы пиковая
+память не смешивалась.
+
+Сценарии:
+    conversations — AppSaver.get_all_conversations
+    media         — перечисление аттачей (iter_media) для --media-dialogs диалогов
+    full          — Archiver (как DownloadThread) с загрузкой в temp-папку
+
+    python -m benchmarks.bench_pipeline --dialogs 5000 --messages 1000000 --rps 20
+    python -m benchmarks.bench_pipeline --scenario full --workers 16 --json report.json
+    python -m benchmarks.bench_pipeline --scenario full --types photo --max-photo-size 1280 \
+        --date-from 1500300000
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import shutil
+import tempfile
+import time
+
+from benchmarks.mock_vk import (MockServer, add_dataset_arguments, dataset_from_args,
+                                server_options)
+
+SCENARIOS = ('conversations', 'media', 'full')
+TOKEN = 'bench-token'
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux — КБ, macOS — байты
+    return peak / (1048576 if sys.platform == 'darwin' else 1024)
+
+
+def _serve(conn, args):
+    with MockServer(dataset_from_args(args), **server_options(args)) as server:
+        conn.send(server.api_url)
+        while True:
+            command = conn.recv()
+            if command == 'stats':
+                conn.send(server.mock.stats())
+            elif command == 'reset':
+                server.mock.reset()
+                conn.send(True)
+            else:
+                return
+
+
+def _run_scenario(name, api_url, args, results):
+    logging.basicConfig(level=logging.ERROR)
+    from scripts.media_filter import MediaFilter
+    from scripts.metrics import metrics
+    from scripts.parse_vk_dialogs import AppSaver
+
+    media_filter = MediaFilter(types=args.types.split(','), date_from=args.date_from,
+                               max_photo_size=args.max_photo_size,
+                               max_video_height=args.max_video_quality)
+    saver = AppSaver(TOKEN, api_url=api_url, rps=args.rps, media_filter=media_filter)
+    started = time.perf_counter()
+    result = {}
+
+    if name == 'conversations':
+        dialogs = saver.get_all_conversations()
+        result['items'] = len(dialogs)
+
+    elif name == 'media':
+        dialogs = saver.get_all_conversations()[:args.media_dialogs]
+        started = time.perf_counter()
+        first_item = None
+        count = 0
+        for dialog in dialogs:
+            for _ in saver.iter_media(dialog['peer_id']):
+                if first_item is None:
+                    first_item = time.perf_counter() - started
+                count += 1
+        result['items'] = count
+        result['time_to_first_item'] = first_item
+
+    elif name == 'full':
+        from scripts.async_engine import create_archiver
+
+        dialogs = saver.get_all_conversations()[:args.media_dialogs]
+        output = tempfile.mkdtemp(prefix='bench_full_')
+        try:
+            started = time.perf_counter()
+            archiver = create_archiver(TOKEN, dialogs, output, engine=args.engine,
+                                       workers=args.workers, api_url=api_url, rps=args.rps,
+                                       dialog_concurrency=args.parallel_dialogs,
+                                       media_filter=media_filter)
+            stats = archiver.run()
+            result['items'] = stats['files_done'] + stats.get('files_linked', 0)
+            result['files_failed'] = stats['files_failed']
+            result['failed_remaining'] = stats['failed_remaining']
+            result['bytes'] = stats['bytes_done']
+        finally:
+            shutil.rmtree(output, ignore_errors=True)
+
+    result['wall'] = time.perf_counter() - started
+    result['peak_rss_mb'] = peak_rss_mb()
+    result['metrics'] = metrics.snapshot()['summary']
+    results.put(result)
+
+
+def run(args):
+    ctx = multiprocessing.get_context('spawn')
+    parent, child = ctx.Pipe()
+    server = ctx.Process(target=_serve, args=(child, args), daemon=True)
+    server.start()
+    api_url = parent.recv()
+
+    report = {'dataset': {k: v for k, v in vars(args).items() if k not in ('json', 'scenario')}, 'scenarios': {}}
+    try:
+        for name in args.scenario or SCENARIOS:
+            parent.send('reset')
+            parent.recv()
+
+            results = ctx.Queue()
+            process = ctx.Process(target=_run_scenario, args=(name, api_url, args, results))
+            process.start()
+            result = results.get()
+            process.join()
+
+            parent.send('stats')
+            server_stats = parent.recv()
+            result['api_calls'] = server_stats['api_calls_total']
+            result['api_calls_by_method'] = server_stats['api_calls']
+            result['http_requests'] = sum(v for k, v in server_stats['http_requests'].items() if k != 'cdn')
+            result['rate_limit_errors'] = server_stats['errors'].get(6, 0)
+            result['cdn_errors'] = server_stats['errors'].get('cdn_503', 0)
+            result['cdn_requests'] = server_stats['http_requests'].get('cdn', 0)
+            result['cdn_bytes'] = server_stats['cdn_bytes']
+            result['items_per_sec'] = result['items'] / result['wall'] if result['wall'] else None
+            if 'bytes' in result:
+                result['mb_per_sec'] = result['bytes'] / 1048576 / result['wall']
+
+            report['scenarios'][name] = result
+            print_result(name, result)
+    finally:
+        parent.send('stop')
+        server.join(timeout=5)
+
+    return report
+
+
+def print_result(name, result):
+    line = (f"{name:<14} wall {result['wall']:8.2f} с  элементов {result['items']:>8}  "
+            f"API-вызовов {result['api_calls']:>6} (HTTP {result['http_requests']}, ошибок 6: "
+            f"{result['rate_limit_errors']})")
+    if result.get('cdn_errors'):
+        line += f"  CDN 503: {result['cdn_errors']}, не скачано {result.get('failed_remaining')}"
+    if result.get('time_to_first_item') is not None:
+        line += f"  первый элемент {result['time_to_first_item']:.2f} с"
+    if result.get('mb_per_sec') is not None:
+        line += f"  {result['mb_per_sec']:.1f} МБ/с"
+    if result.get('peak_rss_mb') is not None:
+        line += f"  пик RSS {result['peak_rss_mb']:.0f} МБ"
+    print(line, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_dataset_arguments(parser)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS)
+    parser.add_argument('--rps', type=float, default=3, help='лимит клиента (token bucket)')
+    parser.add_argument('--workers', type=int, help='по умолчанию — значение движка')
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads',
+                        help='движок загрузки в сценарии full')
+    parser.add_argument('--parallel-dialogs', type=int, default=3,
+                        help='диалогов одновременно в сценарии full')
+    parser.add_argument('--media-dialogs', type=int, default=10,
+                        help='сколько диалогов перечислять / скачивать в media и full')
+    parser.add_argument('--types', default='photo,video', help='фильтр типов (media и full)')
+    parser.add_argument('--date-from', type=int, metavar='UNIXTIME',
+                        help='фильтр дат; у сообщения i диалога дата 1500000000 + 60*i')
+    parser.add_argument('--max-photo-size', type=int)
+    parser.add_argument('--max-video-quality', type=int)
+    parser.add_argument('--json', help='записать отчёт в файл')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,511 @@
+"""
+Локальная замена VK API и CDN для бенчмарков.
+
+Эмулирует messages.getConversations / getHistory / getHistoryAttachments /
+getChat, users.get, groups.getById, video.get и execute в том виде, в каком
+их вызывает VkRequestScheduler, а также раздачу фото и видео (с Range).
+Данные генерируются детерминированно из (peer_id, номер сообщения) и не
+хранятся в памяти, так что 5 000 диалогов и 1M сообщений не стоят ничего.
+
+    python -m benchmarks.mock_vk --port 8765 --dialogs 5000 --messages 1000000
+"""
+import argparse
+import collections
+import io
+import json
+import random
+import re
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CHAT_PEER_OFFSET = 2000000000
+TOO_MANY_REQUESTS = 6
+
+
+class Dataset:
+    """
+    Диалог k (0..dialogs-1): каждый 10-й — беседа, каждый 25-й — сообщество,
+    остальные — пользователи. Сообщение i диалога имеет id i+1 (новые — больше).
+    Первый диалог можно сделать «гигантом» через giant_messages.
+    """
+
+    def __init__(self, dialogs=200, messages=20000, photo_percent=20, video_percent=2,
+                 giant_messages=0, photo_size=150 * 1024, video_size=5 * 1024 * 1024):
+        self.dialogs = dialogs
+        self.messages = messages
+        self.photo_percent = photo_percent
+        self.video_percent = video_percent
+        self.giant_messages = giant_messages
+        self.photo_size = photo_size
+        self.video_size = video_size
+        self.base_url = ''
+
+        self.peers = [self._peer_id(k) for k in range(dialogs)]
+        self._index = {peer_id: k for k, peer_id in enumerate(self.peers)}
+        # Уменьшенные копии (_m, _x в sizes) — пропорционально меньше байт
+        self._photos = {
+            '': self._make_jpeg(photo_size),
+            '_x': self._make_jpeg(max(photo_size // 4, 1024)),
+            '_m': self._make_jpeg(max(photo_size // 40, 1024)),
+        }
+        self._videos = {}
+
+    @staticmethod
+    def _peer_id(k):
+        if k % 10 == 9:
+            return CHAT_PEER_OFFSET + k
+        if k % 25 == 24:
+            return -(100000 + k)
+        return 1000 + k
+
+    def message_count(self, peer_id):
+        k = self._index.get(peer_id)
+        if k is None:
+            return 0
+        if k == 0 and self.giant_messages:
+            return self.giant_messages
+        per_dialog = self.messages // max(self.dialogs, 1)
+        return per_dialog + (1 if k < self.messages % max(self.dialogs, 1) else 0)
+
+    def attachment_type(self, peer_id, message_id):
+        roll = (message_id * 2654435761 + peer_id * 40503) % 100
+        if roll < self.photo_percent:
+            return 'photo'
+        if roll < self.photo_percent + self.video_percent:
+            return 'video'
+        return None
+
+    def attachment(self, peer_id, message_id):
+        kind = self.attachment_type(peer_id, message_id)
+        owner_id = peer_id if peer_id < CHAT_PEER_OFFSET else 1
+        item_id = abs(peer_id) * 10000000 + message_id
+        date = 1500000000 + message_id * 60
+        if kind == 'photo':
+            return {'type': 'photo', 'photo': {
+                'id': item_id, 'owner_id': owner_id, 'date': date,
+                'sizes': [
+                    {'type': 'm', 'width': 130, 'height': 97,
+                     'url': f'{self.base_url}/cdn/photo/{owner_id}_{item_id}_m.jpg'},
+                    {'type': 'x', 'width': 604, 'height': 453,
+                     'url': f'{self.base_url}/cdn/photo/{owner_id}_{item_id}_x.jpg'},
+                    {'type': 'z', 'width': 1280, 'height': 960,
+                     'url': f'{self.base_url}/cdn/photo/{owner_id}_{item_id}.jpg'},
+                ],
+            }}
+        if kind == 'video':
+            return {'type': 'video', 'video': {
+                'id': item_id, 'owner_id': owner_id, 'date': date, 'duration': 60,
+                'title': f'video {item_id}', 'access_key': 'k',
+                'width': 1280, 'height': 720,
+            }}
+        return None
+
+    def message(self, peer_id, message_id):
+        attach = self.attachment(peer_id, message_id)
+        return {
+            'id': message_id,
+            'peer_id': peer_id,
+            'date': 1500000000 + message_id * 60,
+            'text': 'x',
+            'attachments': [attach] if attach else [],
+            'fwd_messages': [],
+        }
+
+    def photo_bytes(self, suffix=''):
+        return self._photos[suffix]
+
+    def video_bytes(self, size):
+        if size not in self._videos:
+            self._videos[size] = self._make_mp4(size)
+        return self._videos[size]
+
+    @staticmethod
+    def _make_mp4(size):
+        # ftyp + moov/mvhd + mdat: минимум, который mutagen принимает для тегов
+        def atom(name, payload):
+            return struct.pack('>I4s', 8 + len(payload), name) + payload
+
+        mvhd = atom(b'mvhd', b'\0' * 4 + struct.pack('>IIII', 0, 0, 1000, 60000) + b'\0' * 80)
+        head = atom(b'ftyp', b'isom\0\0\x02\0isomiso2mp41') + atom(b'moov', mvhd)
+        return head + atom(b'mdat', b'\0' * max(size - len(head) - 8, 0))
+
+    @staticmethod
+    def _make_jpeg(size):
+        # Настоящий JPEG, добитый COM-сегментами до нужного размера: EXIF в него вставляется
+        try:
+            from PIL import Image
+            buf = io.BytesIO()
+            Image.new('RGB', (64, 48), (120, 80, 40)).save(buf, 'JPEG')
+            data = buf.getvalue()
+        except ImportError:
+            data = b'\xff\xd8\xff\xd9'
+
+        padding = bytearray()
+        remaining = max(size - len(data), 0)
+        while remaining > 4:
+            chunk = min(remaining - 4, 65533)
+            padding += b'\xff\xfe' + (chunk + 2).to_bytes(2, 'big') + b'\0' * chunk
+            remaining -= chunk + 4
+        return data[:2] + bytes(padding) + data[2:]
+
+
+class MockVk:
+    def __init__(self, dataset, api_latency=0.0, cdn_latency=0.0, rps_limit=0, error_rate=0.0,
+                 cdn_error_rate=0.0):
+        self.dataset = dataset
+        self.api_latency = api_latency
+        self.cdn_latency = cdn_latency
+        self.rps_limit = rps_limit
+        self.error_rate = error_rate
+        self.cdn_error_rate = cdn_error_rate
+
+        self.lock = threading.Lock()
+        self.http_requests = collections.Counter()
+        self.api_calls = collections.Counter()
+        self.errors = collections.Counter()
+        self.cdn_bytes = 0
+        self._recent = collections.deque()
+
+    # --- статистика -----------------------------------------------------------------
+
+    def stats(self):
+        with self.lock:
+            return {
+                'http_requests': dict(self.http_requests),
+                'api_calls': dict(self.api_calls),
+                'api_calls_total': sum(self.api_calls.values()),
+                'errors': dict(self.errors),
+                'cdn_bytes': self.cdn_bytes,
+            }
+
+    def reset(self):
+        with self.lock:
+            self.http_requests.clear()
+            self.api_calls.clear()
+            self.errors.clear()
+            self.cdn_bytes = 0
+
+    # --- API ------------------------------------------------------------------------
+
+    def handle_api(self, method, params):
+        with self.lock:
+            self.http_requests[method] += 1
+            if self._rate_limited() or (self.error_rate and random.random() < self.error_rate):
+                self.errors[TOO_MANY_REQUESTS] += 1
+                return {'error': {'error_code': TOO_MANY_REQUESTS, 'error_msg': 'Too many requests per second'}}
+
+        if self.api_latency:
+            time.sleep(self.api_latency)
+
+        if method == 'execute':
+            return self._execute(params.get('code', ''))
+
+        try:
+            return {'response': self.call(method, params)}
+        except KeyError as e:
+            return {'error': {'error_code': 100, 'error_msg': f'One of the parameters is missing: {e}'}}
+
+    def _rate_limited(self):
+        if not self.rps_limit:
+            return False
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] >= 1.0:
+            self._recent.popleft()
+        if len(self._recent) >= self.rps_limit:
+            return True
+        self._recent.append(now)
+        return False
+
+    def call(self, method, params):
+        with self.lock:
+            self.api_calls[method] += 1
+        handler = getattr(self, '_' + method.replace('.', '_'), None)
+        if handler is None:
+            raise KeyError(method)
+        return handler(params)
+
+    def _execute(self, code):
+        # Цикл курсора из HISTORY_ATTACHMENTS_CODE
+        if 'getHistoryAttachments' in code and 'while' in code:
+            def grab(name):
+                return re.search(r'"%s":\s*("[^"]*"|-?\d+)' % name, code).group(1)
+
+            params = {
+                'peer_id': int(grab('peer_id')),
+                'media_type': json.loads(grab('media_type')),
+                'count': int(grab('count')),
+                'start_from': json.loads(re.search(r'var next = ("[^"]*"|null);', code).group(1)) or '',
+            }
+            pages = int(re.search(r'while \(i < (\d+)\)', code).group(1))
+            items = []
+            for _ in range(pages):
+                page = self.call('messages.getHistoryAttachments', params)
+                items.extend(page['items'])
+                params['start_from'] = page.get('next_from')
+                if not params['start_from'] or not page['items']:
+                    break
+            return {'response': {'items': items, 'next_from': params['start_from']}}
+
+        # Пачка вызовов: return [API.method({...}), ...];
+        decoder = json.JSONDecoder()
+        responses, errors = [], []
+        for match in re.finditer(r'API\.([\w.]+)\(', code):
+            params, _ = decoder.raw_decode(code, match.end())
+            try:
+                responses.append(self.call(match.group(1), params))
+            except KeyError as e:
+                responses.append(False)
+                errors.append({'method': match.group(1), 'error_code': 100, 'error_msg': str(e)})
+        result = {'response': responses}
+        if errors:
+            result['execute_errors'] = errors
+        return result
+
+    def _messages_getConversations(self, params):
+        offset, count = int(params.get('offset', 0)), int(params.get('count', 20))
+        peers = self.dataset.peers[offset:offset + count]
+        items = []
+        for peer_id in peers:
+            last_id = self.dataset.message_count(peer_id)
+            conv = {'peer': {'id': peer_id, 'type': 'chat' if peer_id >= CHAT_PEER_OFFSET else 'user'},
+                    'last_message_id': last_id, 'last_conversation_message_id': last_id}
+            if peer_id >= CHAT_PEER_OFFSET:
+                conv['chat_settings'] = {'title': f'Беседа {peer_id - CHAT_PEER_OFFSET}'}
+            items.append({'conversation': conv,
+                          'last_message': {'id': last_id, 'date': 1500000000 + last_id * 60}})
+
+        response = {'count': len(self.dataset.peers), 'items': items}
+        if int(params.get('extended', 0)):
+            # Как и в VK, профили приходят не для всех — остальное добирается users.get
+            response['profiles'] = [self._user(p) for p in peers if 0 < p < CHAT_PEER_OFFSET and p % 3]
+            response['groups'] = [self._group(-p) for p in peers if p < 0]
+        return response
+
+    @staticmethod
+    def _user(user_id):
+        return {'id': user_id, 'first_name': 'Пользователь', 'last_name': str(user_id)}
+
+    @staticmethod
+    def _group(group_id):
+        return {'id': group_id, 'name': f'Сообщество {group_id}'}
+
+    def _users_get(self, params):
+        if not params.get('user_ids'):
+            # Без user_ids — владелец токена
+            return [self._user(1)]
+        return [self._user(int(x)) for x in str(params['user_ids']).split(',') if x]
+
+    def _groups_getById(self, params):
+        ids = params.get('group_ids') or params.get('group_id')
+        return [self._group(int(x)) for x in str(ids).split(',') if x]
+
+    def _messages_getChat(self, params):
+        ids = params.get('chat_ids') or params.get('chat_id')
+        return [{'id': int(x), 'title': f'Беседа {x}'} for x in str(ids).split(',') if x]
+
+    def _messages_getHistory(self, params):
+        peer_id = int(params['peer_id'])
+        offset, count = int(params.get('offset', 0)), int(params.get('count', 20))
+        total = self.dataset.message_count(peer_id)
+        if str(params.get('rev')) == '1':
+            # От старых к новым
+            first = offset + 1
+            items = [self.dataset.message(peer_id, mid) for mid in range(first, min(first + count, total + 1))]
+            return {'count': total, 'items': items}
+        newest = total - offset
+        items = [self.dataset.message(peer_id, mid) for mid in range(newest, max(newest - count, 0), -1)]
+        return {'count': total, 'items': items}
+
+    def _messages_getHistoryAttachments(self, params):
+        peer_id = int(params['peer_id'])
+        media_type = params['media_type']
+        count = int(params.get('count', 30))
+        start = params.get('start_from')
+        message_id = int(start) if start else self.dataset.message_count(peer_id)
+
+        items = []
+        while message_id > 0 and len(items) < count:
+            if self.dataset.attachment_type(peer_id, message_id) == media_type:
+                items.append({
+                    'message_id': message_id,
+                    'from_id': peer_id,
+                    'date': 1500000000 + message_id * 60,
+                    'attachment': self.dataset.attachment(peer_id, message_id),
+                })
+            message_id -= 1
+
+        response = {'items': items}
+        if message_id > 0:
+            response['next_from'] = str(message_id)
+        return response
+
+    def _video_get(self, params):
+        items = []
+        for key in str(params['videos']).split(','):
+            owner_id, video_id = key.split('_')[:2]
+            items.append({
+                'owner_id': int(owner_id), 'id': int(video_id),
+                'files': {
+                    'mp4_720': f'{self.dataset.base_url}/cdn/video/{owner_id}_{video_id}.mp4',
+                    'mp4_480': f'{self.dataset.base_url}/cdn/video/{owner_id}_{video_id}_480.mp4',
+                },
+            })
+        return {'count': len(items), 'items': items}
+
+    # --- CDN ------------------------------------------------------------------------
+
+    def handle_cdn(self, path, range_header):
+        if self.cdn_latency:
+            time.sleep(self.cdn_latency)
+
+        if self.cdn_error_rate and random.random() < self.cdn_error_rate:
+            with self.lock:
+                self.errors['cdn_503'] += 1
+            return 503, {'Retry-After': '0'}, b''
+
+        if path.startswith('/cdn/photo/'):
+            suffix = re.search(r'(_[mx])?\.jpg$', path).group(1) or ''
+            data, content_type = self.dataset.photo_bytes(suffix), 'image/jpeg'
+        elif path.startswith('/cdn/video/'):
+            size = self.dataset.video_size // (2 if path.endswith('_480.mp4') else 1)
+            data, content_type = self.dataset.video_bytes(size), 'video/mp4'
+        else:
+            return 404, {}, b''
+
+        status, headers = 200, {'Content-Type': content_type, 'Accept-Ranges': 'bytes'}
+        match = re.match(r'bytes=(\d+)-(\d*)', range_header or '')
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            if start >= len(data):
+                return 416, {'Content-Range': f'bytes */{len(data)}'}, b''
+            headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+            data, status = data[start:end + 1], 206
+
+        with self.lock:
+            self.http_requests['cdn'] += 1
+            self.cdn_bytes += len(data)
+        return status, headers, data
+
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            params = {k: v[-1] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+            self._api(params)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path.startswith('/method/'):
+                self._api({k: v[-1] for k, v in parse_qs(url.query).items()})
+                return
+            status, headers, body = mock.handle_cdn(url.path, self.headers.get('Range'))
+            self._send(status, headers, body)
+
+        def do_HEAD(self):
+            status, headers, body = mock.handle_cdn(urlparse(self.path).path, None)
+            self._send(status, headers, body, head=True)
+
+        def _api(self, params):
+            method = urlparse(self.path).path[len('/method/'):]
+            body = json.dumps(mock.handle_api(method, params), ensure_ascii=False).encode()
+            self._send(200, {'Content-Type': 'application/json'}, body)
+
+        def _send(self, status, headers, body, head=False):
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if not head:
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class MockServer:
+    """Сервер в фоновом потоке: api_url и base_url подставляются в AppSaver"""
+
+    def __init__(self, dataset, host='127.0.0.1', port=0, **options):
+        self.mock = MockVk(dataset, **options)
+        self.httpd = ThreadingHTTPServer((host, port), make_handler(self.mock))
+        self.httpd.daemon_threads = True
+        self.base_url = f'http://{host}:{self.httpd.server_port}'
+        dataset.base_url = self.base_url
+        self.api_url = self.base_url + '/method/'
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def add_dataset_arguments(parser):
+    parser.add_argument('--dialogs', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=20000, help='сообщений на все диалоги')
+    parser.add_argument('--giant-messages', type=int, default=0, help='отдельный размер первого диалога')
+    parser.add_argument('--photo-percent', type=int, default=20)
+    parser.add_argument('--video-percent', type=int, default=2)
+    parser.add_argument('--photo-kb', type=int, default=150)
+    parser.add_argument('--video-kb', type=int, default=5 * 1024)
+    parser.add_argument('--api-latency', type=float, default=0.05, help='секунд на запрос API')
+    parser.add_argument('--cdn-latency', type=float, default=0.05, help='секунд на запрос CDN')
+    parser.add_argument('--server-rps', type=int, default=0, help='лимит сервера, сверх — ошибка 6')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля случайных ошибок 6')
+    parser.add_argument('--cdn-error-rate', type=float, default=0.0, help='доля ответов CDN 503')
+
+
+def dataset_from_args(args):
+    return Dataset(
+        dialogs=args.dialogs,
+        messages=args.messages,
+        giant_messages=args.giant_messages,
+        photo_percent=args.photo_percent,
+        video_percent=args.video_percent,
+        photo_size=args.photo_kb * 1024,
+        video_size=args.video_kb * 1024,
+    )
+
+
+def server_options(args):
+    return {
+        'api_latency': args.api_latency,
+        'cdn_latency': args.cdn_latency,
+        'rps_limit': args.server_rps,
+        'error_rate': args.error_rate,
+        'cdn_error_rate': args.cdn_error_rate,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    add_dataset_arguments(parser)
+    args = parser.parse_args()
+
+    with MockServer(dataset_from_args(args), args.host, args.port, **server_options(args)) as server:
+        print(f'API: {server.api_url}  CDN: {server.base_url}/cdn/', flush=True)
+        try:
+            while True:
+                time.sleep(5)
+                print(json.dumps(server.mock.stats(), ensure_ascii=False), flush=True)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+"""
+Консольный запуск архивации без GUI (cron, контейнеры, скрипты).
+
+    python cli.py --token $VK_TOKEN --output /data/vk --all --incremental
+    python cli.py --peer-id 2000000001,12345 --output ./out --workers 16
+    python cli.py --all --output ./out --engine asyncio
+    python cli.py --all --output ./out --types photo --date-from 2024-05-01 --max-photo-size 1280
+    python cli.py --all --output /data/vk --plan --plan-sample 1000
+    python cli.py --all --output ./out --priority 2000000001 --commands
+
+Ход работы пишется в stdout построчно в JSON (--progress json), логи — в stderr.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+# Логи до импорта scripts.*: их basicConfig тогда не перехватит stdout
+logging.basicConfig(
+    level=logging.WARNING,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[logging.StreamHandler(sys.stderr)]
+)
+
+from scripts.async_engine import ENGINES, ENGINE_THREADS, create_archiver  # noqa: E402
+from scripts.disk_space import MIN_FREE_BYTES  # noqa: E402
+from scripts.conversation_cache import ConversationCache, owner_key, sync_conversations  # noqa: E402
+from scripts.media_filter import MEDIA_TYPES, MediaFilter  # noqa: E402
+from scripts.pipeline import DEFAULT_CONCURRENCY  # noqa: E402
+from scripts.shards import DEFAULT_SHARD_SIZE  # noqa: E402
+from scripts.metrics import metrics  # noqa: E402
+from scripts.parse_vk_dialogs import AppSaver  # noqa: E402
+
+logger = logging.getLogger('cli')
+
+
+class JsonProgress:
+    """Одна JSON-строка на событие; stats не чаще interval секунд"""
+
+    def __init__(self, enabled=True, interval=1.0):
+        self.enabled = enabled
+        self.interval = interval
+        self._last_stats = 0.0
+
+    def emit(self, event, **data):
+        if not self.enabled:
+            return
+        data.update(event=event, ts=round(time.time(), 3))
+        sys.stdout.write(json.dumps(data, ensure_ascii=False) + '\n')
+        sys.stdout.flush()
+
+    def stats(self, stats, force=False):
+        now = time.monotonic()
+        if force or now - self._last_stats >= self.interval:
+            self._last_stats = now
+            self.emit('stats', **stats)
+
+
+def parse_peer_ids(values):
+    peer_ids = []
+    for value in values or []:
+        peer_ids.extend(int(part) for part in value.split(',') if part.strip())
+    return peer_ids
+
+
+def parse_types(value):
+    types = tuple(part.strip() for part in value.split(',') if part.strip())
+    unknown = set(types) - set(MEDIA_TYPES)
+    if not types or unknown:
+        raise argparse.ArgumentTypeError(f"ожидается {','.join(MEDIA_TYPES)} через запятую")
+    return types
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError('дата в формате ГГГГ-ММ-ДД')
+
+
+def build_media_filter(args):
+    # Границы — по локальному времени, --date-to включает весь день
+    date_from = int(args.date_from.timestamp()) if args.date_from else None
+    date_to = int((args.date_to + datetime.timedelta(days=1)).timestamp()) - 1 if args.date_to else None
+    return MediaFilter(
+        types=args.types,
+        date_from=date_from,
+        date_to=date_to,
+        max_photo_size=args.max_photo_size,
+        min_photo_size=args.min_photo_size,
+        max_video_height=args.max_video_quality
+    )
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--token', default=os.environ.get('VK_TOKEN'),
+                        help='токен VK (по умолчанию из VK_TOKEN)')
+    parser.add_argument('--output', '-o', required=True, help='папка сохранения')
+
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--peer-id', action='append', metavar='IDS',
+                        help='peer_id через запятую, можно повторять')
+    target.add_argument('--filter', metavar='REGEX',
+                        help='диалоги, название которых подходит под регулярное выражение')
+    target.add_argument('--all', action='store_true', help='все диалоги')
+    target.add_argument('--retry-failed', action='store_true',
+                        help='повторить только неудачные загрузки прошлых запусков')
+
+    parser.add_argument('--workers', type=int,
+                        help='параллельных загрузок (по умолчанию 8 потоков или 64 корутины)')
+    parser.add_argument('--engine', choices=ENGINES, default=ENGINE_THREADS,
+                        help='движок загрузки: пул потоков или asyncio + aiohttp')
+    parser.add_argument('--parallel-dialogs', type=int, default=DEFAULT_CONCURRENCY,
+                        help='сколько диалогов перечислять одновременно')
+    parser.add_argument('--incremental', action='store_true',
+                        help='только новое с прошлого запуска (манифест в папке сохранения)')
+    parser.add_argument('--include-forwarded', action=argparse.BooleanOptionalAction, default=True,
+                        help='искать и вложения пересланных сообщений (по умолчанию да; '
+                             '--no-include-forwarded — только вложения самих сообщений)')
+    parser.add_argument('--priority', action='append', metavar='IDS',
+                        help='peer_id через запятую — эти диалоги скачиваются первыми, в указанном порядке')
+    parser.add_argument('--commands', action='store_true',
+                        help='читать из stdin команды «prioritize PEER_ID», чтобы поднять диалог на ходу')
+
+    media = parser.add_argument_group('фильтры (применяются при перечислении истории)')
+    media.add_argument('--types', type=parse_types, default=MEDIA_TYPES, metavar='photo,video',
+                       help='какие вложения скачивать')
+    media.add_argument('--date-from', type=parse_date, metavar='ГГГГ-ММ-ДД',
+                       help='сообщения не раньше этой даты; более старая история не запрашивается')
+    media.add_argument('--date-to', type=parse_date, metavar='ГГГГ-ММ-ДД',
+                       help='сообщения не позже этой даты (включительно)')
+    media.add_argument('--max-photo-size', type=int, metavar='PX',
+                       help='предел длинной стороны фото: берётся меньший размер из доступных')
+    media.add_argument('--min-photo-size', type=int, metavar='PX',
+                       help='пропускать фото, у которых даже оригинал меньше')
+    media.add_argument('--max-video-quality', type=int, choices=(1080, 720, 480, 360, 240, 144),
+                       help='предел качества mp4')
+
+    parser.add_argument('--plan', action='store_true',
+                        help='только оценить объём (метаданные + выборочные HEAD) и выйти')
+    parser.add_argument('--plan-sample', type=int, metavar='N',
+                        help='при оценке брать из диалога не больше N аттачей, остальное экстраполировать')
+    parser.add_argument('--min-free-space', type=float, default=MIN_FREE_BYTES / 1024 ** 3, metavar='ГБ',
+                        help='ниже этого запаса на диске загрузка встаёт на паузу; 0 — не следить')
+    parser.add_argument('--shards', action='store_true',
+                        help='упаковывать медиа в tar-шарды с SQLite-индексом (shards/) вместо отдельных файлов')
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE // 1048576, metavar='МБ',
+                        help='размер, после которого начинается новый шард')
+    parser.add_argument('--no-dedup', action='store_true', help='не связывать дубликаты между диалогами')
+    parser.add_argument('--dedup-hash', action='store_true', help='дедупликация и по хэшу содержимого')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='не использовать локальный кэш списка диалогов')
+    parser.add_argument('--no-report', action='store_true',
+                        help='не писать JSON-отчёт о прогоне в .vk_media_reports/')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='отдавать текущие метрики JSON по http://127.0.0.1:PORT/')
+    parser.add_argument('--progress', choices=('json', 'none'), default='json')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    return parser
+
+
+def read_commands(archiver, stream):
+    """Команды из stdin во время загрузки, по одной в строке: prioritize PEER_ID"""
+    for line in stream:
+        parts = line.split()
+        if len(parts) == 2 and parts[0] == 'prioritize' and parts[1].lstrip('-').isdigit():
+            archiver.prioritize(int(parts[1]))
+        elif parts:
+            logger.warning(f"Неизвестная команда: {line.strip()}")
+
+
+def select_dialogs(saver, args):
+    peer_ids = parse_peer_ids(args.peer_id)
+    if peer_ids:
+        return saver.get_dialogs(peer_ids)
+
+    if args.no_cache:
+        dialogs = saver.get_all_conversations()
+    else:
+        cache = ConversationCache(owner_key(saver, args.token))
+        try:
+            dialogs = sync_conversations(saver, cache)
+        finally:
+            cache.close()
+    if args.filter:
+        pattern = re.compile(args.filter, re.IGNORECASE)
+        dialogs = [d for d in dialogs if pattern.search(d['title'] or '')]
+    return dialogs
+
+
+def run_plan(archiver, args, progress):
+    try:
+        plan = archiver.plan(
+            sample_limit=args.plan_sample,
+            on_progress=lambda p: progress.emit('progress', percent=p)
+        )
+    except Exception as e:
+        progress.emit('error', message=str(e))
+        logger.exception(f"Ошибка оценки объёма: {e}")
+        return 1
+
+    progress.emit('plan', **plan)
+    gb = 1024 ** 3
+    message = (f"Оценка: {plan['items']} файлов, ~{plan['bytes'] / gb:.2f} ГБ"
+               f"{' (часть диалогов — по выборке)' if plan['sampled'] else ''}; "
+               f"свободно {plan['free_bytes'] / gb:.2f} ГБ")
+    if plan['fits']:
+        logger.warning(message)
+    else:
+        logger.error(message + f" — с запасом {plan['min_free_bytes'] / gb:.1f} ГБ не поместится")
+    return 0 if plan['fits'] else 1
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+    if not args.token:
+        print('Не указан токен: --token или переменная VK_TOKEN', file=sys.stderr)
+        return 2
+
+    progress = JsonProgress(enabled=args.progress == 'json')
+    os.makedirs(args.output, exist_ok=True)
+    if args.metrics_port is not None:
+        port = metrics.serve(args.metrics_port)
+        logger.warning(f"Метрики: http://127.0.0.1:{port}/")
+
+    dialogs = []
+    if not args.retry_failed:
+        try:
+            dialogs = select_dialogs(AppSaver(args.token), args)
+        except Exception as e:
+            progress.emit('error', message=str(e))
+            logger.error(f"Не удалось получить список диалогов: {e}")
+            return 1
+
+        progress.emit('dialogs', count=len(dialogs), dialogs=dialogs)
+        if not dialogs:
+            return 0
+
+    try:
+        archiver = create_archiver(
+            args.token, dialogs, args.output,
+            engine=args.engine,
+            include_forwarded=args.include_forwarded,
+            workers=args.workers,
+            dialog_concurrency=args.parallel_dialogs,
+            incremental=args.incremental,
+            dedup=not args.no_dedup,
+            dedup_by_hash=args.dedup_hash,
+            report=not args.no_report,
+            retry_failed=args.retry_failed,
+            media_filter=build_media_filter(args),
+            min_free_space=int(args.min_free_space * 1024 ** 3),
+            shards=args.shards,
+            shard_size=args.shard_size * 1048576,
+            on_progress=lambda p: progress.emit('progress', percent=p),
+            on_stats=progress.stats,
+            on_postprocess=lambda stats: progress.stats({'postprocess': stats})
+        )
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    if args.plan:
+        return run_plan(archiver, args, progress)
+
+    def _stop(signum, frame):
+        logger.warning('Остановка по сигналу, незавершённые загрузки продолжатся при следующем запуске')
+        archiver.stop()
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+
+    # Последний поднятый — первый, поэтому список поднимаем с конца
+    for peer_id in reversed(parse_peer_ids(args.priority)):
+        archiver.prioritize(peer_id)
+    if args.commands:
+        threading.Thread(target=read_commands, args=(archiver, sys.stdin), daemon=True).start()
+
+    try:
+        stats = archiver.run()
+    except Exception as e:
+        progress.emit('error', message=str(e))
+        logger.exception(f"Ошибка архивации: {e}")
+        return 1
+
+    progress.stats(stats, force=True)
+    if archiver.report_path:
+        progress.emit('report', path=archiver.report_path, summary=metrics.snapshot()['summary'])
+    progress.emit('finished' if archiver.is_running else 'stopped')
+    return 0 if archiver.is_running and not stats['files_failed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
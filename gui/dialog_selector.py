@@ -1,33 +1,200 @@
-from PySide6.QtCore import Qt
-from PySide6.QtWidgets import QDialog, QVBoxLayout, QPushButton, QListWidget, QListWidgetItem, QCheckBox
+from PySide6.QtCore import Qt, QAbstractListModel, QModelIndex, QSortFilterProxyModel, QTimer, Signal
+import time
 
+from PySide6.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QPushButton, QListView, QLineEdit,
+                               QComboBox, QLabel, QCheckBox)
+
+from gui.progress import format_size
 from gui.styles import APP_STYLE
+from scripts.media_filter import MEDIA_TYPES, MediaFilter
+
+LAST_DATE_ROLE = Qt.ItemDataRole.UserRole + 1
+MESSAGES_ROLE = Qt.ItemDataRole.UserRole + 2
+
+# (подпись, роль сортировки, порядок)
+SORT_OPTIONS = (
+    ("По дате сообщения", LAST_DATE_ROLE, Qt.SortOrder.DescendingOrder),
+    ("По числу сообщений", MESSAGES_ROLE, Qt.SortOrder.DescendingOrder),
+    ("По названию", Qt.ItemDataRole.DisplayRole, Qt.SortOrder.AscendingOrder),
+)
+
+FILTER_DELAY_MS = 150
+
+# Фильтры загрузки (scripts.media_filter): подпись и значение
+TYPE_OPTIONS = (
+    ("Фото и видео", MEDIA_TYPES),
+    ("Только фото", ('photo',)),
+    ("Только видео", ('video',)),
+)
+# Период — дней назад от текущего момента
+PERIOD_OPTIONS = (
+    ("За всё время", None),
+    ("За месяц", 30),
+    ("За 3 месяца", 90),
+    ("За год", 365),
+)
+# (подпись, предел стороны фото, предел качества видео)
+QUALITY_OPTIONS = (
+    ("Оригинал", None, None),
+    ("До 2560px / 1080p", 2560, 1080),
+    ("До 1280px / 720p", 1280, 720),
+    ("До 807px / 480p", 807, 480),
+)
+
+
+class DialogListModel(QAbstractListModel):
+    """
+    Диалоги как данные, а не виджеты: отметки хранятся множеством peer_id,
+    QListView рисует только видимые строки.
+    """
+
+    def __init__(self, dialogs, parent=None):
+        super().__init__(parent)
+        self._dialogs = list(dialogs)
+        self._checked = set()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._dialogs)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        dialog = self._dialogs[index.row()]
+
+        if role == Qt.ItemDataRole.DisplayRole:
+            return dialog['title'] or str(dialog['peer_id'])
+        if role == Qt.ItemDataRole.CheckStateRole:
+            return Qt.CheckState.Checked if dialog['peer_id'] in self._checked else Qt.CheckState.Unchecked
+        if role == LAST_DATE_ROLE:
+            return dialog.get('last_date') or 0
+        if role == MESSAGES_ROLE:
+            return dialog.get('messages') or 0
+        return None
+
+    def setData(self, index, value, role=Qt.ItemDataRole.EditRole):
+        if not index.isValid() or role != Qt.ItemDataRole.CheckStateRole:
+            return False
+        peer_id = self._dialogs[index.row()]['peer_id']
+        if Qt.CheckState(value) == Qt.CheckState.Checked:
+            self._checked.add(peer_id)
+        else:
+            self._checked.discard(peer_id)
+        self.dataChanged.emit(index, index, [Qt.ItemDataRole.CheckStateRole])
+        return True
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.ItemFlag.NoItemFlags
+        return Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsUserCheckable
+
+    def set_dialogs(self, dialogs):
+        """Новый список после фонового обновления; отметки сохраняются по peer_id"""
+        self.beginResetModel()
+        self._dialogs = list(dialogs)
+        self._checked &= {dialog['peer_id'] for dialog in self._dialogs}
+        self.endResetModel()
+
+    def set_checked(self, rows, checked):
+        """Массовая отметка одним сигналом dataChanged вместо сигнала на строку"""
+        if not rows:
+            return
+        peer_ids = {self._dialogs[row]['peer_id'] for row in rows}
+        if checked:
+            self._checked |= peer_ids
+        else:
+            self._checked -= peer_ids
+        self.dataChanged.emit(self.index(min(rows)), self.index(max(rows)),
+                              [Qt.ItemDataRole.CheckStateRole])
+
+    def checked_count(self):
+        return len(self._checked)
+
+    def checked_dialogs(self):
+        return [dialog for dialog in self._dialogs if dialog['peer_id'] in self._checked]
 
 
 class DialogSelectorDialog(QDialog):
-    def __init__(self, dialog_labels, parent=None):
+    # Выбранные диалоги, MediaFilter, пересланные — оценку запускает главное окно
+    estimate_requested = Signal(list, object, bool)
+
+    def __init__(self, dialog_labels, parent=None, refreshing=False):
         super().__init__(parent)
+        self.refreshing = refreshing
         self.setWindowTitle("Выбор диалогов")
-        self.setFixedSize(400, 500)
+        self.setFixedSize(400, 650)
         self.setStyleSheet(APP_STYLE)
 
+        self.model = DialogListModel(dialog_labels, self)
+        self.proxy = QSortFilterProxyModel(self)
+        self.proxy.setSourceModel(self.model)
+        self.proxy.setFilterCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+        self.proxy.setSortCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+
         layout = QVBoxLayout()
 
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("Поиск по названию")
+        self.search_input.setClearButtonEnabled(True)
+        layout.addWidget(self.search_input)
+
+        # Фильтр применяется после паузы в наборе, а не на каждую букву
+        self._filter_timer = QTimer(self)
+        self._filter_timer.setSingleShot(True)
+        self._filter_timer.setInterval(FILTER_DELAY_MS)
+        self._filter_timer.timeout.connect(self._apply_filter)
+        self.search_input.textChanged.connect(self._filter_timer.start)
+
+        controls = QHBoxLayout()
+        self.sort_combo = QComboBox()
+        for label, _, _ in SORT_OPTIONS:
+            self.sort_combo.addItem(label)
+        self.sort_combo.currentIndexChanged.connect(self._apply_sort)
+        controls.addWidget(self.sort_combo, stretch=2)
+
         self.btn_toggle_all = QPushButton("Выбрать все")
         self.btn_toggle_all.clicked.connect(self.toggle_all_selection)
-        layout.addWidget(self.btn_toggle_all)
+        controls.addWidget(self.btn_toggle_all, stretch=1)
+        layout.addLayout(controls)
+
+        self.list_view = QListView()
+        self.list_view.setUniformItemSizes(True)
+        self.list_view.setModel(self.proxy)
+        layout.addWidget(self.list_view)
 
-        self.list_widget = QListWidget()
+        self.counter_label = QLabel()
+        layout.addWidget(self.counter_label)
 
-        for dialog_data in dialog_labels:
-            item = QListWidgetItem()
-            check = QCheckBox(f"{dialog_data['title']}")
-            check.setProperty("peer_id", dialog_data["peer_id"])
-            check.setChecked(False)
-            self.list_widget.addItem(item)
-            self.list_widget.setItemWidget(item, check)
+        media_controls = QHBoxLayout()
+        self.type_combo = QComboBox()
+        for label, _ in TYPE_OPTIONS:
+            self.type_combo.addItem(label)
+        media_controls.addWidget(self.type_combo)
+        self.period_combo = QComboBox()
+        for label, _ in PERIOD_OPTIONS:
+            self.period_combo.addItem(label)
+        media_controls.addWidget(self.period_combo)
+        self.quality_combo = QComboBox()
+        for label, _, _ in QUALITY_OPTIONS:
+            self.quality_combo.addItem(label)
+        media_controls.addWidget(self.quality_combo)
+        layout.addLayout(media_controls)
 
-        layout.addWidget(self.list_widget)
+        self.forwarded_check = QCheckBox("Вложения пересланных сообщений")
+        self.forwarded_check.setChecked(True)
+        layout.addWidget(self.forwarded_check)
+
+        self.shards_check = QCheckBox("Упаковать в tar-архивы с индексом")
+        self.shards_check.setToolTip("Вместо тысяч отдельных файлов — крупные шарды и shards/index.sqlite")
+        layout.addWidget(self.shards_check)
+
+        estimate_row = QHBoxLayout()
+        self.btn_estimate = QPushButton("Оценить объём")
+        self.btn_estimate.clicked.connect(self._request_estimate)
+        estimate_row.addWidget(self.btn_estimate)
+        self.estimate_label = QLabel()
+        self.estimate_label.setWordWrap(True)
+        estimate_row.addWidget(self.estimate_label, stretch=1)
+        layout.addLayout(estimate_row)
 
         self.btn_confirm = QPushButton("Начать загрузку")
         self.btn_confirm.clicked.connect(self.accept)
@@ -35,23 +202,85 @@ class DialogSelectorDialog(QDialog):
 
         self.setLayout(layout)
 
+        self.model.dataChanged.connect(self._update_counter)
+        self.model.modelReset.connect(self._update_counter)
+        self.proxy.layoutChanged.connect(self._update_counter)
+        self._apply_sort(0)
+        self._update_counter()
+
+    def _apply_filter(self):
+        self.proxy.setFilterFixedString(self.search_input.text())
+        self._update_counter()
+
+    def _apply_sort(self, index):
+        _, role, order = SORT_OPTIONS[index]
+        self.proxy.setSortRole(role)
+        self.proxy.sort(0, order)
+
+    def update_dialogs(self, dialog_labels):
+        self.refreshing = False
+        self.model.set_dialogs(dialog_labels)
+
+    def finish_refresh(self):
+        """Обновление не удалось — остаётся список из кэша"""
+        self.refreshing = False
+        self._update_counter()
+
+    def _update_counter(self, *args):
+        text = (f"Выбрано: {self.model.checked_count()}, показано: "
+                f"{self.proxy.rowCount()} из {self.model.rowCount()}")
+        if self.refreshing:
+            text += " · обновление…"
+        self.counter_label.setText(text)
+
     def toggle_all_selection(self):
+        # Действует на отфильтрованные строки: «найти и выбрать все» по подстроке
         new_state = self.btn_toggle_all.text() == "Выбрать все"
-        for i in range(self.list_widget.count()):
-            item = self.list_widget.item(i)
-            widget = self.list_widget.itemWidget(item)
-            widget.setChecked(new_state)
+        rows = [self.proxy.mapToSource(self.proxy.index(i, 0)).row() for i in range(self.proxy.rowCount())]
+        self.model.set_checked(rows, new_state)
 
         self.btn_toggle_all.setText("Снять все" if new_state else "Выбрать все")
 
+    def get_media_filter(self):
+        _, types = TYPE_OPTIONS[self.type_combo.currentIndex()]
+        _, days = PERIOD_OPTIONS[self.period_combo.currentIndex()]
+        _, max_photo_size, max_video_height = QUALITY_OPTIONS[self.quality_combo.currentIndex()]
+        return MediaFilter(
+            types=types,
+            date_from=int(time.time()) - days * 86400 if days else None,
+            max_photo_size=max_photo_size,
+            max_video_height=max_video_height
+        )
+
+    def _request_estimate(self):
+        selected = self.get_selected_labels()
+        if not selected:
+            self.estimate_label.setText("Не выбрано ни одного диалога")
+            return
+        self.btn_estimate.setEnabled(False)
+        self.estimate_label.setText("Оценка…")
+        self.estimate_requested.emit(selected, self.get_media_filter(), self.include_forwarded())
+
+    def show_estimate(self, plan):
+        self.btn_estimate.setEnabled(True)
+        text = (f"~{format_size(plan['bytes'])}, файлов: {plan['items']}"
+                f"{' (по выборке)' if plan['sampled'] else ''}; свободно {format_size(plan['free_bytes'])}")
+        if not plan['fits']:
+            text += " — не поместится"
+        self.estimate_label.setText(text)
+
+    def show_estimate_error(self, message):
+        self.btn_estimate.setEnabled(True)
+        self.estimate_label.setText(f"Ошибка оценки: {message}")
+
+    def include_forwarded(self):
+        return self.forwarded_check.isChecked()
+
+    def use_shards(self):
+        return self.shards_check.isChecked()
+
     def get_selected_labels(self):
-        selected = []
-        for i in range(self.list_widget.count()):
-            item = self.list_widget.item(i)
-            widget = self.list_widget.itemWidget(item)
-            if widget.isChecked():
-                selected.append({
-                    'title': widget.text(),
-                    'peer_id': widget.property("peer_id")
-                })
-        return selected
\ No newline at end of file
+        return [
+            {'title': dialog['title'], 'peer_id': dialog['peer_id']}
+            for dialog in self.model.checked_dialogs()
+        ]
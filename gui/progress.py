@@ -0,0 +1,134 @@
+import time
+
+from PySide6.QtCore import QObject, QTimer
+
+REFRESH_INTERVAL_MS = 200
+# Сглаживание скорости: доля нового замера за один тик
+RATE_SMOOTHING = 0.2
+
+
+def format_size(size):
+    for unit in ('Б', 'КБ', 'МБ', 'ГБ'):
+        if size < 1024 or unit == 'ГБ':
+            return f"{size:.0f} {unit}" if unit == 'Б' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+class ProgressMonitor(QObject):
+    """
+    Слоты set_percent / set_stats только запоминают последнее значение,
+    а виджеты перерисовываются по QTimer не чаще REFRESH_INTERVAL_MS.
+    Частые сигналы от движка загрузки так схлопываются в один кадр и не
+    блокируют цикл событий.
+    """
+
+    def __init__(self, bar, label, parent=None):
+        super().__init__(parent)
+        self.bar = bar
+        self.label = label
+
+        self._timer = QTimer(self)
+        self._timer.setInterval(REFRESH_INTERVAL_MS)
+        self._timer.timeout.connect(self._refresh)
+        self.reset()
+
+    def reset(self):
+        self._percent = 0
+        self._stats = None
+        self._dirty = True
+        self._started = time.monotonic()
+        self._last_bytes = 0
+        self._last_tick = self._started
+        self._rate = None
+        self.bar.setValue(0)
+        self.label.setText('')
+
+    def start(self):
+        self.reset()
+        self._timer.start()
+
+    def stop(self, percent=None):
+        """Последний кадр сразу, без ожидания таймера"""
+        if percent is not None:
+            self._percent = percent
+            self._dirty = True
+        self._refresh()
+        self._timer.stop()
+
+    def set_percent(self, value):
+        self._percent = value
+        self._dirty = True
+
+    def set_stats(self, stats):
+        self._stats = stats
+        self._dirty = True
+
+    def _refresh(self):
+        now = time.monotonic()
+        self._update_rate(now)
+        if not self._dirty:
+            return
+        self._dirty = False
+
+        fraction = self._fraction()
+        self.bar.setValue(int(fraction * 100))
+        if self._stats is not None:
+            self.label.setText(self._describe(fraction, now))
+
+    def _update_rate(self, now):
+        if self._stats is None:
+            return
+        bytes_done = self._stats.get('bytes_done', 0)
+        elapsed = now - self._last_tick
+        if elapsed < REFRESH_INTERVAL_MS / 2000:
+            # Внеочередной кадр из stop() — слишком короткий замер для скорости
+            return
+        current = (bytes_done - self._last_bytes) / elapsed
+        self._rate = current if self._rate is None else (
+            self._rate + RATE_SMOOTHING * (current - self._rate)
+        )
+        self._last_bytes = bytes_done
+        self._last_tick = now
+        self._dirty = True
+
+    def _fraction(self):
+        stats = self._stats
+        if not stats or not stats.get('dialogs_total'):
+            return self._percent / 100
+
+        # Доля перечисленных диалогов, умноженная на долю скачанного из
+        # уже найденного: очередь растёт по ходу перечисления, точнее не узнать.
+        # Текущий диалог считаем пройденным наполовину
+        done, total = stats['dialogs_done'], stats['dialogs_total']
+        enumerated = 1.0 if done >= total else (done + 0.5) / total
+        submitted = stats.get('files_submitted', 0)
+        downloaded = self._completed(stats) / submitted if submitted else 1
+        return min(enumerated * downloaded, 1.0)
+
+    @staticmethod
+    def _completed(stats):
+        return stats.get('files_done', 0) + stats.get('files_linked', 0) + stats.get('files_failed', 0)
+
+    def _describe(self, fraction, now):
+        stats = self._stats
+        if stats.get('low_space'):
+            return (f"Пауза: на диске свободно {format_size(stats.get('free_bytes', 0))}, "
+                    f"освободите место — загрузка продолжится сама")
+        parts = [
+            f"Файлы: {self._completed(stats)} из {stats.get('files_submitted', 0)}",
+            format_size(stats.get('bytes_done', 0)),
+        ]
+        if self._rate is not None:
+            parts.append(f"{format_size(max(self._rate, 0))}/с")
+
+        elapsed = now - self._started
+        if 0.01 < fraction < 1:
+            parts.append(f"осталось ~{format_eta(elapsed * (1 - fraction) / fraction)}")
+        return ' · '.join(parts)
@@ -1,10 +1,20 @@
-import os
+import time
+
 from PySide6.QtCore import QThread, Signal
 from scripts.parse_vk_dialogs import AppSaver
+from scripts.archiver import Archiver
+from scripts.async_engine import ENGINE_THREADS, create_archiver
+from scripts.conversation_cache import ConversationCache, owner_key, sync_conversations
+from scripts.planner import DEFAULT_SAMPLE_LIMIT
+
+# Статистика от движка приходит на каждый файл; в UI уходит не чаще этого
+STATS_INTERVAL = 0.1
 
 
 class ConversationThread(QThread):
     progress_updated = Signal(int)
+    # Список из локального кэша — сразу, до обращения к API за изменениями
+    cached = Signal(list)
     finished = Signal(list)
     error_occurred = Signal(str)
 
@@ -15,65 +25,105 @@ class ConversationThread(QThread):
     def run(self):
         try:
             app = AppSaver(self.token)
-            app.get_all_conversations(
-                progress_callback=lambda p: self.progress_updated.emit(p)
-            )
-            filtered_labels = [l for l in app.conversations_label if "Недоступный" not in l]
-            self.finished.emit(filtered_labels)
+            cache = ConversationCache(owner_key(app, self.token))
+            try:
+                cached = cache.load()
+                if cached:
+                    self.cached.emit(self._filter(cached))
+
+                dialogs = sync_conversations(
+                    app, cache,
+                    progress_callback=lambda p: self.progress_updated.emit(p)
+                )
+            finally:
+                cache.close()
+            self.finished.emit(self._filter(dialogs))
 
         except Exception as e:
             self.error_occurred.emit(str(e))
 
+    @staticmethod
+    def _filter(dialogs):
+        return [l for l in dialogs if "Недоступный" not in l]
 
-class DownloadThread(QThread):
-    progress_updated = Signal(int)
-    finished = Signal()
+
+class PlanThread(QThread):
+    """Оценка объёма выбранных диалогов до загрузки (Archiver.plan, режим выборки)"""
+    finished = Signal(dict)
     error_occurred = Signal(str)
 
-    def __init__(self, token, dialogs, save_path):
+    def __init__(self, token, dialogs, save_path, include_forwarded=True, media_filter=None,
+                 sample_limit=DEFAULT_SAMPLE_LIMIT):
         super().__init__()
-        self.token = token
-        self.dialogs = dialogs
-        self.save_path = save_path
-        self._is_running = True
+        self.sample_limit = sample_limit
+        self.archiver = Archiver(
+            token, dialogs, save_path,
+            include_forwarded=include_forwarded,
+            media_filter=media_filter
+        )
 
     def run(self):
         try:
-            downloader = AppSaver(token=self.token)
-            total = len(self.dialogs)
-
-            for i, dialog_data in enumerate(self.dialogs):
-                if not self._is_running:
-                    break
-
-                self.progress_updated.emit(int((i / total) * 100))
-                peer_id = dialog_data['peer_id']
+            self.finished.emit(self.archiver.plan(sample_limit=self.sample_limit))
+        except Exception as e:
+            self.error_occurred.emit(str(e))
 
-                media = downloader.get_media(peer_id)
-                valid_media = [m for m in media if m is not None]
+    def stop(self):
+        self.archiver.stop()
 
-                folder_name = self.sanitize_folder_name(dialog_data['title'])
-                final_save_path = os.path.join(self.save_path, folder_name)
-                os.makedirs(final_save_path, exist_ok=True)
 
-                for item in valid_media:
-                    if not self._is_running:
-                        break
+class DownloadThread(QThread):
+    progress_updated = Signal(int)
+    stats_updated = Signal(dict)
+    postprocess_updated = Signal(dict)
+    finished = Signal()
+    error_occurred = Signal(str)
 
-                    filename = f"{item['id']}.{'jpg' if item['type'] == 'photo' else 'mp4'}"
-                    path = os.path.join(final_save_path, filename)
-                    downloader.download_file(item['url'], path, item['date'])
+    def __init__(self, token, dialogs, save_path, include_forwarded=True, workers=None,
+                 incremental=False, dedup=True, dedup_by_hash=False, engine=ENGINE_THREADS,
+                 media_filter=None, shards=False):
+        super().__init__()
+        self._last_stats = 0.0
+        self._last_postprocess = 0.0
+        self.archiver = create_archiver(
+            token, dialogs, save_path,
+            engine=engine,
+            include_forwarded=include_forwarded,
+            workers=workers,
+            incremental=incremental,
+            dedup=dedup,
+            dedup_by_hash=dedup_by_hash,
+            media_filter=media_filter,
+            shards=shards,
+            on_progress=lambda p: self.progress_updated.emit(p),
+            on_stats=self._emit_stats,
+            on_postprocess=self._emit_postprocess
+        )
+
+    def _emit_stats(self, stats):
+        now = time.monotonic()
+        if now - self._last_stats >= STATS_INTERVAL:
+            self._last_stats = now
+            self.stats_updated.emit(stats)
+
+    def _emit_postprocess(self, stats):
+        now = time.monotonic()
+        if now - self._last_postprocess >= STATS_INTERVAL:
+            self._last_postprocess = now
+            self.postprocess_updated.emit(stats)
 
-            self.finished.emit() if self._is_running else None
+    def run(self):
+        try:
+            stats = self.archiver.run()
+            self.stats_updated.emit(stats)
+            self.finished.emit() if self.archiver.is_running else None
 
         except Exception as e:
             self.error_occurred.emit(str(e))
 
-    def sanitize_folder_name(self, name):
-        invalid_chars = ['<', '>', ':', '"', '/', '\\', '|', '?', '*']
-        for char in invalid_chars:
-            name = name.replace(char, '_')
-        return name.strip()
-
     def stop(self):
-        self._is_running = False
\ No newline at end of file
+        self.archiver.stop()
+
+    def prioritize(self, peer_id):
+        # Из GUI-потока: Archiver.prioritize потокобезопасен
+        self.archiver.prioritize(peer_id)
@@ -1,16 +1,17 @@
 import logging
+import multiprocessing
 import sys
-import time
 import webbrowser
 from PySide6.QtWidgets import (QApplication, QWidget, QVBoxLayout,
                                QPushButton, QLineEdit, QLabel, QProgressBar,
-                               QFileDialog, QMessageBox, QDialog, QHBoxLayout)
+                               QFileDialog, QMessageBox, QDialog, QHBoxLayout, QComboBox)
 from PySide6.QtGui import QIcon, QFont
-from PySide6.QtCore import Qt, QSize, QThread
+from PySide6.QtCore import Qt, QSize, QThread, QTimer
 
 from gui.dialog_selector import DialogSelectorDialog
+from gui.progress import ProgressMonitor
 from gui.styles import FOLDER_LBL_STYLE_PICK, FOLDER_LBL_STYLE_ERR, ICON, FOLDER_ICON, APP_STYLE, BTN_STYLE
-from gui.worker import ConversationThread, DownloadThread
+from gui.worker import ConversationThread, DownloadThread, PlanThread
 
 logging.basicConfig(
     level=logging.INFO,
@@ -19,6 +20,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Как часто окно при закрытии проверяет, сохранил ли поток загрузки очередь
+CLOSE_POLL_MS = 200
+
 class MediaSaverApp(QWidget):
     def __init__(self):
         super().__init__()
@@ -26,10 +30,17 @@ class MediaSaverApp(QWidget):
         self.setStyleSheet(APP_STYLE)
         self.dialogs = []
         self.selected_dialogs = []
+        self.media_filter = None
+        self.include_forwarded = True
+        self.shards = False
         self.save_path = ""
         self.conversation_thread = None
+        self.dialog_selector = None
+        self.selector_shown = False
+        self.plan_thread = None
         self.download_thread = None
         self.download_complete = False
+        self.closing = False
 
     def initUI(self):
         self.setWindowTitle('VK Media Downloader')
@@ -61,6 +72,15 @@ class MediaSaverApp(QWidget):
         self.progress.setRange(0, 100)
         self.progress.setTextVisible(False)
 
+        self.progress_label = QLabel('')
+        self.progress_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.progress_monitor = ProgressMonitor(self.progress, self.progress_label, self)
+
+        # Во время загрузки: поднять диалог в начало очереди
+        self.priority_combo = QComboBox()
+        self.btn_priority = QPushButton('Скачать первым')
+        self.btn_priority.clicked.connect(self.prioritize_dialog)
+
         self.btn_choose_dialog = QPushButton('Выбрать диалог')
         self.btn_choose_dialog.clicked.connect(self.show_dialog_selector)
         self.btn_choose_dialog.setStyleSheet(BTN_STYLE)
@@ -80,8 +100,23 @@ class MediaSaverApp(QWidget):
         main_layout.addLayout(simple_builder)
         main_layout.addStretch(1)
         main_layout.addWidget(self.progress)
+        main_layout.addWidget(self.progress_label)
+        priority_row = QHBoxLayout()
+        priority_row.addWidget(self.priority_combo, stretch=2)
+        priority_row.addWidget(self.btn_priority, stretch=1)
+        main_layout.addLayout(priority_row)
+        self._show_priority(False)
         self.setLayout(main_layout)
 
+    def _show_priority(self, visible):
+        self.priority_combo.setVisible(visible)
+        self.btn_priority.setVisible(visible)
+
+    def prioritize_dialog(self):
+        peer_id = self.priority_combo.currentData()
+        if self.download_thread is not None and peer_id is not None:
+            self.download_thread.prioritize(peer_id)
+
     def open_instruction(self):
         webbrowser.open_new('https://github.com/homostultus39/vk-media-saver')
 
@@ -103,34 +138,93 @@ class MediaSaverApp(QWidget):
             self.show_error('Сначала введите токен и выберите папку!')
             return
 
-        self.progress.setValue(0)
-        self.progress.setVisible(True)
-
+        # Окно выбора открывается один раз на запрос: из кэша или по готовому списку
+        self.selector_shown = False
         self.conversation_thread = ConversationThread(token)
-        self.conversation_thread.progress_updated.connect(self._update_progress)
+        if not self._download_active():
+            self.progress.setVisible(True)
+            self.progress_monitor.start()
+            self.conversation_thread.progress_updated.connect(self.progress_monitor.set_percent)
+        self.conversation_thread.cached.connect(self._handle_dialogs_cached)
         self.conversation_thread.finished.connect(self._handle_dialogs_loaded)
         self.conversation_thread.error_occurred.connect(self._handle_dialogs_error)
         self.conversation_thread.start()
 
-    def _update_progress(self, value):
-        current_value = self.progress.value()
-        step = 1 if value > current_value else -1
-
-        while current_value != value:
-            current_value += step
-            self.progress.setValue(current_value)
-            QApplication.processEvents()
-            time.sleep(0.005)
+    def _handle_dialogs_cached(self, labels):
+        # Окно открывается сразу из кэша, свежий список придёт в _handle_dialogs_loaded
+        if self.selector_shown:
+            return
+        self._open_dialog_selector(labels, refreshing=True)
 
     def _handle_dialogs_loaded(self, labels):
-        self.progress.setValue(0)
+        if not self._download_active():
+            self.progress_monitor.stop()
+            self.progress_monitor.reset()
+
+        if self.dialog_selector is not None:
+            self.dialog_selector.update_dialogs(labels)
+            return
+        if self.selector_shown:
+            # Окно из кэша уже закрыто: кэш обновлён потоком, второй раз не открываем
+            return
+        self._open_dialog_selector(labels)
+
+    def _download_active(self):
+        return self.download_thread is not None and self.download_thread.isRunning()
 
-        dialog = DialogSelectorDialog(labels, self)
-        if dialog.exec() == QDialog.DialogCode.Accepted:
-            self.selected_dialogs = dialog.get_selected_labels()
+    def _open_dialog_selector(self, labels, refreshing=False):
+        self.selector_shown = True
+        self.dialog_selector = DialogSelectorDialog(labels, self, refreshing=refreshing)
+        self.dialog_selector.estimate_requested.connect(self._estimate_download)
+        try:
+            accepted = self.dialog_selector.exec() == QDialog.DialogCode.Accepted
+            selected = self.dialog_selector.get_selected_labels()
+            self.media_filter = self.dialog_selector.get_media_filter()
+            self.include_forwarded = self.dialog_selector.include_forwarded()
+            self.shards = self.dialog_selector.use_shards()
+        finally:
+            self.dialog_selector = None
+            if self.plan_thread is not None:
+                self.plan_thread.stop()
+
+        if accepted:
+            self.selected_dialogs = selected
             self.start_download()
 
+    def _estimate_download(self, dialogs, media_filter, include_forwarded):
+        self.plan_thread = PlanThread(
+            token=self.token_input.text(),
+            dialogs=dialogs,
+            save_path=self.save_path,
+            include_forwarded=include_forwarded,
+            media_filter=media_filter
+        )
+        self.plan_thread.finished.connect(self._handle_plan_ready)
+        self.plan_thread.error_occurred.connect(self._handle_plan_error)
+        self.plan_thread.start()
+
+    def _handle_plan_ready(self, plan):
+        self.plan_thread = None
+        if self.dialog_selector is not None:
+            self.dialog_selector.show_estimate(plan)
+
+    def _handle_plan_error(self, error_msg):
+        self.plan_thread = None
+        if self.dialog_selector is not None:
+            self.dialog_selector.show_estimate_error(error_msg)
+
     def _handle_dialogs_error(self, error_msg):
+        if not self._download_active():
+            self.progress_monitor.stop()
+        if self.selector_shown:
+            # Список из кэша уже показан — ошибка обновления не повод его закрывать
+            logger.error(f"Не удалось обновить список диалогов: {error_msg}")
+            if self.dialog_selector is not None:
+                self.dialog_selector.finish_refresh()
+            return
+        if self._download_active():
+            self.show_error(error_msg)
+            return
         self.progress.setVisible(False)
         self.show_error(error_msg)
 
@@ -141,12 +235,12 @@ class MediaSaverApp(QWidget):
 
         try:
             self.download_complete = False
-            self.progress.setValue(0)
 
             if self.download_thread:
                 try:
                     self.download_thread.finished.disconnect()
                     self.download_thread.progress_updated.disconnect()
+                    self.download_thread.stats_updated.disconnect()
                     self.download_thread.error_occurred.disconnect()
                 except TypeError:
                     pass
@@ -154,27 +248,39 @@ class MediaSaverApp(QWidget):
             self.download_thread = DownloadThread(
                 token=self.token_input.text(),
                 dialogs=self.selected_dialogs,
-                save_path=self.save_path
+                save_path=self.save_path,
+                include_forwarded=self.include_forwarded,
+                media_filter=self.media_filter,
+                shards=self.shards
             )
 
-            self.download_thread.progress_updated.connect(self._update_progress)
+            self.download_thread.progress_updated.connect(self.progress_monitor.set_percent)
+            self.download_thread.stats_updated.connect(self.progress_monitor.set_stats)
             self.download_thread.finished.connect(self._handle_download_finished)
             self.download_thread.error_occurred.connect(self._handle_download_error)
 
+            self.priority_combo.clear()
+            for dialog in self.selected_dialogs:
+                self.priority_combo.addItem(dialog['title'], dialog['peer_id'])
+            self._show_priority(len(self.selected_dialogs) > 1)
+
+            self.progress_monitor.start()
             self.download_thread.start()
 
         except Exception as e:
             self.show_error(f"Ошибка запуска загрузки: {str(e)}")
 
     def _handle_download_finished(self):
+        self._show_priority(False)
         if not self.download_complete:
             self.download_complete = True
-            self.progress.setValue(100)
+            self.progress_monitor.stop(percent=100)
             self.show_success('Загрузка завершена!')
 
             try:
                 self.download_thread.finished.disconnect()
                 self.download_thread.progress_updated.disconnect()
+                self.download_thread.stats_updated.disconnect()
                 self.download_thread.error_occurred.disconnect()
             except Exception as e:
                 logger.error(f"Ошибка отключения сигналов: {str(e)}")
@@ -182,23 +288,31 @@ class MediaSaverApp(QWidget):
             self.download_thread = None
 
     def _handle_download_error(self, error_msg):
+        self._show_priority(False)
+        self.progress_monitor.stop()
         self.progress.setVisible(False)
         self.show_error(error_msg)
 
     def closeEvent(self, event):
-        threads = []
+        if self._download_active():
+            # Не докачанная очередь сохранится в манифест, следующий запуск продолжит её.
+            # Окно закрывается только когда поток вышел из run(), то есть очередь уже записана
+            if not self.closing:
+                self.closing = True
+                self.download_thread.stop()
+                self._show_priority(False)
+                self.progress_monitor.stop()
+                self.progress_label.setText('Сохранение очереди…')
+                self.setEnabled(False)
+            event.ignore()
+            QTimer.singleShot(CLOSE_POLL_MS, self.close)
+            return
 
         if isinstance(self.conversation_thread, QThread):
-            threads.append(self.conversation_thread)
-
-        if isinstance(self.download_thread, QThread):
-            threads.append(self.download_thread)
-
-        for thread in threads:
             try:
-                if thread.isRunning():
-                    thread.quit()
-                    thread.wait(2000)
+                if self.conversation_thread.isRunning():
+                    self.conversation_thread.quit()
+                    self.conversation_thread.wait(2000)
             except Exception as e:
                 logger.error(f"Ошибка остановки потока: {str(e)}")
 
@@ -224,6 +338,8 @@ class MediaSaverApp(QWidget):
 
 
 if __name__ == '__main__':
+    # Пул процессов пост-обработки в собранном PyInstaller exe
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     window = MediaSaverApp()
     window.show()
@@ -0,0 +1,485 @@
+import logging
+import os
+import time
+
+from scripts.dedup import DedupIndex
+from scripts.disk_space import DiskSpaceGuard, MIN_FREE_BYTES, free_bytes
+from scripts.download_engine import DownloadEngine, DEFAULT_WORKERS
+from scripts.download_queue import video_slots_for
+from scripts.manifest import SyncManifest
+from scripts.media_filter import MediaFilter
+from scripts.metrics import metrics
+from scripts.parse_vk_dialogs import AppSaver
+from scripts.pipeline import InterleavedStreams, DEFAULT_CONCURRENCY
+from scripts.planner import DownloadPlanner
+from scripts.postprocess import PostProcessor
+from scripts.retry import reset_breakers
+from scripts.shards import DEFAULT_SHARD_SIZE, ShardIndex, ShardWriter
+from scripts.vk_scheduler import API_URL, USER_TOKEN_RPS
+
+logger = logging.getLogger(__name__)
+
+# Отчёты прогонов (scripts.metrics) — рядом с манифестом в папке сохранения
+REPORTS_DIR = '.vk_media_reports'
+
+
+def sanitize_folder_name(name):
+    invalid_chars = ['<', '>', ':', '"', '/', '\\', '|', '?', '*']
+    for char in invalid_chars:
+        name = name.replace(char, '_')
+    return name.strip()
+
+
+class Archiver:
+    """
+    Скачивание выбранных диалогов без привязки к Qt: его запускают и
+    DownloadThread, и консольный cli.py. О ходе работы сообщает через колбэки.
+    prioritize() поднимает диалог вперёд прямо во время загрузки; очередь,
+    не докачанная к stop(), сохраняется в манифест и продолжается следующим run().
+    """
+
+    def __init__(self, token, dialogs, save_path, include_forwarded=True, workers=DEFAULT_WORKERS,
+                 incremental=False, dedup=True, dedup_by_hash=False,
+                 on_progress=None, on_stats=None, on_postprocess=None,
+                 api_url=API_URL, rps=USER_TOKEN_RPS, report=True,
+                 dialog_concurrency=DEFAULT_CONCURRENCY, retry_failed=False, media_filter=None,
+                 min_free_space=MIN_FREE_BYTES, shards=False, shard_size=DEFAULT_SHARD_SIZE):
+        self.token = token
+        self.api_url = api_url
+        self.rps = rps
+        self.dialogs = dialogs
+        self.save_path = save_path
+        self.include_forwarded = include_forwarded
+        self.workers = workers
+        self.dialog_concurrency = dialog_concurrency
+        self.incremental = incremental
+        self.media_filter = media_filter or MediaFilter()
+        self.dedup = dedup
+        self.dedup_by_hash = dedup_by_hash
+        # Вместо обхода диалогов — повтор неудачных загрузок из манифеста
+        self.retry_failed = retry_failed
+        self.report = report
+        self.report_path = None
+        # Запас свободного места, ниже которого загрузка встаёт на паузу; 0 — не следить
+        self.min_free_space = min_free_space
+        self.space_guard = None
+        # Вместо отдельных файлов — tar-шарды с индексом (scripts.shards)
+        self.shards = shards
+        self.shard_size = shard_size
+        self.shard_index = None
+        self.shard_writer = None
+
+        self.on_progress = on_progress
+        self.on_stats = on_stats
+        self.on_postprocess = on_postprocess
+
+        self.engine = None
+        self.postprocessor = None
+        self.manifest = None
+        self.dialogs_done = 0
+        self.failed_remaining = 0
+        self._is_running = True
+        # peer_id -> приоритет; больше — раньше, последний поднятый диалог — первый
+        self.priorities = {}
+        self._streams = None
+
+    @property
+    def is_running(self):
+        return self._is_running
+
+    def run(self):
+        metrics.reset()
+        reset_breakers()
+        downloader = AppSaver(token=self.token, api_url=self.api_url, rps=self.rps,
+                              media_filter=self.media_filter)
+        self.postprocessor = PostProcessor(on_progress=self.on_postprocess)
+        self.manifest = SyncManifest(self.save_path)
+        self._open_shards()
+        # В шардах дубликаты и так хранятся один раз (по id и по sha256)
+        dedup_index = DedupIndex(self.save_path, hash_content=self.dedup_by_hash) \
+            if self.dedup and not self.shards else None
+        self.space_guard = self._space_guard()
+        self.engine = DownloadEngine(
+            downloader,
+            workers=self.workers,
+            postprocessor=self.postprocessor,
+            dedup=dedup_index,
+            space_guard=self.space_guard,
+            video_slots=video_slots_for(self.workers, self.media_filter.types)
+        )
+        for peer_id, priority in list(self.priorities.items()):
+            self.engine.set_priority(peer_id, priority)
+        if not self._is_running:
+            self.engine.cancel()
+
+        try:
+            with self.engine:
+                if self.retry_failed:
+                    self._run_failed(downloader)
+                else:
+                    self._run_dialogs(downloader)
+        finally:
+            self.postprocessor.close(cancel=not self._is_running)
+            self._close_shards()
+            if dedup_index is not None:
+                dedup_index.close()
+            self.failed_remaining = self.manifest.failed_count()
+            self.manifest.close()
+
+        if self.failed_remaining:
+            logger.warning(f"Не скачано файлов: {self.failed_remaining}, "
+                           f"их можно повторить без обхода диалогов (--retry-failed)")
+
+        stats = self.stats()
+        if self.report:
+            self._write_report(stats)
+        return stats
+
+    def stats(self):
+        """Статистика движка плюс сколько диалогов уже перечислено — для оценки остатка"""
+        stats = self.engine.stats()
+        self._add_run_stats(stats)
+        return stats
+
+    def _add_run_stats(self, stats):
+        stats['dialogs_done'] = self.dialogs_done
+        stats['dialogs_total'] = len(self.dialogs)
+        stats['failed_remaining'] = self.failed_remaining
+        if self.space_guard is not None:
+            stats['low_space'] = self.space_guard.paused
+            stats['free_bytes'] = self.space_guard.free
+        if self.shard_writer is not None:
+            stats['shards'] = self.shard_writer.stats()
+
+    def _open_shards(self):
+        if self.shards:
+            self.shard_index = ShardIndex(self.save_path)
+            self.shard_writer = ShardWriter(self.shard_index, shard_size=self.shard_size)
+            self._pack_staged()
+
+    def _pack_staged(self):
+        """
+        Файлы, скачанные прошлым запуском, но не упакованные: stop() снимает
+        колбэки упаковки, _pack мог упасть. Диалог уже отмечен скачанным (или
+        перечисленным), так что заново их не скачают — упаковываем до загрузок,
+        пока в staging никто не пишет. Данные записи — из манифеста по пути.
+        """
+        packed = 0
+        for root, _, files in os.walk(self.shard_index.staging_path):
+            for name in files:
+                path = os.path.join(root, name)
+                row = self.manifest.downloaded_at(path)
+                if row is None:
+                    # Недокачанный файл: его продолжит или перезапишет загрузка
+                    continue
+                peer_id, item_id, message_id = row
+                item = {
+                    'id': item_id,
+                    'type': 'photo' if name.lower().endswith(('.jpg', '.jpeg')) else 'video',
+                    'message_id': message_id,
+                    # mtime проставлен датой сообщения при пост-обработке
+                    'date': int(os.path.getmtime(path)),
+                }
+                packed += self.shard_writer.pack(path, peer_id, item)
+        if packed:
+            logger.info(f"Упаковано файлов, оставшихся с прошлого запуска: {packed}")
+
+    def _close_shards(self):
+        # После postprocessor.close: все колбэки when_done уже поставили файлы в очередь
+        if self.shard_writer is not None:
+            self.shard_writer.close()
+            self.shard_index.close()
+
+    def _dialog_folder(self, title):
+        base = self.shard_index.staging_path if self.shard_index is not None else self.save_path
+        folder = os.path.join(base, sanitize_folder_name(title))
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def _already_stored(self, peer_id, item, path):
+        if self.shard_index is None:
+            return self.incremental and self.manifest.is_downloaded(peer_id, item['id'], path)
+
+        if self.shard_index.has_entry(peer_id, item['id']):
+            return True
+        if self.shard_index.has_object(item['id']):
+            # Байты уже в шарде из другого диалога — качать нечего, только запись индекса
+            self.shard_index.add_entry(peer_id, item)
+            self.manifest.mark_downloaded(peer_id, item['id'], path, item.get('message_id'))
+            return True
+        return False
+
+    def plan(self, sample_limit=None, on_progress=None):
+        """
+        Оценка объёма без загрузки (scripts.planner) с теми же фильтрами и
+        курсором --incremental, плюс сравнение со свободным местом
+        """
+        saver = AppSaver(token=self.token, api_url=self.api_url, rps=self.rps,
+                         media_filter=self.media_filter)
+        manifest = SyncManifest(self.save_path) if self.incremental else None
+        try:
+            planner = DownloadPlanner(
+                saver,
+                include_forwarded=self.include_forwarded,
+                manifest=manifest,
+                sample_limit=sample_limit,
+                is_running=lambda: self._is_running,
+                on_progress=on_progress
+            )
+            plan = planner.plan(self.dialogs)
+        finally:
+            if manifest is not None:
+                manifest.close()
+
+        plan['free_bytes'] = free_bytes(self.save_path)
+        plan['min_free_bytes'] = self.min_free_space
+        plan['fits'] = plan['free_bytes'] - self.min_free_space >= plan['bytes']
+        return plan
+
+    def _space_guard(self):
+        if not self.min_free_space:
+            return None
+        return DiskSpaceGuard(self.save_path, self.min_free_space, on_pause=self._space_paused)
+
+    def _space_paused(self, paused, free):
+        # Пауза без новых файлов — не будет и on_stats от загрузок, поэтому сообщаем сразу
+        if self.on_stats:
+            self.on_stats(self.stats())
+
+    def stop(self):
+        self._is_running = False
+        if self.engine is not None:
+            self.engine.cancel()
+
+    def prioritize(self, peer_id):
+        """Файлы диалога — раньше остальных, его перечисление — сразу, не дожидаясь очереди"""
+        priority = max(self.priorities.values(), default=0) + 1
+        self.priorities[peer_id] = priority
+        logger.info(f"Диалог {peer_id} поднят в начало очереди")
+        if self.engine is not None:
+            self.engine.set_priority(peer_id, priority)
+        self._promote(peer_id)
+
+    def _promote(self, peer_id):
+        if self._streams is not None:
+            self._streams.promote(peer_id)
+
+    def _ordered_dialogs(self):
+        # Поднятые до запуска диалоги перечисляются первыми
+        return sorted(self.dialogs, key=lambda d: -self.priorities.get(d['peer_id'], 0))
+
+    def _take_queue(self):
+        """
+        Очередь, сохранённая при остановке прошлого запуска: файлы в прежнем
+        порядке и {peer_id: newest} диалогов, перечисленных тогда целиком
+        """
+        items, enumerated = self.manifest.take_queue(d['peer_id'] for d in self.dialogs)
+        media_filter = self.media_filter
+        items = [item for item in items if item['type'] in media_filter.types
+                 and not media_filter.is_too_old(item['date']) and not media_filter.is_too_new(item['date'])]
+        for item in items:
+            item['id'] = item.pop('item_id')
+        self._restore_folders(items)
+        if items or enumerated:
+            logger.info(f"Продолжение очереди прошлого запуска: файлов {len(items)}, "
+                        f"диалогов без повторного перечисления: {len(enumerated)}")
+        return items, enumerated
+
+    @staticmethod
+    def _restore_folders(items):
+        # Папку без файлов удаляют (ShardWriter.close, сам пользователь), а
+        # сохранённые и неудачные качаются по старым путям без перечисления диалога
+        for folder in {os.path.dirname(item['path']) for item in items}:
+            os.makedirs(folder, exist_ok=True)
+
+    def _save_queue(self, pending, sync_state):
+        # Перечисленные при фильтре типов или дат диалоги следующий полный прогон должен пройти заново
+        enumerated = {} if self.media_filter.narrows_history else {
+            peer_id: state['newest'] for peer_id, state in sync_state.items()
+            if state.get('enumerated') and not state['failed']
+        }
+        if pending or enumerated:
+            self.manifest.save_queue(pending, enumerated)
+            logger.info(f"Очередь сохранена: файлов {len(pending)}, следующий запуск начнёт с них")
+
+    def _write_report(self, stats):
+        path = os.path.join(self.save_path, REPORTS_DIR,
+                            time.strftime('run-%Y%m%d-%H%M%S.json'))
+        try:
+            self.report_path = metrics.write_report(
+                path,
+                stats=stats,
+                dialogs=len(self.dialogs),
+                workers=self.workers,
+                media_filter=self.media_filter.describe(),
+                completed=self._is_running
+            )
+        except OSError as e:
+            logger.error(f"Не удалось записать отчёт о прогоне: {e}")
+
+    def _report_progress(self, value):
+        if self.on_progress:
+            self.on_progress(value)
+
+    def _run_dialogs(self, downloader):
+        # peer_id -> {'newest': максимальный message_id, 'failed': прервано ли перечисление,
+        #             'enumerated': перечислен целиком, 'folder': папка}
+        sync_state = {}
+        resumed, enumerated = self._take_queue()
+        queued = {(item['peer_id'], item['id']) for item in resumed}
+
+        def open_dialog(dialog_data):
+            return downloader.iter_media(
+                dialog_data['peer_id'],
+                include_forwarded=self.include_forwarded,
+                min_message_id=self._open_dialog(dialog_data, sync_state)
+            )
+
+        dialogs = self._dialogs_to_enumerate(enumerated, sync_state)
+        self._refresh_video_urls(downloader, resumed)
+        unsubmitted = []
+        for index, item in enumerate(resumed):
+            if self._skip_resumed(item):
+                continue
+            if not self._is_running or not self._submit(item['peer_id'], item, item['path'], cost=0):
+                unsubmitted = [(i['peer_id'], i, i['path']) for i in resumed[index:]]
+                break
+
+        media = self._streams = InterleavedStreams(
+            ((d['peer_id'], lambda d=d: open_dialog(d)) for d in dialogs),
+            concurrency=self.dialog_concurrency,
+            is_running=lambda: self._is_running,
+            on_finished=lambda peer_id, error: self._dialog_enumerated(peer_id, error, sync_state)
+        )
+
+        for peer_id, item in media:
+            if not self._is_running:
+                break
+            metrics.gauge('queue.media', media.qsize)
+            path = self._media_path(peer_id, item, sync_state, queued)
+            if path is not None:
+                self._submit(peer_id, item, path)
+
+        self._streams = None
+        self.engine.wait()
+        self._finish_dialogs(sync_state, self.engine.pending() + unsubmitted)
+
+    # Общие шаги обхода диалогов для обоих движков; работают с диском и SQLite,
+    # асинхронный движок зовёт их через asyncio.to_thread
+
+    def _dialogs_to_enumerate(self, enumerated, sync_state):
+        dialogs = []
+        for dialog_data in self._ordered_dialogs():
+            peer_id = dialog_data['peer_id']
+            if peer_id in enumerated:
+                # Всё найденное тогда уже в resumed или скачано — историю не листаем
+                sync_state[peer_id] = {'newest': enumerated[peer_id], 'failed': False, 'enumerated': True}
+                self.dialogs_done += 1
+            else:
+                dialogs.append(dialog_data)
+        return dialogs
+
+    def _open_dialog(self, dialog_data, sync_state):
+        """Папка и состояние диалога перед перечислением; возвращает курсор --incremental"""
+        peer_id = dialog_data['peer_id']
+        min_message_id = self.manifest.last_message_id(peer_id) if self.incremental else None
+        folder = self._dialog_folder(dialog_data['title'])
+        sync_state[peer_id] = {'newest': min_message_id or 0, 'failed': False, 'folder': folder}
+        return min_message_id
+
+    def _media_path(self, peer_id, item, sync_state, queued):
+        """Куда качать найденный аттач; None — не нужно"""
+        state = sync_state[peer_id]
+        state['newest'] = max(state['newest'], item.get('message_id') or 0)
+        if not AppSaver.has_direct_url(item['url']):
+            # Недоступное видео не должно навсегда блокировать курсор диалога
+            return None
+
+        filename = f"{item['id']}.{'jpg' if item['type'] == 'photo' else 'mp4'}"
+        path = os.path.join(state['folder'], filename)
+        if (peer_id, item['id']) in queued or self._already_stored(peer_id, item, path):
+            return None
+        return path
+
+    def _skip_resumed(self, item):
+        return not AppSaver.has_direct_url(item['url']) or self._already_stored(item['peer_id'], item, item['path'])
+
+    def _finish_dialogs(self, sync_state, pending):
+        if self._is_running:
+            self._advance_cursors(sync_state)
+            self._report_progress(100)
+        else:
+            self._save_queue(pending, sync_state)
+
+    def _submit(self, peer_id, item, path, cost=None):
+        return self.engine.submit(
+            item['url'], path, item['date'],
+            on_done=lambda ok: self._item_done(ok, peer_id, item, path),
+            media_id=item['id'],
+            peer_id=peer_id,
+            item=item,
+            cost=cost
+        )
+
+    @staticmethod
+    def _refresh_video_urls(downloader, items):
+        # Прямые ссылки на видео живут недолго — берём свежие одним пакетом
+        downloader.api.run(downloader.video_resolver.refresh_steps(items))
+
+    def _advance_cursors(self, sync_state):
+        # Курсор диалога двигаем только если он перечислен целиком без ошибок,
+        # иначе следующий запуск не доберёт пропущенное. По той же причине
+        # его не трогает частичный прогон (только фото, диапазон дат)
+        if self.media_filter.narrows_history:
+            logger.info(f"Фильтр ({self.media_filter.describe()}): курсоры синхронизации не сдвигаются")
+            return
+        for peer_id, state in sync_state.items():
+            if state['newest'] and not state['failed']:
+                self.manifest.set_last_message_id(peer_id, state['newest'])
+
+    def _run_failed(self, downloader):
+        items = self._take_failed()
+        self._refresh_video_urls(downloader, items)
+        for item in items:
+            if not self._is_running:
+                break
+            if downloader.has_direct_url(item['url']):
+                self._submit(item['peer_id'], item, item['path'])
+
+        self.engine.wait()
+        if self._is_running:
+            self._report_progress(100)
+
+    def _take_failed(self):
+        items = self.manifest.failed_items()
+        logger.info(f"Повтор неудачных загрузок: {len(items)}")
+        for item in items:
+            item['id'] = item.pop('item_id')
+        self._restore_folders(items)
+        return items
+
+    def _dialog_enumerated(self, peer_id, error, sync_state):
+        if error is not None:
+            # Ошибка одного диалога не останавливает остальные; курсор его не двигаем
+            logger.error(f"Перечисление диалога {peer_id} прервано: {error}")
+            sync_state[peer_id]['failed'] = True
+        elif self._is_running:
+            # После stop() перечисление обрывается без ошибки — целиком оно не пройдено
+            sync_state[peer_id]['enumerated'] = True
+        self.dialogs_done += 1
+        # 100 — только после того, как докачается очередь
+        self._report_progress(min(int(self.dialogs_done / len(self.dialogs) * 100), 99))
+
+    def _item_done(self, ok, peer_id, item, path):
+        if ok:
+            self.manifest.mark_downloaded(peer_id, item['id'], path, item.get('message_id'))
+            if self.shard_writer is not None:
+                # В шард — после тегов и mtime, иначе упакуется необработанный файл
+                self.postprocessor.when_done(path, lambda: self.shard_writer.add(path, peer_id, item))
+        elif self._is_running:
+            # Неудачный файл уходит в failed_items и курсор диалога не держит:
+            # повтор (--retry-failed) обходится без перечисления истории.
+            # Отменённое неудачей не считается — его доберёт следующий запуск
+            self.manifest.mark_failed(peer_id, item, path)
+        if self.on_stats:
+            self.on_stats(self.stats())
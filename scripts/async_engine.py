@@ -0,0 +1,594 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+try:
+    import aiohttp
+except ImportError:
+    # Необязательная зависимость: без неё работает только потоковый Archiver
+    aiohttp = None
+
+from scripts.archiver import Archiver
+from scripts.dedup import DedupIndex
+from scripts.download_engine import TransferStats, log_totals
+from scripts.download_queue import DownloadQueue, item_cost, lane_of, video_slots_for
+from scripts.manifest import SyncManifest
+from scripts.metrics import metrics
+from scripts.parse_vk_dialogs import (AppSaver, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_RETRIES, DOWNLOAD_TIMEOUT,
+                                      ResumableDownload, expected_size, is_photo_path, save_photo)
+from scripts.postprocess import PostProcessor
+from scripts.retry import (DownloadRetry, IncompleteDownloadError, RetryableHTTPError, check_status,
+                           reset_breakers)
+from scripts.vk_scheduler import (API_URL, API_VERSION, STEP_ITEM, STEP_SLEEP, USER_TOKEN_RPS, RequestCancelled,
+                                  VkRequestPolicy, advance)
+
+logger = logging.getLogger(__name__)
+
+ENGINE_THREADS = 'threads'
+ENGINE_ASYNCIO = 'asyncio'
+ENGINES = (ENGINE_THREADS, ENGINE_ASYNCIO)
+
+# Одновременных загрузок в одном потоке: мелкие фото упираются в задержку
+# CDN, а не в CPU, поэтому их держат «в полёте» сотнями
+ASYNC_WORKERS = 64
+ASYNC_QUEUE_SIZE = 1000
+QUEUE_POLL_INTERVAL = 0.2
+# Видео пишутся на диск из пула потоков пачками такого размера, а не каждым чанком
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+if aiohttp is not None:
+    TRANSIENT_ERRORS = (
+        RetryableHTTPError,
+        IncompleteDownloadError,
+        aiohttp.ClientConnectionError,
+        aiohttp.ClientPayloadError,
+        asyncio.TimeoutError,
+    )
+
+
+def require_aiohttp():
+    if aiohttp is None:
+        raise RuntimeError("Для асинхронного движка нужен пакет aiohttp: pip install aiohttp")
+
+
+def check_response(response):
+    """scripts.retry.check_response для ответа aiohttp"""
+    check_status(response.status, str(response.url), response.headers)
+    response.raise_for_status()
+
+
+async def wait_event(event, delay):
+    """Пауза на delay секунд, которую прерывает event: True — событие взведено"""
+    try:
+        await asyncio.wait_for(event.wait(), delay)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+def create_archiver(*args, engine=ENGINE_THREADS, **kwargs):
+    """Archiver выбранного движка; workers=None — значение по умолчанию движка"""
+    if kwargs.get('workers') is None:
+        kwargs.pop('workers', None)
+    if engine == ENGINE_ASYNCIO:
+        require_aiohttp()
+        return AsyncArchiver(*args, **kwargs)
+    return Archiver(*args, **kwargs)
+
+
+class AsyncVkApi(VkRequestPolicy):
+    """
+    Транспорт VkRequestPolicy на aiohttp: тот же token bucket на токен, те же
+    execute-пачки и повторы, но паузы и запросы идут в event loop. Паузы
+    прерывает stop_event — тогда запрос бросает RequestCancelled.
+    """
+
+    def __init__(self, session, token, rps=USER_TOKEN_RPS, api_url=API_URL, api_version=API_VERSION,
+                 stop_event=None):
+        super().__init__(token, rps=rps, api_url=api_url, api_version=api_version)
+        self.transient_errors = TRANSIENT_ERRORS
+        self.session = session
+        self.stop_event = stop_event
+
+    async def call(self, method, **params):
+        return await self.run(self.call_steps(method, params))
+
+    async def execute(self, code):
+        return await self.run(self.execute_steps(code))
+
+    async def batch(self, calls, raise_errors=True):
+        return await self.run(self.batch_steps(calls, raise_errors))
+
+    async def run(self, steps):
+        """Выполняет шаги и возвращает их результат"""
+        reply = error = None
+        while True:
+            try:
+                step = advance(steps, reply, error)
+            except StopIteration as stop:
+                return stop.value
+            reply, error = await self._perform(step)
+
+    async def iterate(self, steps):
+        """Выполняет шаги, найденные аттачи (STEP_ITEM) отдаёт по одному"""
+        reply = error = None
+        while True:
+            try:
+                step = advance(steps, reply, error)
+            except StopIteration:
+                return
+            if step[0] == STEP_ITEM:
+                reply = error = None
+                yield step[1]
+            else:
+                reply, error = await self._perform(step)
+
+    async def _perform(self, step):
+        try:
+            if step[0] == STEP_SLEEP:
+                await self._sleep(step[1])
+                return None, None
+            return await self._post(step[1], step[2]), None
+        except Exception as e:
+            return None, e
+
+    async def _sleep(self, delay):
+        if self.stop_event is None:
+            await asyncio.sleep(delay)
+        elif await wait_event(self.stop_event, delay):
+            raise RequestCancelled()
+
+    async def _post(self, method, values):
+        started = time.monotonic()
+        try:
+            async with self.session.post(self.api_url + method, data=values) as response:
+                check_response(response)
+                return await response.json(content_type=None)
+        finally:
+            metrics.observe('api.latency', time.monotonic() - started, method=method)
+
+
+class AsyncArchiver(Archiver):
+    """
+    Archiver на одном event loop: перечисление истории, получение ссылок на
+    видео и потоковые загрузки идут корутинами через общий пул соединений
+    aiohttp. Снаружи — тот же интерфейс (run / stop / stats и колбэки), так
+    что DownloadThread и cli.py выбирают движок параметром.
+    Разбор аттачей, yt-dlp (в отдельном пуле потоков) и пост-обработка — общие с
+    потоковым движком.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('workers', ASYNC_WORKERS)
+        super().__init__(*args, **kwargs)
+        self.cancel_event = threading.Event()
+        self.saver = None
+        self.api = None
+        self.session = None
+        self.dedup_index = None
+        # media_id -> asyncio.Event: этот объект уже качает другая корутина
+        self._dedup_waits = {}
+        self._ytdlp_pool = None
+        self.queue = None
+        self.counters = TransferStats()
+        self._in_flight = 0
+        self._loop = None
+        # asyncio-двойник cancel_event: его ждут паузы в loop, взводит stop()
+        self._stopped = None
+        self._queue_changed = None
+        # Прерванные отменой загрузки — в начало сохранённой очереди
+        self._interrupted = []
+        # Ещё не начатые диалоги и состояние перечисления — для prioritize() на ходу
+        self._pending_dialogs = None
+        self._sync_state = None
+        self._queued = set()
+        self._enumerators = set()
+
+    def run(self):
+        require_aiohttp()
+        return asyncio.run(self._main())
+
+    def stop(self):
+        self._is_running = False
+        self.cancel_event.set()
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._set_stopped)
+            except RuntimeError:
+                pass
+
+    def _set_stopped(self):
+        self._stopped.set()
+        if self._queue_changed is not None:
+            self._queue_changed.set()
+
+    async def _wait_cancelled(self, delay):
+        """Пауза, которую прерывает stop(): True — остановлено"""
+        return await wait_event(self._stopped, delay) or self.cancel_event.is_set()
+
+    def stats(self):
+        queued = len(self.queue) if self.queue is not None else 0
+        stats = self.counters.snapshot(self._in_flight + queued, self.queue, self.dedup_index, self.postprocessor)
+        self._add_run_stats(stats)
+        return stats
+
+    async def _main(self):
+        metrics.reset()
+        reset_breakers()
+        self.counters = TransferStats()
+        self._stopped = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        if not self._is_running:
+            self.cancel_event.set()
+            self._stopped.set()
+
+        # От AppSaver — шаги перечисления и кэш ссылок на видео (запросы выполняет
+        # AsyncVkApi), разбор аттачей и yt-dlp
+        self.saver = AppSaver(token=self.token, api_url=self.api_url, rps=self.rps,
+                              media_filter=self.media_filter)
+        self.postprocessor = PostProcessor(on_progress=self.on_postprocess)
+        self.manifest = SyncManifest(self.save_path)
+        self._open_shards()
+        if self.dedup and not self.shards:
+            self.dedup_index = DedupIndex(self.save_path, hash_content=self.dedup_by_hash)
+        self.space_guard = self._space_guard()
+        # yt-dlp держит поток минутами: у него свой пул размером с полосу видео,
+        # пул по умолчанию остаётся коротким операциям с файлами и SQLite
+        self._ytdlp_pool = ThreadPoolExecutor(max_workers=video_slots_for(self.workers, self.media_filter.types),
+                                              thread_name_prefix='ytdlp')
+
+        connector = aiohttp.TCPConnector(limit=self.workers, limit_per_host=self.workers)
+        timeout = aiohttp.ClientTimeout(sock_connect=DOWNLOAD_TIMEOUT, sock_read=DOWNLOAD_TIMEOUT)
+        try:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                self.session = session
+                self.api = AsyncVkApi(session, self.token, rps=self.rps, api_url=self.api_url,
+                                      stop_event=self._stopped)
+                if self.retry_failed:
+                    await self._run_failed_async()
+                else:
+                    await self._run_dialogs_async()
+        finally:
+            self._loop = None
+            self._ytdlp_pool.shutdown()
+            self.postprocessor.close(cancel=not self._is_running)
+            self._close_shards()
+            if self.dedup_index is not None:
+                self.dedup_index.close()
+            self.failed_remaining = self.manifest.failed_count()
+            self.manifest.close()
+
+        if self.failed_remaining:
+            logger.warning(f"Не скачано файлов: {self.failed_remaining}, "
+                           f"их можно повторить без обхода диалогов (--retry-failed)")
+
+        stats = self.stats()
+        log_totals(stats)
+        if self.report:
+            self._write_report(stats)
+        return stats
+
+    # --- Диалоги ----------------------------------------------------------------
+
+    async def _run_dialogs_async(self):
+        self._open_queue()
+        sync_state = self._sync_state = {}
+        # SQLite манифеста и индексов — в пуле потоков, loop не ждёт диска
+        resumed, enumerated = await asyncio.to_thread(self._take_queue)
+        self._queued = {(item['peer_id'], item['id']) for item in resumed}
+        self._pending_dialogs = deque(self._dialogs_to_enumerate(enumerated, sync_state))
+
+        downloaders = [asyncio.create_task(self._download_worker()) for _ in range(self.workers)]
+        await self._refresh_video_urls_async(resumed)
+        unsubmitted = []
+        for index, item in enumerate(resumed):
+            if await asyncio.to_thread(self._skip_resumed, item):
+                continue
+            if not await self._put(item['peer_id'], item, item['path'], cost=0):
+                unsubmitted = [(i['peer_id'], i, i['path']) for i in resumed[index:]]
+                break
+
+        for _ in range(self.dialog_concurrency):
+            self._start_enumerator()
+        while self._enumerators:
+            done, _ = await asyncio.wait(list(self._enumerators))
+            for task in done:
+                task.result()
+        self._pending_dialogs = None
+
+        await self._close_queue(downloaders)
+        await asyncio.to_thread(self._finish_dialogs, sync_state, self._pending() + unsubmitted)
+
+    def _start_enumerator(self, dialog_data=None):
+        task = asyncio.create_task(self._enumerator(dialog_data))
+        self._enumerators.add(task)
+        task.add_done_callback(self._enumerators.discard)
+
+    async def _enumerator(self, dialog_data=None):
+        # Общая очередь диалогов: одновременно перечисляется не больше dialog_concurrency
+        # (плюс поднятые prioritize); поднятый диалог перечисляется отдельной задачей
+        if dialog_data is not None:
+            await self._enumerate(dialog_data)
+            return
+        while self._is_running and self._pending_dialogs:
+            await self._enumerate(self._pending_dialogs.popleft())
+
+    def _promote(self, peer_id):
+        # Из другого потока (GUI, сигнал): приоритет очереди — под её локом, перечисление — в loop
+        if self.queue is not None:
+            self.queue.set_priority(peer_id, self.priorities[peer_id])
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._start_promoted, peer_id)
+            except RuntimeError:
+                pass
+
+    def _start_promoted(self, peer_id):
+        if not self._pending_dialogs:
+            return
+        for dialog_data in self._pending_dialogs:
+            if dialog_data['peer_id'] == peer_id:
+                self._pending_dialogs.remove(dialog_data)
+                self._start_enumerator(dialog_data)
+                return
+
+    async def _enumerate(self, dialog_data):
+        peer_id = dialog_data['peer_id']
+        sync_state = self._sync_state
+        min_message_id = await asyncio.to_thread(self._open_dialog, dialog_data, sync_state)
+        steps = self.saver.media_steps(peer_id, include_forwarded=self.include_forwarded,
+                                       min_message_id=min_message_id)
+
+        error = None
+        try:
+            async for item in self.api.iterate(steps):
+                if not self._is_running:
+                    break
+                path = await asyncio.to_thread(self._media_path, peer_id, item, sync_state, self._queued)
+                if path is not None and not await self._put(peer_id, item, path):
+                    break
+        except RequestCancelled:
+            # Остановка, а не ошибка: диалог просто не перечислен целиком
+            pass
+        except Exception as e:
+            error = e
+        self._dialog_enumerated(peer_id, error, sync_state)
+
+    async def _refresh_video_urls_async(self, items):
+        # Прерванное остановкой обновление оставляет старые ссылки — они уйдут в сохранённую очередь
+        await self.api.run(self.saver.video_resolver.refresh_steps(items))
+
+    # --- Неудачные из манифеста ---------------------------------------------------
+
+    async def _run_failed_async(self):
+        items = await asyncio.to_thread(self._take_failed)
+        await self._refresh_video_urls_async(items)
+
+        self._open_queue()
+        downloaders = [asyncio.create_task(self._download_worker()) for _ in range(self.workers)]
+        for item in items:
+            if not self._is_running:
+                break
+            if self.saver.has_direct_url(item['url']):
+                await self._put(item['peer_id'], item, item['path'])
+        await self._close_queue(downloaders)
+
+        if self._is_running:
+            self._report_progress(100)
+
+    # --- Очередь и загрузка ---------------------------------------------------------
+
+    def _open_queue(self):
+        self.queue = DownloadQueue(video_slots_for(self.workers, self.media_filter.types),
+                                   maxsize=ASYNC_QUEUE_SIZE)
+        for peer_id, priority in list(self.priorities.items()):
+            self.queue.set_priority(peer_id, priority)
+        self._queue_changed = asyncio.Event()
+
+    async def _close_queue(self, downloaders):
+        self.queue.close()
+        self._queue_changed.set()
+        await asyncio.gather(*downloaders)
+
+    def _pending(self):
+        """Не скачанное после отмены: прерванные, затем очередь — (peer_id, item, path)"""
+        pending = self._interrupted + self.queue.drain()
+        self._interrupted = []
+        return pending
+
+    async def _wait_queue(self):
+        # Событие взводят put, pop, task_done и stop(); таймаут — страховка от пропущенного сигнала
+        self._queue_changed.clear()
+        await wait_event(self._queue_changed, QUEUE_POLL_INTERVAL)
+
+    async def _put(self, peer_id, item, path, cost=None):
+        """False — остановлено, пока ждали места в очереди"""
+        while self.queue.full:
+            if not self._is_running:
+                return False
+            await self._wait_queue()
+        self.queue.push((peer_id, item, path), peer_id=peer_id, lane=lane_of(item),
+                        cost=item_cost(item) if cost is None else cost)
+        self.counters.submitted()
+        self._queue_changed.set()
+        metrics.gauge('queue.media', len(self.queue))
+        return True
+
+    async def _next_job(self):
+        while not self.cancel_event.is_set():
+            job = self.queue.pop()
+            if job is not None:
+                self._queue_changed.set()
+                return job
+            if self.queue.closed and not len(self.queue):
+                return None
+            await self._wait_queue()
+        return None
+
+    async def _download_worker(self):
+        while True:
+            job = await self._next_job()
+            if job is None:
+                return
+
+            peer_id, item, path = job
+            ok = False
+            try:
+                if not await self._wait_for_space():
+                    continue
+                # Меняется только в loop, stats() из других потоков лишь читает
+                self._in_flight += 1
+                try:
+                    ok = await self._download(item['url'], path, item['date'], item['id'],
+                                              item.get('video_format'))
+                finally:
+                    self._in_flight -= 1
+                await asyncio.to_thread(self._item_done, ok, peer_id, item, path)
+            finally:
+                self.queue.task_done(lane_of(item))
+                if not ok and self.cancel_event.is_set():
+                    self._interrupted.append(job)
+                self._queue_changed.set()
+
+    async def _wait_for_space(self):
+        if self.space_guard is None:
+            return True
+        while not self.space_guard.check():
+            if await self._wait_cancelled(self.space_guard.interval):
+                return False
+        return True
+
+    async def _download(self, url, path, item_date, media_id, video_format=None):
+        if self.dedup_index is None or media_id is None:
+            ok = await self._fetch(url, path, item_date, video_format)
+            self._postprocess(ok, path, item_date)
+            return ok
+
+        # Ту же загрузку в другой корутине ждём в loop: блокирующий acquire
+        # занял бы поток пула, нужный yt-dlp и самой загрузке
+        while media_id in self._dedup_waits:
+            await self._dedup_waits[media_id].wait()
+        done = self._dedup_waits[media_id] = asyncio.Event()
+        try:
+            # Других владельцев в этом процессе нет — acquire не ждёт, только SQLite
+            existing = await asyncio.to_thread(self.dedup_index.acquire, media_id)
+            if existing:
+                metrics.incr('dedup.linked')
+                return await asyncio.to_thread(self.dedup_index.link, existing, path)
+
+            ok = replaced = False
+            try:
+                ok = await self._fetch(url, path, item_date, video_format)
+            finally:
+                replaced = await asyncio.to_thread(self.dedup_index.release, media_id, path if ok else None)
+            self._postprocess(ok and not replaced, path, item_date)
+            return ok
+        finally:
+            del self._dedup_waits[media_id]
+            done.set()
+
+    def _postprocess(self, ok, path, item_date):
+        # Фото уже с EXIF и mtime (save_photo) — в пул уходят только видео
+        if ok and not is_photo_path(path):
+            self.postprocessor.submit(path, item_date)
+
+    async def _fetch(self, url, path, item_date, video_format=None):
+        try:
+            ok = await self._fetch_with_retries(url, path, item_date, video_format)
+        except Exception as e:
+            metrics.incr('download.errors', host=urlsplit(url).hostname or '')
+            logger.error(f"Ошибка при скачивании {url} -> {path}: {e!r}")
+            ok = False
+        self.counters.finished(ok, self.cancel_event.is_set())
+        return ok
+
+    async def _fetch_with_retries(self, url, path, item_date, video_format=None):
+        for attempt in DownloadRetry(url, DOWNLOAD_RETRIES, TRANSIENT_ERRORS, aiohttp.ClientResponseError):
+            for pause in attempt.breaker_pauses():
+                if await self._wait_cancelled(pause):
+                    return False
+            with attempt:
+                if self.saver.needs_ytdlp(url, path, video_format):
+                    # HLS и внешние ссылки — yt-dlp в своём пуле потоков, loop не блокируется
+                    await asyncio.get_running_loop().run_in_executor(
+                        self._ytdlp_pool, self.saver.download_with_ytdlp, url, path, self.cancel_event)
+                    ok = True
+                elif is_photo_path(path):
+                    ok = await self._download_photo(url, path, item_date)
+                else:
+                    ok = await self._download_resumable(url, path)
+                if ok:
+                    attempt.succeeded()
+                return ok
+            if await self._wait_cancelled(attempt.delay):
+                return False
+
+    async def _download_photo(self, url, path, item_date):
+        buffer = bytearray()
+        started = time.monotonic()
+        async with self.session.get(url) as r:
+            metrics.observe('download.ttfb', time.monotonic() - started, host=r.url.host or '')
+            check_response(r)
+            expected = expected_size(r.status, r.headers)
+            async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                if self.cancel_event.is_set():
+                    return False
+                buffer.extend(chunk)
+                self.counters.count_bytes(len(chunk))
+
+        # Сверка размера, EXIF и запись на диск — в пуле потоков
+        await asyncio.to_thread(save_photo, path, bytes(buffer), item_date, expected)
+        return True
+
+    async def _download_resumable(self, url, path):
+        for attempt in ResumableDownload(url, path):
+            if attempt.delay is not None and await self._wait_cancelled(attempt.delay):
+                return False
+            headers = await asyncio.to_thread(attempt.start)
+            started = time.monotonic()
+            try:
+                async with self.session.get(url, headers=headers) as r:
+                    metrics.observe('download.ttfb', time.monotonic() - started, host=r.url.host or '')
+                    if not attempt.accept(r.status, r.headers):
+                        continue
+                    check_response(r)
+                    if not await self._write_part(r, attempt.part_path, attempt.mode):
+                        return False
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                attempt.interrupted(e)
+                continue
+
+            if await asyncio.to_thread(attempt.finish):
+                return True
+
+    async def _write_part(self, response, part_path, mode):
+        """
+        Тело ответа в .part; на диск пишет пул потоков пачками по WRITE_BUFFER_SIZE.
+        Принятое до обрыва или отмены дописывается — докачка продолжит с него
+        """
+        f = await asyncio.to_thread(open, part_path, mode)
+        buffer = bytearray()
+        try:
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                if self.cancel_event.is_set():
+                    return False
+                buffer.extend(chunk)
+                self.counters.count_bytes(len(chunk))
+                if len(buffer) >= WRITE_BUFFER_SIZE:
+                    data, buffer = bytes(buffer), bytearray()
+                    await asyncio.to_thread(f.write, data)
+            return True
+        finally:
+            await asyncio.to_thread(self._close_part, f, bytes(buffer))
+
+    @staticmethod
+    def _close_part(f, data):
+        with f:
+            if data:
+                f.write(data)
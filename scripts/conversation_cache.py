@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR_NAME = 'vk-media-downloader'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    peer_id INTEGER PRIMARY KEY,
+    position INTEGER NOT NULL,
+    title TEXT,
+    last_message_id INTEGER,
+    last_date INTEGER,
+    messages INTEGER,
+    pinned INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS peer_names (
+    peer_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+COLUMNS = ('peer_id', 'title', 'last_message_id', 'last_date', 'messages', 'pinned')
+
+
+def default_cache_dir():
+    base = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME') \
+        or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, CACHE_DIR_NAME)
+
+
+def owner_key(saver, token):
+    """
+    Ключ кэша — id владельца токена, чтобы разные аккаунты не смешивались.
+    Если id не получить (токен сообщества), берём хэш токена: сам токен
+    на диск не пишется.
+    """
+    try:
+        owner_id = saver.get_owner_id()
+        if owner_id:
+            return str(owner_id)
+    except Exception as e:
+        logger.warning(f"Не удалось узнать владельца токена: {e}")
+    return 'token_' + hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+class ConversationCache:
+    """
+    Список диалогов и имена собеседников между запусками, отдельный файл
+    на каждого владельца токена. Окно выбора открывается из кэша сразу,
+    а из API догружаются только изменившиеся диалоги.
+    """
+
+    def __init__(self, key, cache_dir=None):
+        cache_dir = cache_dir or default_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, f'conversations_{key}.sqlite')
+        self._conn = sqlite3.connect(self.path)
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def load(self):
+        rows = self._conn.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM conversations ORDER BY position"
+        ).fetchall()
+        dialogs = [dict(zip(COLUMNS, row)) for row in rows]
+        for dialog in dialogs:
+            dialog['pinned'] = bool(dialog['pinned'])
+        return dialogs
+
+    def peer_names(self):
+        return dict(self._conn.execute('SELECT peer_id, name FROM peer_names'))
+
+    @property
+    def synced_at(self):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'synced_at'").fetchone()
+        return int(row[0]) if row else None
+
+    def save(self, dialogs, peer_names=None):
+        """Список целиком заменяется: порядок — как в getConversations"""
+        with self._conn:
+            self._conn.execute('DELETE FROM conversations')
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO conversations (position, {', '.join(COLUMNS)}) "
+                f"VALUES (?, {', '.join('?' * len(COLUMNS))})",
+                [(position, *(dialog.get(column) for column in COLUMNS))
+                 for position, dialog in enumerate(dialogs)]
+            )
+            if peer_names:
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO peer_names (peer_id, name) VALUES (?, ?)',
+                    [(peer_id, name) for peer_id, name in peer_names.items() if name]
+                )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('synced_at', ?)",
+                (str(int(time.time())),)
+            )
+
+    def close(self):
+        self._conn.close()
+
+
+def merge_conversations(cached, changed):
+    """Изменившиеся диалоги — наверх (они свежее), остальные в прежнем порядке"""
+    changed_ids = {dialog['peer_id'] for dialog in changed}
+    pinned = [d for d in changed if d.get('pinned')]
+    fresh = [d for d in changed if not d.get('pinned')]
+    return pinned + fresh + [d for d in cached if d['peer_id'] not in changed_ids]
+
+
+def sync_conversations(saver, cache, progress_callback=None):
+    """
+    Обновляет кэш и возвращает актуальный список диалогов. Из API берутся
+    только изменившиеся; полный обход — при пустом кэше или если число
+    диалогов не сошлось (диалог удалён или покинут).
+    """
+    cached = cache.load()
+    saver.peer_names.update(cache.peer_names())
+
+    dialogs = None
+    if cached:
+        known = {dialog['peer_id']: dialog['last_message_id'] for dialog in cached}
+        changed, total = saver.get_changed_conversations(known)
+        merged = merge_conversations(cached, changed)
+        if len(merged) == total:
+            logger.info(f"Диалогов изменилось с прошлой синхронизации: {len(changed)}")
+            dialogs = merged
+            if progress_callback:
+                progress_callback(100)
+        else:
+            logger.info(f"Число диалогов не сошлось с кэшем ({len(merged)} и {total}), полный обход")
+
+    if dialogs is None:
+        dialogs = saver.get_all_conversations(progress_callback=progress_callback)
+
+    cache.save(dialogs, saver.peer_names)
+    return dialogs
@@ -0,0 +1,170 @@
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+
+from scripts.manifest import MANIFEST_NAME
+
+logger = logging.getLogger(__name__)
+
+# ioctl FICLONE (Linux, btrfs / xfs): копия с общими блоками, без записи данных
+FICLONE = 0x40049409
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    media_id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    sha256 TEXT,
+    size INTEGER,
+    stored_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_sha256 ON objects (sha256);
+"""
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _reflink(source, target):
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+
+    try:
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copystat(source, target)
+        return True
+    except OSError:
+        if os.path.exists(target):
+            os.remove(target)
+        return False
+
+
+def link_file(source, target):
+    """hardlink, если нельзя — reflink, в крайнем случае обычная копия"""
+    if os.path.abspath(source) == os.path.abspath(target):
+        return 'same'
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+        return 'hardlink'
+    except OSError:
+        pass
+    if _reflink(source, target):
+        return 'reflink'
+    shutil.copy2(source, target)
+    return 'copy'
+
+
+class DedupIndex:
+    """
+    Глобальный индекс скачанных объектов в папке сохранения: один и тот же
+    photo{owner}_{id} из разных диалогов и пересылок качается один раз,
+    в остальные папки ставится ссылка. С hash_content дополнительно
+    склеиваются разные id с одинаковым содержимым (экономит диск, не трафик).
+    """
+
+    def __init__(self, save_path, hash_content=False):
+        self.save_path = save_path
+        self.hash_content = hash_content
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._conn = sqlite3.connect(
+            os.path.join(save_path, MANIFEST_NAME), check_same_thread=False, timeout=30
+        )
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+        self.linked = 0
+        self.bytes_saved = 0
+
+    def acquire(self, media_id):
+        """
+        Путь уже скачанной копии или None. При None вызывающий сам качает
+        объект и обязан вызвать release(); параллельные запросы того же id ждут его.
+        """
+        while True:
+            with self._lock:
+                path = self._lookup(media_id)
+                if path:
+                    return path
+                event = self._in_flight.get(media_id)
+                if event is None:
+                    self._in_flight[media_id] = threading.Event()
+                    return None
+            event.wait()
+
+    def release(self, media_id, path=None):
+        """
+        path=None — загрузка не удалась, ждущие потоки попробуют сами.
+        Возвращает True, если файл заменён ссылкой на копию с тем же содержимым.
+        """
+        try:
+            if path and os.path.exists(path):
+                return self._store(media_id, path)
+            return False
+        finally:
+            with self._lock:
+                event = self._in_flight.pop(media_id, None)
+            if event is not None:
+                event.set()
+
+    def link(self, source, target):
+        try:
+            method = link_file(source, target)
+        except OSError as e:
+            logger.warning(f"Не удалось связать {source} -> {target}: {e}")
+            return False
+
+        if method != 'same':
+            with self._lock:
+                self.linked += 1
+                self.bytes_saved += os.path.getsize(target)
+            logger.debug(f"Дубликат ({method}): {target}")
+        return True
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _lookup(self, media_id):
+        row = self._conn.execute('SELECT path FROM objects WHERE media_id = ?', (media_id,)).fetchone()
+        if not row:
+            return None
+        path = os.path.join(self.save_path, row[0])
+        return path if os.path.exists(path) else None
+
+    def _store(self, media_id, path):
+        sha256 = file_sha256(path) if self.hash_content else None
+        replaced = False
+
+        if sha256:
+            with self._lock:
+                row = self._conn.execute(
+                    'SELECT path FROM objects WHERE sha256 = ? AND media_id != ?', (sha256, media_id)
+                ).fetchone()
+            same = os.path.join(self.save_path, row[0]) if row else None
+            if same and os.path.exists(same):
+                # Другой id, то же содержимое — заменяем файл ссылкой на уже сохранённый
+                replaced = self.link(same, path)
+
+        relpath = os.path.relpath(path, self.save_path)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO objects (media_id, path, sha256, size, stored_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (media_id, relpath, sha256, os.path.getsize(path), int(time.time()))
+            )
+            self._conn.commit()
+        return replaced
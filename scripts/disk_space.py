@@ -0,0 +1,79 @@
+import logging
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Ниже этого запаса свободного места новые загрузки не начинаются
+MIN_FREE_BYTES = 1024 ** 3
+CHECK_INTERVAL = 1.0
+
+
+def free_bytes(path):
+    return shutil.disk_usage(path).free
+
+
+class DiskSpaceGuard:
+    """
+    Пауза вместо ошибок при заполненном диске: перед каждым файлом поток
+    загрузки вызывает wait(), который ждёт, пока свободного места снова не
+    станет больше min_free (освободили место — загрузка продолжается сама),
+    или отмены. Начатые файлы докачиваются: запас min_free на это и рассчитан.
+    disk_usage опрашивается не чаще interval — потоков много, диск один.
+    on_pause(paused, free) — при входе в паузу и выходе из неё.
+    """
+
+    def __init__(self, path, min_free=MIN_FREE_BYTES, on_pause=None, interval=CHECK_INTERVAL):
+        self.path = path
+        self.min_free = min_free
+        self.on_pause = on_pause
+        self.interval = interval
+        self.paused = False
+        self._free = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def free(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._free is None or now - self._checked_at >= self.interval:
+                self._free = free_bytes(self.path)
+                self._checked_at = now
+            return self._free
+
+    def has_space(self):
+        return self.free >= self.min_free
+
+    def wait(self, cancel_event):
+        """False — отменено, пока ждали места"""
+        while not self.has_space():
+            self._set_paused(True)
+            if cancel_event.wait(self.interval):
+                return False
+        self._set_paused(False)
+        return True
+
+    def check(self):
+        """Неблокирующая проверка для asyncio-движка: ждёт он сам, через asyncio.sleep"""
+        if self.has_space():
+            self._set_paused(False)
+            return True
+        self._set_paused(True)
+        return False
+
+    def _set_paused(self, paused):
+        with self._lock:
+            if self.paused == paused:
+                return
+            self.paused = paused
+            free = self._free
+
+        if paused:
+            logger.warning(f"Свободно {free / 1048576:.0f} МБ при минимуме "
+                           f"{self.min_free / 1048576:.0f} МБ — загрузка на паузе до освобождения места")
+        else:
+            logger.warning("Место на диске освободилось, загрузка продолжается")
+        if self.on_pause:
+            self.on_pause(paused, free)
@@ -0,0 +1,245 @@
+import logging
+import threading
+import time
+
+from scripts.download_queue import DEFAULT_QUEUE_SIZE, PHOTO_LANE, DownloadQueue, item_cost, lane_of
+from scripts.metrics import metrics
+from scripts.parse_vk_dialogs import is_photo_path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+QUEUE_POLL_INTERVAL = 0.2
+
+
+class TransferStats:
+    """Счётчики файлов и байтов загрузки, общие для обоих движков"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self.files_submitted = 0
+        self.files_done = 0
+        self.files_failed = 0
+        self.bytes_done = 0
+
+    def submitted(self):
+        with self._lock:
+            self.files_submitted += 1
+
+    def finished(self, ok, cancelled):
+        # Отменённое неудачей не считается — его доберёт следующий запуск
+        with self._lock:
+            if ok:
+                self.files_done += 1
+            elif not cancelled:
+                self.files_failed += 1
+        metrics.incr('download.files', result='ok' if ok else 'failed')
+
+    def count_bytes(self, size):
+        with self._lock:
+            self.bytes_done += size
+        metrics.incr('download.bytes', size)
+
+    def snapshot(self, in_flight, queue, dedup=None, postprocessor=None):
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        with self._lock:
+            stats = {
+                'files_submitted': self.files_submitted,
+                'files_done': self.files_done,
+                'files_failed': self.files_failed,
+                'bytes_done': self.bytes_done,
+                'in_flight': in_flight,
+                'elapsed': elapsed,
+                'bytes_per_sec': self.bytes_done / elapsed,
+            }
+        if queue is not None:
+            stats['queue'] = queue.stats()
+        if dedup is not None:
+            stats['files_linked'] = dedup.linked
+            stats['bytes_saved'] = dedup.bytes_saved
+        if postprocessor is not None:
+            stats['postprocess'] = postprocessor.stats()
+        return stats
+
+
+def log_totals(stats):
+    logger.info(
+        f"Скачано файлов: {stats['files_done']}, ошибок: {stats['files_failed']}, "
+        f"{stats['bytes_done'] / 1048576:.1f} МБ, {stats['bytes_per_sec'] / 1048576:.2f} МБ/с"
+    )
+
+
+class DownloadEngine:
+    """
+    Потоки загрузки поверх AppSaver.download_file, которые берут файлы из
+    DownloadQueue: мелкие фото раньше крупных, видео — в своей полосе из
+    video_slots потоков, приоритетные диалоги (set_priority) — вперёд.
+    submit() блокируется, когда в очереди queue_size файлов, — так
+    перечисление не уходит далеко вперёд. cancel() прерывает загрузки на
+    ближайшем чанке; что не успело скачаться, отдаёт pending().
+    С postprocessor теги и mtime ставятся не в потоке загрузки, а передаются
+    в отдельный этап (PostProcessor). С dedup (DedupIndex) объект, уже
+    скачанный для другого диалога, не качается повторно, а связывается ссылкой.
+    С space_guard (DiskSpaceGuard) новый файл не начинается, пока на диске
+    меньше минимального запаса: поток ждёт, а не сыплет ошибками записи.
+    """
+
+    def __init__(self, saver, workers=DEFAULT_WORKERS, postprocessor=None, dedup=None, space_guard=None,
+                 video_slots=None, queue_size=DEFAULT_QUEUE_SIZE):
+        self.saver = saver
+        self.workers = workers
+        self.postprocessor = postprocessor
+        self.dedup = dedup
+        self.space_guard = space_guard
+        self.cancel_event = threading.Event()
+        self.queue = DownloadQueue(video_slots or workers, maxsize=queue_size)
+
+        self.saver.configure_http(pool_size=workers)
+        self.counters = TransferStats()
+        # Уведомляет и загрузчики (появилась задача), и submit (освободилось место)
+        self._changed = threading.Condition()
+        self._active = 0
+        self._closing = False
+        # Прерванные отменой загрузки — в начало сохранённой очереди
+        self._interrupted = []
+
+        self._threads = [threading.Thread(target=self._worker, name=f'download-{index}', daemon=True)
+                         for index in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, url, path, item_date=None, on_done=None, media_id=None, peer_id=None, item=None,
+               cost=None):
+        """
+        False — отменено, пока ждали места в очереди. item (аттач из iter_media)
+        задаёт полосу и размер для сортировки; cost=0 — строго по порядку
+        """
+        task = {'url': url, 'path': path, 'date': item_date, 'media_id': media_id,
+                'on_done': on_done, 'peer_id': peer_id, 'item': item,
+                'video_format': item.get('video_format') if item else None,
+                'lane': lane_of(item) if item else PHOTO_LANE}
+        if cost is None:
+            cost = item_cost(item) if item else 0
+
+        with self._changed:
+            while self.queue.full:
+                if self.cancel_event.is_set():
+                    return False
+                self._changed.wait(QUEUE_POLL_INTERVAL)
+            self.queue.push(task, peer_id=peer_id, lane=task['lane'], cost=cost)
+            self._changed.notify_all()
+        self.counters.submitted()
+        metrics.gauge('queue.downloads', len(self.queue) + self._active)
+        return True
+
+    def set_priority(self, peer_id, priority):
+        self.queue.set_priority(peer_id, priority)
+
+    def wait(self):
+        """До конца очереди; после отмены — только до конца начатых загрузок"""
+        self.queue.close()
+        with self._changed:
+            self._changed.notify_all()
+            while self._active or (len(self.queue) and not self.cancel_event.is_set()):
+                self._changed.wait(QUEUE_POLL_INTERVAL)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def shutdown(self):
+        with self._changed:
+            self._closing = True
+            self._changed.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def pending(self):
+        """Не скачанное после отмены: прерванные, затем очередь — (peer_id, item, path)"""
+        tasks = self._interrupted + self.queue.drain()
+        self._interrupted = []
+        return [(task['peer_id'], task['item'], task['path']) for task in tasks if task['item'] is not None]
+
+    def stats(self):
+        return self.counters.snapshot(self._active + len(self.queue), self.queue, self.dedup, self.postprocessor)
+
+    def _next_task(self):
+        with self._changed:
+            while not self.cancel_event.is_set():
+                task = self.queue.pop()
+                if task is not None:
+                    self._active += 1
+                    self._changed.notify_all()
+                    return task
+                if self._closing and not len(self.queue):
+                    return None
+                self._changed.wait(QUEUE_POLL_INTERVAL)
+        return None
+
+    def _worker(self):
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            ok = False
+            try:
+                ok = self._download(task['url'], task['path'], task['date'], task['media_id'],
+                                    task['video_format'])
+                if task['on_done']:
+                    task['on_done'](ok)
+            except Exception as e:
+                logger.error(f"Ошибка загрузки {task['path']}: {e!r}")
+            finally:
+                self.queue.task_done(task['lane'])
+                with self._changed:
+                    if not ok and self.cancel_event.is_set():
+                        self._interrupted.append(task)
+                    self._active -= 1
+                    self._changed.notify_all()
+
+    def _download(self, url, path, item_date, media_id=None, video_format=None):
+        if self.dedup is None or media_id is None:
+            ok = self._fetch(url, path, item_date, video_format)
+            self._postprocess(ok, path, item_date)
+            return ok
+
+        existing = self.dedup.acquire(media_id)
+        if existing:
+            metrics.incr('dedup.linked')
+            return self.dedup.link(existing, path)
+
+        ok = replaced = False
+        try:
+            ok = self._fetch(url, path, item_date, video_format)
+        finally:
+            replaced = self.dedup.release(media_id, path if ok else None)
+        # Заменённый ссылкой файл уже обработан как оригинал
+        self._postprocess(ok and not replaced, path, item_date)
+        return ok
+
+    def _fetch(self, url, path, item_date, video_format=None):
+        if self.space_guard is not None and not self.space_guard.wait(self.cancel_event):
+            return False
+        ok = self.saver.download_file(
+            url, path, item_date,
+            cancel_event=self.cancel_event,
+            on_chunk=self.counters.count_bytes,
+            stamp=self.postprocessor is None,
+            video_format=video_format
+        )
+        self.counters.finished(ok, self.cancel_event.is_set())
+        return ok
+
+    def _postprocess(self, ok, path, item_date):
+        # Фото уже с EXIF и mtime (save_photo) — в пул уходят только видео
+        if ok and self.postprocessor is not None and not is_photo_path(path):
+            self.postprocessor.submit(path, item_date)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.cancel()
+        self.shutdown()
+        log_totals(self.stats())
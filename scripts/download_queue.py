@@ -0,0 +1,129 @@
+import heapq
+import itertools
+import threading
+
+from scripts.planner import DEFAULT_SIZES, metadata_size
+
+PHOTO_LANE = 'photo'
+VIDEO_LANE = 'video'
+
+# Сколько файлов ждёт загрузки; дальше перечисление встаёт на паузу.
+# Чем больше окно, тем заметнее сортировка, но тем больше работы теряется
+# при падении (при stop() очередь сохраняется в манифест)
+DEFAULT_QUEUE_SIZE = 2000
+# Доля загрузчиков, которую могут занять видео, пока в очереди есть фото
+VIDEO_LANE_SHARE = 0.25
+
+# Очередь упорядочена по «виртуальному времени»: номер поступления плюс
+# штраф за размер. Фото в COST_UNIT байт обгоняет одно фото, поступившее
+# раньше; штраф ограничен MAX_DELAY, поэтому крупные файлы не голодают
+COST_UNIT = {PHOTO_LANE: 64 * 1024, VIDEO_LANE: 16 * 1048576}
+MAX_DELAY = 500
+
+
+def lane_of(item):
+    return VIDEO_LANE if item.get('type') == 'video' else PHOTO_LANE
+
+
+def item_cost(item):
+    size = metadata_size(item)
+    return size if size is not None else DEFAULT_SIZES.get(item.get('type'), DEFAULT_SIZES['photo'])
+
+
+def video_slots_for(workers, media_types):
+    # Без фото ограничивать видео незачем
+    if 'photo' not in media_types:
+        return workers
+    return max(1, int(workers * VIDEO_LANE_SHARE))
+
+
+class DownloadQueue:
+    """
+    Очередь загрузок с приоритетами: мелкие фото раньше крупных, видео —
+    в отдельной полосе, которая занимает не больше video_slots загрузчиков,
+    пока фото ждут в очереди (без фото и после close() — сколько угодно). Приоритет диалога
+    (set_priority) важнее размера и меняется на ходу: очередь пересобирается.
+    Сама не блокирует — ждут движки, каждый своим способом; lock нужен для
+    set_priority из другого потока (GUI, сигнал).
+    """
+
+    def __init__(self, video_slots, maxsize=DEFAULT_QUEUE_SIZE):
+        self.video_slots = video_slots
+        self.maxsize = maxsize
+        self.closed = False
+        self.videos_active = 0
+        self._heaps = {PHOTO_LANE: [], VIDEO_LANE: []}
+        self._priorities = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heaps[PHOTO_LANE]) + len(self._heaps[VIDEO_LANE])
+
+    @property
+    def full(self):
+        return len(self) >= self.maxsize
+
+    def push(self, task, peer_id=None, lane=PHOTO_LANE, cost=0):
+        """cost=0 — без штрафа, строго в порядке поступления (возобновлённая очередь)"""
+        with self._lock:
+            seq = next(self._seq)
+            delay = min(cost / COST_UNIT[lane], MAX_DELAY)
+            entry = [None, seq + delay, seq, peer_id, lane, task]
+            entry[0] = self._key(entry)
+            heapq.heappush(self._heaps[lane], entry)
+
+    def pop(self):
+        """Следующая задача или None, если брать нечего (пусто или полоса видео занята)"""
+        with self._lock:
+            photos, videos = self._heaps[PHOTO_LANE], self._heaps[VIDEO_LANE]
+            video_open = videos and (self.closed or not photos
+                                     or self.videos_active < self.video_slots)
+            if video_open and (not photos or videos[0][0][0] <= photos[0][0][0]):
+                # Свободная полоса видео не простаивает, если фото не приоритетнее
+                self.videos_active += 1
+                return heapq.heappop(videos)[-1]
+            if photos:
+                return heapq.heappop(photos)[-1]
+            return None
+
+    def task_done(self, lane):
+        if lane == VIDEO_LANE:
+            with self._lock:
+                self.videos_active -= 1
+
+    def close(self):
+        """Новых задач не будет: видео больше не ограничены своей полосой"""
+        self.closed = True
+
+    def set_priority(self, peer_id, priority):
+        with self._lock:
+            self._priorities[peer_id] = priority
+            for heap in self._heaps.values():
+                for entry in heap:
+                    entry[0] = self._key(entry)
+                heapq.heapify(heap)
+
+    def priority(self, peer_id):
+        return self._priorities.get(peer_id, 0)
+
+    def drain(self):
+        """Все оставшиеся задачи в том порядке, в каком их взяли бы загрузчики"""
+        with self._lock:
+            entries = self._heaps[PHOTO_LANE] + self._heaps[VIDEO_LANE]
+            self._heaps = {PHOTO_LANE: [], VIDEO_LANE: []}
+        return [entry[-1] for entry in sorted(entries, key=lambda entry: entry[0])]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'photos': len(self._heaps[PHOTO_LANE]),
+                'videos': len(self._heaps[VIDEO_LANE]),
+                'videos_active': self.videos_active,
+            }
+
+    def _key(self, entry):
+        # Приоритет диалога, затем виртуальное время поступления; номер
+        # поступления делает ключ уникальным, чтобы heapq не сравнивал задачи
+        return -self._priorities.get(entry[3], 0), entry[1], entry[2]
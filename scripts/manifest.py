@@ -0,0 +1,188 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = '.vk_media_manifest.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dialogs (
+    peer_id INTEGER PRIMARY KEY,
+    last_message_id INTEGER NOT NULL,
+    synced_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    peer_id INTEGER NOT NULL,
+    item_id TEXT NOT NULL,
+    message_id INTEGER,
+    path TEXT NOT NULL,
+    downloaded_at INTEGER NOT NULL,
+    PRIMARY KEY (peer_id, item_id)
+);
+CREATE INDEX IF NOT EXISTS items_path ON items (path);
+CREATE TABLE IF NOT EXISTS failed_items (
+    peer_id INTEGER NOT NULL,
+    item_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    url TEXT NOT NULL,
+    video_key TEXT,
+    path TEXT NOT NULL,
+    date INTEGER,
+    message_id INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    failed_at INTEGER NOT NULL,
+    PRIMARY KEY (peer_id, item_id)
+);
+CREATE TABLE IF NOT EXISTS queued_items (
+    position INTEGER PRIMARY KEY,
+    peer_id INTEGER NOT NULL,
+    item_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    url TEXT NOT NULL,
+    video_key TEXT,
+    path TEXT NOT NULL,
+    date INTEGER,
+    message_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS queued_dialogs (
+    peer_id INTEGER PRIMARY KEY,
+    newest INTEGER NOT NULL
+);
+"""
+
+FAILED_COLUMNS = ('peer_id', 'item_id', 'type', 'url', 'video_key', 'path', 'date', 'message_id', 'attempts')
+QUEUED_COLUMNS = ('peer_id', 'item_id', 'type', 'url', 'video_key', 'path', 'date', 'message_id')
+
+
+class SyncManifest:
+    """
+    Состояние синхронизации в папке сохранения: для каждого peer_id — последний
+    обработанный message_id, уже скачанные аттачи и список неудачных
+    (failed_items), которые можно докачать позже без повторного обхода истории.
+    При остановке сюда же сохраняется очередь загрузок (queued_items) и
+    диалоги, перечисленные целиком (queued_dialogs): следующий запуск
+    начинает с них в том же порядке, не перечисляя эти диалоги заново.
+    Пишут в него потоки загрузки, поэтому одно соединение под общим локом.
+    """
+
+    def __init__(self, save_path):
+        self.path = os.path.join(save_path, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def last_message_id(self, peer_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT last_message_id FROM dialogs WHERE peer_id = ?', (peer_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_last_message_id(self, peer_id, message_id):
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO dialogs (peer_id, last_message_id, synced_at) VALUES (?, ?, ?) '
+                'ON CONFLICT(peer_id) DO UPDATE SET '
+                'last_message_id = MAX(last_message_id, excluded.last_message_id), '
+                'synced_at = excluded.synced_at',
+                (peer_id, message_id, int(time.time()))
+            )
+            self._conn.commit()
+
+    def is_downloaded(self, peer_id, item_id, path=None):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT path FROM items WHERE peer_id = ? AND item_id = ?', (peer_id, item_id)
+            ).fetchone()
+        if row is None:
+            return False
+        # Файл удалили руками — скачаем заново
+        return os.path.exists(path or row[0])
+
+    def downloaded_at(self, path):
+        """(peer_id, item_id, message_id) файла, скачанного в path, или None"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT peer_id, item_id, message_id FROM items WHERE path = ?', (path,)
+            ).fetchone()
+
+    def mark_downloaded(self, peer_id, item_id, path, message_id=None):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO items (peer_id, item_id, message_id, path, downloaded_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (peer_id, item_id, message_id, path, int(time.time()))
+            )
+            self._conn.execute(
+                'DELETE FROM failed_items WHERE peer_id = ? AND item_id = ?', (peer_id, item_id)
+            )
+            self._conn.commit()
+
+    def mark_failed(self, peer_id, item, path):
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO failed_items (peer_id, item_id, type, url, video_key, path, date, '
+                'message_id, failed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(peer_id, item_id) DO UPDATE SET '
+                'url = excluded.url, path = excluded.path, '
+                'attempts = attempts + 1, failed_at = excluded.failed_at',
+                (peer_id, item['id'], item['type'], item['url'], item.get('video_key'), path,
+                 item.get('date'), item.get('message_id'), int(time.time()))
+            )
+            self._conn.commit()
+
+    def failed_items(self):
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(FAILED_COLUMNS)} FROM failed_items ORDER BY failed_at"
+            ).fetchall()
+        return [dict(zip(FAILED_COLUMNS, row)) for row in rows]
+
+    def failed_count(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM failed_items').fetchone()[0]
+
+    def save_queue(self, items, enumerated):
+        """items — (peer_id, item, path) в порядке загрузки; enumerated — {peer_id: newest message_id}"""
+        with self._lock:
+            start = self._conn.execute('SELECT COALESCE(MAX(position), 0) FROM queued_items').fetchone()[0]
+            self._conn.executemany(
+                'INSERT INTO queued_items (position, peer_id, item_id, type, url, video_key, path, date, '
+                'message_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(start + index + 1, peer_id, item['id'], item['type'], item['url'], item.get('video_key'),
+                  path, item.get('date'), item.get('message_id'))
+                 for index, (peer_id, item, path) in enumerate(items)]
+            )
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO queued_dialogs (peer_id, newest) VALUES (?, ?)',
+                list(enumerated.items())
+            )
+            self._conn.commit()
+
+    def take_queue(self, peer_ids):
+        """
+        Сохранённая очередь выбранных диалогов; из манифеста она удаляется —
+        после падения следующий запуск просто перечислит диалоги заново
+        """
+        peer_ids = list(peer_ids)
+        marks = ', '.join('?' * len(peer_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(QUEUED_COLUMNS)} FROM queued_items "
+                f"WHERE peer_id IN ({marks}) ORDER BY position", peer_ids
+            ).fetchall()
+            enumerated = dict(self._conn.execute(
+                f'SELECT peer_id, newest FROM queued_dialogs WHERE peer_id IN ({marks})', peer_ids
+            ).fetchall())
+            self._conn.execute(f'DELETE FROM queued_items WHERE peer_id IN ({marks})', peer_ids)
+            self._conn.execute(f'DELETE FROM queued_dialogs WHERE peer_id IN ({marks})', peer_ids)
+            self._conn.commit()
+        return [dict(zip(QUEUED_COLUMNS, row)) for row in rows], enumerated
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
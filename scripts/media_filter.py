@@ -0,0 +1,82 @@
+import time
+
+MEDIA_TYPES = ('photo', 'video')
+
+
+def _longest_side(size):
+    return max(size.get('width') or 0, size.get('height') or 0)
+
+
+def _format_date(timestamp):
+    return time.strftime('%Y-%m-%d', time.localtime(timestamp)) if timestamp is not None else '…'
+
+
+class MediaFilter:
+    """
+    Что скачивать из диалога: типы аттачей, диапазон дат сообщений
+    (unix time, включительно) и предел разрешения. Применяется при
+    перечислении, до video.get и загрузок: история идёт от новых сообщений
+    к старым, поэтому date_from останавливает пагинацию, а ненужный тип
+    не запрашивается вовсе.
+    max_photo_size — предел длинной стороны фото: берётся самый крупный
+    размер из sizes, который в него укладывается. min_photo_size — фото,
+    у которых даже оригинал меньше, пропускаются (иконки, стикеры-картинки).
+    max_video_height — предел качества mp4 (480 → mp4_480).
+    """
+
+    def __init__(self, types=MEDIA_TYPES, date_from=None, date_to=None,
+                 max_photo_size=None, min_photo_size=None, max_video_height=None):
+        unknown = set(types) - set(MEDIA_TYPES)
+        if unknown:
+            raise ValueError(f"Неизвестные типы медиа: {', '.join(sorted(unknown))}")
+        self.types = tuple(t for t in MEDIA_TYPES if t in types)
+        self.date_from = date_from
+        self.date_to = date_to
+        self.max_photo_size = max_photo_size
+        self.min_photo_size = min_photo_size
+        self.max_video_height = max_video_height
+
+    @property
+    def narrows_history(self):
+        """
+        Перечисляется не вся новая история: фильтр типов, дат или min_photo_size
+        отбрасывает аттачи. Курсор инкрементальной синхронизации после такого
+        прогона двигать нельзя — иначе следующий полный прогон не доберёт
+        отфильтрованное. max_photo_size и max_video_height только выбирают
+        размер и ничего не отбрасывают.
+        """
+        return (self.types != MEDIA_TYPES or self.date_from is not None or self.date_to is not None
+                or bool(self.min_photo_size))
+
+    def is_too_old(self, date):
+        """Сообщение старше date_from: дальше по истории только старее"""
+        return self.date_from is not None and date is not None and date < self.date_from
+
+    def is_too_new(self, date):
+        return self.date_to is not None and date is not None and date > self.date_to
+
+    def pick_photo_size(self, sizes):
+        if not sizes:
+            return None
+        best = max(sizes, key=lambda s: s['width'])
+        if self.min_photo_size and _longest_side(best) < self.min_photo_size:
+            return None
+        if self.max_photo_size and _longest_side(best) > self.max_photo_size:
+            fitting = [s for s in sizes if _longest_side(s) <= self.max_photo_size]
+            # Все размеры крупнее предела — берём самый мелкий из них
+            best = max(fitting, key=_longest_side) if fitting else min(sizes, key=_longest_side)
+        return best
+
+    def describe(self):
+        parts = []
+        if self.types != MEDIA_TYPES:
+            parts.append('+'.join(self.types))
+        if self.date_from is not None or self.date_to is not None:
+            parts.append(f"даты {_format_date(self.date_from)}–{_format_date(self.date_to)}")
+        if self.max_photo_size:
+            parts.append(f"фото ≤{self.max_photo_size}px")
+        if self.min_photo_size:
+            parts.append(f"фото ≥{self.min_photo_size}px")
+        if self.max_video_height:
+            parts.append(f"видео ≤{self.max_video_height}p")
+        return ', '.join(parts) or 'без фильтров'
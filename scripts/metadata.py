@@ -0,0 +1,108 @@
+import datetime
+import io
+import logging
+import os
+import time
+
+import piexif
+from mutagen.mp4 import MP4
+
+logger = logging.getLogger(__name__)
+
+SOFTWARE = "VK Media Saver"
+
+
+def photo_exif_bytes(create_date):
+    date_str = datetime.datetime.utcfromtimestamp(create_date).strftime('%Y:%m:%d %H:%M:%S')
+
+    exif_dict = {
+        "0th": {
+            piexif.ImageIFD.DateTime: date_str,
+            piexif.ImageIFD.Software: SOFTWARE,
+        },
+        "Exif": {
+            piexif.ExifIFD.DateTimeOriginal: date_str,
+            piexif.ExifIFD.DateTimeDigitized: date_str,
+        },
+        "GPS": {},
+    }
+    return piexif.dump(exif_dict)
+
+
+def inject_photo_exif(data, create_date):
+    """
+    Вставляет сегмент APP1/EXIF в байты JPEG без декодирования пикселей:
+    старый EXIF-сегмент заменяется, остальной поток копируется как есть.
+    Если это не JPEG (например, webp), данные возвращаются без изменений.
+    """
+    if data[:2] != b'\xff\xd8':
+        return data
+
+    out = io.BytesIO()
+    piexif.insert(photo_exif_bytes(create_date), bytes(data), out)
+    return out.getvalue()
+
+
+def add_photo_metadata(file_path, create_date):
+    """Тот же splice, но для файла на диске (переписывается один раз, без перекодирования)"""
+    try:
+        piexif.insert(photo_exif_bytes(create_date), file_path)
+        logger.debug(f"EXIF-данные успешно добавлены: {file_path}")
+        return True
+
+    except Exception as e:
+        logger.error(f"Ошибка записи EXIF: {str(e)}")
+        return False
+
+
+def _write_video_tags(file_path, create_date):
+    video = MP4(file_path)
+    date_iso = datetime.datetime.utcfromtimestamp(create_date).isoformat()
+
+    video["\xa9day"] = [date_iso]
+    video["\xa9too"] = [SOFTWARE]
+    video["\xa9nam"] = ["Media from VK"]
+    video["\xa9cmt"] = [f"Original VK upload date: {date_iso}"]
+    video.save()
+
+
+def add_video_metadata(file_path, create_date):
+    try:
+        _write_video_tags(file_path, create_date)
+        logger.debug(f"Метаданные видео успешно добавлены: {file_path}")
+        return True
+
+    except Exception as e:
+        logger.error(f"Ошибка записи метаданных видео: {str(e)}")
+        return False
+
+
+def set_file_mtime(file_path, timestamp):
+    try:
+        os.utime(file_path, (timestamp, timestamp))
+    except Exception as e:
+        logger.warning(f"Не удалось установить время файла: {e}")
+
+
+def stamp_file(file_path, create_date, photo_exif=True):
+    """
+    Вся пост-обработка одного файла. Функция уровня модуля — её можно
+    отправить в ProcessPoolExecutor. photo_exif=False, если EXIF уже вставлен
+    в буфер при скачивании.
+    Исключения пробрасываются: их считает PostProcessor.
+    """
+    lower = file_path.lower()
+    if lower.endswith(('.jpg', '.jpeg')) and photo_exif:
+        piexif.insert(photo_exif_bytes(create_date), file_path)
+    elif lower.endswith('.mp4'):
+        _write_video_tags(file_path, create_date)
+
+    os.utime(file_path, (create_date, create_date))
+    return file_path
+
+
+def timed_stamp_file(file_path, create_date, photo_exif=True):
+    """stamp_file для пула процессов: возвращает время работы в дочернем процессе"""
+    started = time.perf_counter()
+    stamp_file(file_path, create_date, photo_exif)
+    return time.perf_counter() - started
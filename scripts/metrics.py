@@ -0,0 +1,180 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _label_key(labels):
+    return ','.join(f"{k}={labels[k]}" for k in sorted(labels))
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def snapshot(self):
+        buckets = {f"le_{b}": c for b, c in zip(self.buckets, self.counts)}
+        buckets['le_inf'] = self.counts[-1]
+        return {
+            'count': self.count,
+            'sum': round(self.total, 6),
+            'avg': round(self.total / self.count, 6) if self.count else 0,
+            'max': round(self.max, 6),
+            'buckets': buckets,
+        }
+
+
+class Metrics:
+    """
+    Счётчики, гистограммы времени и gauge по этапам: API, загрузка,
+    пост-обработка, очереди. Потокобезопасно; snapshot() — то, что уходит
+    в JSON-отчёт и на живой HTTP-эндпоинт.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._server = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+            self._gauges = {}
+            self._started = time.time()
+
+    def incr(self, name, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._gauges.setdefault(name, {})
+            current = series.get(key)
+            series[key] = {
+                'value': value,
+                'max': max(value, current['max']) if current else value,
+            }
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def counter_total(self, name):
+        with self._lock:
+            return sum(self._counters.get(name, {}).values())
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                'started_at': self._started,
+                'elapsed': round(time.time() - self._started, 3),
+                'counters': {name: dict(series) for name, series in self._counters.items()},
+                'timers': {
+                    name: {key: h.snapshot() for key, h in series.items()}
+                    for name, series in self._histograms.items()
+                },
+                'gauges': {name: dict(series) for name, series in self._gauges.items()},
+            }
+        snapshot['summary'] = self._summary(snapshot)
+        return snapshot
+
+    @staticmethod
+    def _summary(snapshot):
+        """Грубая подсказка, во что упирается прогон: API, CDN или CPU"""
+        def timer_sum(name):
+            return sum(h['sum'] for h in snapshot['timers'].get(name, {}).values())
+
+        def counter_sum(name):
+            return sum(snapshot['counters'].get(name, {}).values())
+
+        stages = {
+            'api': timer_sum('api.latency') + counter_sum('api.rate_limit_wait_seconds'),
+            'cdn': timer_sum('download.latency'),
+            'cpu': timer_sum('postprocess.seconds'),
+        }
+        elapsed = snapshot['elapsed'] or 1
+        return {
+            'stage_seconds': {k: round(v, 3) for k, v in stages.items()},
+            'bound_by': max(stages, key=stages.get) if any(stages.values()) else None,
+            'bytes_downloaded': counter_sum('download.bytes'),
+            'bytes_per_sec': round(counter_sum('download.bytes') / elapsed, 1),
+            'api_calls': counter_sum('api.calls'),
+            'api_requests': counter_sum('api.requests'),
+        }
+
+    def write_report(self, path, **extra):
+        report = self.snapshot()
+        report.update(extra)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        logger.info(f"Отчёт о прогоне: {path}")
+        return path
+
+    def serve(self, port, host='127.0.0.1'):
+        """Живой JSON на http://host:port/ — для наблюдения за долгим прогоном"""
+        if self._server is not None:
+            return self._server.server_port
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(registry.snapshot(), ensure_ascii=False).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True).start()
+        return self._server.server_port
+
+    def stop_serving(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+metrics = Metrics()
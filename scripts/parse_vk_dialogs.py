@@ -1,168 +1,557 @@
+import json
 import logging
 import sys
 import os
+import threading
 import time
+from urllib.parse import urlsplit
 import requests
-import datetime
-import piexif
-from PIL import Image
-from mutagen.mp4 import MP4
 import yt_dlp
-from vk_api import vk_api, ApiError
+from yt_dlp.utils import DownloadCancelled
+from vk_api import ApiError
+
+from scripts.metadata import add_video_metadata, inject_photo_exif, set_file_mtime
+from scripts.media_filter import MediaFilter
+from scripts.metrics import metrics
+from scripts.retry import (TRANSIENT_ERRORS, DownloadRetry, IncompleteDownloadError, backoff_delay,
+                           check_response)
+from scripts.video_resolver import VideoResolver
+from scripts.vk_scheduler import VkRequestScheduler, API_URL, EXECUTE_MAX_CALLS, STEP_ITEM, USER_TOKEN_RPS
 
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[logging.StreamHandler(sys.stdout)]
 )
 logger = logging.getLogger(__name__)
 
+CHAT_PEER_OFFSET = 2000000000
+PEER_FIELDS = 'first_name,last_name,name'
+
+# Сколько id принимает один вызов users.get / groups.getById / messages.getChat
+USERS_GET_LIMIT = 1000
+GROUPS_GET_LIMIT = 500
+CHATS_GET_LIMIT = 100
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 30
+DEFAULT_POOL_SIZE = 10
+PART_SUFFIX = '.part'
+HLS_FRAGMENT_WORKERS = 4
+RESUME_ATTEMPTS = 5
+# Повторы всей загрузки при 429/5xx и обрывах, с backoff и Retry-After
+DOWNLOAD_RETRIES = 4
+
+MEDIA_MODE_ATTACHMENTS = 'attachments'
+MEDIA_MODE_HISTORY = 'history'
+
+ATTACHMENTS_PAGE_SIZE = 200
+ATTACHMENTS_PAGES_PER_EXECUTE = 10
+
+# Курсор next_from проходится внутри одного execute: до 10 страниц за запрос
+HISTORY_ATTACHMENTS_CODE = """
+var items = [];
+var next = %(start_from)s;
+var i = 0;
+while (i < %(pages)d) {
+    var r = API.messages.getHistoryAttachments({
+        "peer_id": %(peer_id)d,
+        "media_type": %(media_type)s,
+        "count": %(count)d,
+        "start_from": next
+    });
+    items = items + r.items;
+    next = r.next_from;
+    i = i + 1;
+    if (!next || r.items.length == 0) {
+        i = %(pages)d;
+    }
+}
+return {"items": items, "next_from": next};
+"""
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def is_photo_path(path):
+    return path.lower().endswith(('.jpg', '.jpeg'))
+
+
+def part_size(part_path):
+    """Сколько уже скачано в .part — с этого байта продолжает Range-запрос"""
+    return os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+
+def expected_size(status, headers):
+    """Полный размер файла по заголовкам ответа; None — неизвестен"""
+    if status == 206:
+        # Content-Range: bytes 100-999/1000
+        total = headers.get('Content-Range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+
+    length = headers.get('Content-Length')
+    if length is None or headers.get('Content-Encoding'):
+        return None
+    return int(length)
+
+
+def save_photo(path, data, item_date=None, expected=None):
+    """
+    Фото из буфера: сверка размера, EXIF с датой сообщения, запись в .part,
+    mtime и атомарный os.replace. Пост-обработка фото на этом заканчивается —
+    в пул процессов ради одного utime его не отправляют
+    """
+    if expected is not None and len(data) != expected:
+        raise IncompleteDownloadError(f"Размер не совпал ({len(data)} из {expected})")
+
+    if item_date:
+        try:
+            data = inject_photo_exif(data, item_date)
+        except Exception as e:
+            logger.error(f"Ошибка записи EXIF: {str(e)}")
+
+    part_path = path + PART_SUFFIX
+    with open(part_path, 'wb') as f:
+        f.write(data)
+    if item_date:
+        set_file_mtime(part_path, item_date)
+    os.replace(part_path, path)
+
+
+class ResumableDownload:
+    """
+    Докачка в path + '.part' через Range, общая для обоих движков: транспорт
+    (requests или aiohttp) делает запрос и пишет тело, решения — здесь.
+    В path файл попадает атомарным os.replace только после сверки размера,
+    так что обрезанный .jpg/.mp4 на месте итогового файла не остаётся:
+
+        for attempt in ResumableDownload(url, path):
+            wait(attempt.delay)                  # пауза перед повтором, None — без неё
+            response = get(url, headers=attempt.start())
+            if not attempt.accept(status, headers):
+                continue                         # 416 — .part начнётся заново
+            check_response(response)
+            ... тело в attempt.part_path (режим attempt.mode), обрыв — attempt.interrupted(e)
+            if attempt.finish():
+                return True
+
+    Когда попытки кончились, итерация бросает IncompleteDownloadError; .part
+    остаётся — повтор или --retry-failed докачает. start() и finish() работают с диском.
+    """
+
+    def __init__(self, url, path, attempts=RESUME_ATTEMPTS):
+        self.url = url
+        self.path = path
+        self.part_path = path + PART_SUFFIX
+        self.attempts = attempts
+        self.delay = None
+        self.offset = 0
+        self.expected = None
+        self._attempt = 0
+        self._restart = False
+
+    def __iter__(self):
+        for attempt in range(self.attempts):
+            self._attempt = attempt
+            self.delay = None
+            if attempt:
+                metrics.incr('download.resumes', host=urlsplit(self.url).hostname or '')
+                self.delay = backoff_delay(attempt - 1)
+            yield self
+        raise IncompleteDownloadError(f"Не удалось докачать файл за {self.attempts} попыток")
+
+    def start(self):
+        """Заголовки запроса: Range от уже скачанного"""
+        if self._restart:
+            # Диапазон не подошёл (файл на сервере сменился) — начинаем заново
+            os.remove(self.part_path)
+            self._restart = False
+        self.offset = part_size(self.part_path)
+        self.expected = None
+        return {'Range': f'bytes={self.offset}-'} if self.offset else {}
+
+    def accept(self, status, headers):
+        if status == 416:
+            self._restart = True
+            return False
+        self.expected = expected_size(status, headers)
+        if status != 206:
+            # Сервер не умеет Range — отдаёт файл целиком
+            self.offset = 0
+        return True
+
+    @property
+    def mode(self):
+        return 'ab' if self.offset else 'wb'
+
+    def interrupted(self, error):
+        logger.warning(f"Обрыв загрузки {self.url} (попытка {self._attempt + 1}): {error!r}")
+
+    def finish(self):
+        size = os.path.getsize(self.part_path)
+        if self.expected is not None and size != self.expected:
+            logger.warning(f"Размер не совпал ({size} из {self.expected}): {self.part_path}")
+            return False
+        os.replace(self.part_path, self.path)
+        return True
+
+
 class AppSaver:
-    def __init__(self, token):
+    def __init__(self, token, api_url=API_URL, rps=USER_TOKEN_RPS, media_filter=None):
 
         self.token = token
-        vk_session = vk_api.VkApi(token=token)
-        self.vk = vk_session.get_api()
+        self.api = VkRequestScheduler(token, rps=rps, api_url=api_url)
+        self.media_filter = media_filter or MediaFilter()
+        self.video_resolver = VideoResolver(self.api, max_height=self.media_filter.max_video_height)
         self.conversations_label = []
+        self.peer_names = {}
 
-        self.media_types = {
+        # Отфильтрованные типы не запрашиваются и не разбираются вовсе
+        handlers = {
             'photo': self._process_photo,
             'video': self._process_video
         }
+        self.media_types = {t: handlers[t] for t in self.media_filter.types}
 
         self.ydl_opts = {
             'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
             'outtmpl': '%(title)s.%(ext)s',
             'quiet': True,
+            'noprogress': True,
+            # Фрагменты HLS качаются параллельно
+            'concurrent_fragment_downloads': HLS_FRAGMENT_WORKERS,
         }
+        self._ydl_local = threading.local()
 
+        self.http = requests.Session()
+        self.configure_http()
+
+    def configure_http(self, pool_size=DEFAULT_POOL_SIZE):
+        """
+        Keep-alive пул на каждый хост CDN: pool_size соединений должно хватать
+        на все параллельные загрузки, иначе лишние закрываются после ответа.
+        """
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=pool_size)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
 
     def get_all_conversations(self, progress_callback=None):
-        offset = 0
         count = 200
-        total = self._get_total_conversations()
-        processed = 0
+        params = {'count': count, 'extended': 1, 'fields': PEER_FIELDS}
 
         self.conversations_label = []
 
+        # Первая страница отдельно: из неё узнаём общее число диалогов,
+        # остальные страницы уходят пачками через execute
+        first = self.api.call('messages.getConversations', offset=0, **params)
+        total = max(first.get('count', 0), 1)
+        pending_pages = [first]
+        offsets = list(range(count, first.get('count', 0), count))
+
         while True:
-            response = self.vk.messages.getConversations(count=count, offset=offset)
-            items = response.get('items', [])
+            page = []
+            for response in pending_pages:
+                self._cache_peer_names(response)
+                page.extend(self.get_conversation_title(conv) for conv in response.get('items', []))
+            self._resolve_missing_titles(page)
+            self.conversations_label.extend(page)
+
+            if progress_callback:
+                progress = min(int((len(self.conversations_label) / total) * 100), 100)
+                progress_callback(progress)
+
+            if not offsets:
+                break
+            chunk, offsets = offsets[:EXECUTE_MAX_CALLS], offsets[EXECUTE_MAX_CALLS:]
+            pending_pages = self.api.batch([
+                ('messages.getConversations', dict(params, offset=offset)) for offset in chunk
+            ])
 
-            for conv in items:
-                dialog_data = self.get_conversation_title(conv)
-                self.conversations_label.append(dialog_data)
-                processed += 1
+        return self.conversations_label
 
-                if progress_callback:
-                    progress = int((processed / total) * 100)
-                    progress_callback(progress)
+    def get_changed_conversations(self, known):
+        """
+        Диалоги, изменившиеся с прошлой синхронизации; known — {peer_id: last_message_id}
+        из кэша. getConversations отдаёт диалоги от самых свежих, поэтому страницы
+        листаются по одной, пока не встретится неизменившийся незакреплённый диалог:
+        всё, что ниже, тоже не менялось. Закреплённые стоят сверху вне порядка.
+        Возвращает (изменившиеся диалоги, общее число диалогов).
+        """
+        count = 200
+        params = {'count': count, 'extended': 1, 'fields': PEER_FIELDS}
+        changed = []
+        offset = total = 0
+
+        while True:
+            response = self.api.call('messages.getConversations', offset=offset, **params)
+            self._cache_peer_names(response)
+            total = response.get('count', 0)
+            page = [self.get_conversation_title(conv) for conv in response.get('items', [])]
+
+            reached_known = False
+            for dialog in page:
+                if known.get(dialog['peer_id']) != dialog['last_message_id']:
+                    changed.append(dialog)
+                elif not dialog['pinned']:
+                    reached_known = True
 
-            if len(items) < count:
-                break
             offset += count
-            time.sleep(0.33)
+            if reached_known or not page or offset >= total:
+                break
 
-        return self.conversations_label
+        self._resolve_missing_titles(changed)
+        return changed, total
 
-    def _get_total_conversations(self):
-        response = self.vk.messages.getConversations(count=0)
-        return response['count']
+    def get_owner_id(self):
+        """id владельца токена: users.get без user_ids возвращает текущего пользователя"""
+        users = self.api.call('users.get')
+        return users[0]['id'] if users else None
+
+    def _cache_peer_names(self, response):
+        # profiles / groups приходят вместе с extended=1, отдельные запросы не нужны
+        for user in response.get('profiles', []):
+            self.peer_names[user['id']] = f"{user.get('first_name', '')} {user.get('last_name', '')}".strip()
+        for group in response.get('groups', []):
+            self.peer_names[-group['id']] = group.get('name', '')
 
     def get_conversation_title(self, conversation):
-        peer_id = conversation['conversation']['peer']['id']
+        """
+        Заголовок диалога без обращения к API: chat_settings из самой беседы
+        или кэш имён, заполненный из profiles / groups.
+        Если имя неизвестно, title остаётся None до _resolve_missing_titles.
+        """
+        conv = conversation['conversation']
+        peer_id = conv['peer']['id']
         result = {
-            'title': "Ошибка",
-            'peer_id': peer_id
+            'title': None,
+            'peer_id': peer_id,
+            # Для сортировки в окне выбора: дата последнего сообщения и
+            # порядковый номер сообщения в беседе — оценка её размера
+            'last_date': (conversation.get('last_message') or {}).get('date'),
+            'messages': conv.get('last_conversation_message_id'),
+            # По нему кэш (scripts.conversation_cache) узнаёт изменившиеся диалоги
+            'last_message_id': conv.get('last_message_id'),
+            'pinned': bool((conv.get('sort_id') or {}).get('major_id'))
         }
-        try:
-            if peer_id >= 2000000000:
-                chat_id = peer_id - 2000000000
-                chat = self.vk.messages.getChat(chat_id=chat_id)
-                result['title'] = chat.get('title', f"Беседа {chat_id}")
-
-            elif peer_id > 0:
-                users = self.vk.users.get(
-                    user_ids=peer_id,
-                    fields="first_name,last_name",
-                    lang="ru"
-                )
-                if users:
-                    result['title'] = f"{users[0]['first_name']} {users[0]['last_name']}"
-                else:
-                    result['title'] = f"Пользователь {peer_id}"
 
-            else:
-                group_id = abs(peer_id)
-                group = self.vk.groups.getById(group_id=group_id)
-                result['title'] = group[0].get('name', f"Сообщество {group_id}")
+        if peer_id >= CHAT_PEER_OFFSET:
+            title = conv.get('chat_settings', {}).get('title')
+        else:
+            title = self.peer_names.get(peer_id)
 
-        except ApiError as e:
-            logger.error(f"Ошибка для peer_id {peer_id}: {str(e)}")
-            result['title'] = f"Ошибка"
-        except Exception as e:
-            logger.error(f"Непредвиденная ошибка для peer_id {peer_id}: {e}")
-            result['title'] = f"Ошибка"
+        if title:
+            result['title'] = title
         return result
 
-    def get_media(self, peer_id):
+    def _resolve_missing_titles(self, dialogs):
+        missing = [d for d in dialogs if not d['title']]
+        if not missing:
+            return
+
+        user_ids = [d['peer_id'] for d in missing if 0 < d['peer_id'] < CHAT_PEER_OFFSET]
+        group_ids = [-d['peer_id'] for d in missing if d['peer_id'] < 0]
+        chat_ids = [d['peer_id'] - CHAT_PEER_OFFSET for d in missing if d['peer_id'] >= CHAT_PEER_OFFSET]
+
+        calls = []
+        for chunk in _chunks(user_ids, USERS_GET_LIMIT):
+            calls.append(('users.get', {
+                'user_ids': ','.join(map(str, chunk)),
+                'fields': 'first_name,last_name',
+                'lang': 'ru'
+            }))
+        for chunk in _chunks(group_ids, GROUPS_GET_LIMIT):
+            calls.append(('groups.getById', {'group_ids': ','.join(map(str, chunk))}))
+        for chunk in _chunks(chat_ids, CHATS_GET_LIMIT):
+            calls.append(('messages.getChat', {'chat_ids': ','.join(map(str, chunk))}))
+
+        try:
+            results = self.api.batch(calls, raise_errors=False)
+        except Exception as e:
+            logger.error(f"Непредвиденная ошибка пакетного получения имён: {e}")
+            results = []
+
+        for (method, _), result in zip(calls, results):
+            if isinstance(result, ApiError):
+                logger.error(f"Ошибка пакетного получения имён ({method}): {str(result)}")
+                continue
+            for entry in result:
+                if method == 'users.get':
+                    self.peer_names[entry['id']] = f"{entry['first_name']} {entry['last_name']}"
+                elif method == 'groups.getById':
+                    self.peer_names[-entry['id']] = entry.get('name', '')
+                else:
+                    self.peer_names[CHAT_PEER_OFFSET + entry['id']] = entry.get('title', '')
+
+        for dialog in missing:
+            dialog['title'] = self.peer_names.get(dialog['peer_id']) or self._fallback_title(dialog['peer_id'])
+
+    def get_dialogs(self, peer_ids):
+        """Заголовки для заранее известных peer_id без обхода всего списка диалогов"""
+        dialogs = [{'title': self.peer_names.get(peer_id), 'peer_id': peer_id} for peer_id in peer_ids]
+        self._resolve_missing_titles(dialogs)
+        return dialogs
+
+    @staticmethod
+    def _fallback_title(peer_id):
+        if peer_id >= CHAT_PEER_OFFSET:
+            return f"Беседа {peer_id - CHAT_PEER_OFFSET}"
+        if peer_id > 0:
+            return f"Пользователь {peer_id}"
+        return f"Сообщество {abs(peer_id)}"
+
+    def iter_media(self, peer_id, mode=MEDIA_MODE_ATTACHMENTS, include_forwarded=True,
+                   min_message_id=None, types=None):
+        """Аттачи диалога по мере получения ответов API (см. media_steps)"""
+        return self.api.iterate(self.media_steps(peer_id, mode, include_forwarded, min_message_id, types))
+
+    def media_steps(self, peer_id, mode=MEDIA_MODE_ATTACHMENTS, include_forwarded=True,
+                    min_message_id=None, types=None):
         """
-        Возвращает список аттачей (фото / видео / ...).
-        ВАЖНО: используем extended=1, чтобы у видео мог быть access_key.
+        Перечисление аттачей шагами VkRequestPolicy: запросы к API выполняет
+        транспорт (iter_media — VkRequestScheduler, асинхронный движок — AsyncVkApi),
+        найденные аттачи приходят шагами STEP_ITEM, ссылки на видео — пачками
+        через VideoResolver.
+        mode=attachments — курсор messages.getHistoryAttachments (только вложения,
+        не зависит от сдвига offset при новых сообщениях); include_forwarded
+        дополнительно сканирует историю ради вложений пересланных сообщений,
+        которые этот метод не отдаёт.
+        mode=history — полный проход по messages.getHistory.
+        min_message_id — инкрементальный режим: история идёт от новых к старым,
+        поэтому перечисление останавливается на первом уже обработанном сообщении;
+        так же работает нижняя граница дат media_filter.
+        types — перечислить только эти типы (по умолчанию все из media_filter).
         """
-        media = []
-        offset = 0
-        count = 200
+        return self.video_resolver.resolved_steps(
+            self._attachment_steps(peer_id, mode, include_forwarded, min_message_id, types))
+
+    def _attachment_steps(self, peer_id, mode, include_forwarded, min_message_id, types=None):
+        seen = set()
+        if mode == MEDIA_MODE_HISTORY:
+            yield from self._history_steps(peer_id, seen, min_message_id=min_message_id)
+            return
+
+        for media_type in (self.media_types if types is None else types):
+            yield from self._history_attachment_steps(peer_id, media_type, min_message_id, seen)
 
+        if include_forwarded:
+            yield from self._history_steps(peer_id, seen, forwarded_only=True, min_message_id=min_message_id)
+
+    def _history_attachment_steps(self, peer_id, media_type, min_message_id, seen):
+        media_filter = self.media_filter
+        start_from = ''
         while True:
-            response = self.vk.messages.getHistory(
-                peer_id=peer_id,
-                offset=offset,
-                count=count,
-                extended=1
-            )
-
-            items = response.get('items', [])
-            for msg in items:
-                media.extend(self._parse_attachments(msg))
-
-            if len(items) < count:
-                break
+            response = yield from self.api.execute_steps(HISTORY_ATTACHMENTS_CODE % {
+                'peer_id': peer_id,
+                'media_type': json.dumps(media_type),
+                'start_from': json.dumps(start_from),
+                'count': ATTACHMENTS_PAGE_SIZE,
+                'pages': ATTACHMENTS_PAGES_PER_EXECUTE,
+            })
+
+            for entry in response.get('items') or []:
+                message_id = entry.get('message_id')
+                date, exact = self.attachment_date(entry)
+                if min_message_id is not None and message_id <= min_message_id:
+                    return
+                if media_filter.is_too_old(date):
+                    if exact:
+                        return
+                    continue
+                if media_filter.is_too_new(date):
+                    continue
+                result = self.parse_attachment(entry['attachment'], message_id)
+                if result and result['id'] not in seen:
+                    seen.add(result['id'])
+                    yield STEP_ITEM, result
+
+            start_from = response.get('next_from')
+            if not start_from:
+                return
+
+    def _history_steps(self, peer_id, seen, forwarded_only=False, min_message_id=None):
+        # ВАЖНО: используем extended=1, чтобы у видео мог быть access_key.
+        count = 200
+        params = {'peer_id': peer_id, 'count': count, 'extended': 1}
 
-            offset += count
-            time.sleep(0.33)
+        first = yield from self.api.call_steps('messages.getHistory', dict(params, offset=0))
+        pages = [first]
+        offsets = list(range(count, first.get('count', 0), count))
 
-        return media
+        while True:
+            for response in pages:
+                for msg in response.get('items', []):
+                    if min_message_id is not None and msg['id'] <= min_message_id:
+                        return
+                    if self.media_filter.is_too_old(msg.get('date')):
+                        return
+                    if self.media_filter.is_too_new(msg.get('date')):
+                        continue
+                    for result in self.parse_attachments(msg, forwarded_only):
+                        if result['id'] not in seen:
+                            seen.add(result['id'])
+                            yield STEP_ITEM, result
+
+            if not offsets:
+                break
+            chunk, offsets = offsets[:EXECUTE_MAX_CALLS], offsets[EXECUTE_MAX_CALLS:]
+            pages = yield from self.api.batch_steps([
+                ('messages.getHistory', dict(params, offset=offset)) for offset in chunk
+            ])
 
-    def _parse_attachments(self, message):
+    @staticmethod
+    def attachment_date(entry):
+        """
+        (дата, из сообщения ли она) для элемента getHistoryAttachments. Без даты
+        сообщения — дата самого вложения: по ней аттач можно отсеять, но не
+        остановить пагинацию — старое фото могли переслать в свежем сообщении
+        """
+        if entry.get('date'):
+            return entry['date'], True
+        attach = entry.get('attachment') or {}
+        return (attach.get(attach.get('type')) or {}).get('date'), False
+
+    def parse_attachments(self, message, forwarded_only=False, message_id=None):
+        # У пересланных сообщений своего id в диалоге нет — берём id родителя
+        message_id = message_id or message.get('id')
         attachments = []
 
-        for attach in message.get('attachments', []):
-            attach_type = attach.get('type')
-            handler = self.media_types.get(attach_type)
-            if not handler:
-                continue
-            data = attach[attach_type]
-            result = handler(data)
-            if result:
-                attachments.append(result)
+        if not forwarded_only:
+            for attach in message.get('attachments', []):
+                result = self.parse_attachment(attach, message_id)
+                if result:
+                    attachments.append(result)
 
         for fwd_msg in message.get('fwd_messages', []):
-            attachments.extend(self._parse_attachments(fwd_msg))
+            attachments.extend(self.parse_attachments(fwd_msg, message_id=message_id))
 
         return attachments
 
+    def parse_attachment(self, attach, message_id=None):
+        attach_type = attach.get('type')
+        handler = self.media_types.get(attach_type)
+        if not handler:
+            return None
+        result = handler(attach[attach_type])
+        if result:
+            result['message_id'] = message_id
+        return result
+
     def _process_photo(self, photo):
-        sizes = photo.get('sizes', [])
-        if not sizes:
+        best = self.media_filter.pick_photo_size(photo.get('sizes', []))
+        if not best:
             return None
-        best = max(sizes, key=lambda s: s['width'])
 
         return {
             'type': 'photo',
             'url': best.get('url'),
             'date': photo.get('date'),
-            'id': f"photo{photo['owner_id']}_{photo['id']}"
+            'id': f"photo{photo['owner_id']}_{photo['id']}",
+            # Для оценки объёма до загрузки (scripts.planner)
+            'width': best.get('width'),
+            'height': best.get('height')
         }
 
     def _process_video(self, video):
@@ -172,99 +561,86 @@ class AppSaver:
 
             owner_id = video['owner_id']
             video_id = video['id']
-            upload_ts = video.get('date')
             access_key = video.get('access_key')
 
-            # Пытаемся вытащить прямую ссылку (mobile=1)
-            direct_url = None
-            if access_key:
-                direct_url = self._download_private_video(owner_id, video_id, access_key)
-            else:
-                logger.debug(f"У видео {owner_id}_{video_id} нет access_key, возможно, публичное или слишком приватное.")
-
-            # Если не удалось добыть прямой URL, дадим fallback ссылку (обычно не скачивается)
-
-            final_url = direct_url or f"https://vk.com/video{owner_id}_{video_id}"
+            # Прямую ссылку (video.get mobile=1) добывает VideoResolver пачкой,
+            # здесь только ключ; пока ссылки нет — fallback, который не скачивается
+            video_key = f"{owner_id}_{video_id}_{access_key}" if access_key else f"{owner_id}_{video_id}"
 
             return {
                 'type': 'video',
-                'url': final_url,
+                'url': f"https://vk.com/video{owner_id}_{video_id}",
+                'video_key': video_key,
                 'title': video.get('title', ''),
-                'date': upload_ts,
-                'id': f"video{owner_id}_{video_id}"
+                'date': video.get('date'),
+                'id': f"video{owner_id}_{video_id}",
+                'duration': video.get('duration')
             }
 
         except Exception as e:
             logger.error(f"Ошибка обработки видео: {e}")
             return None
 
-    def _download_private_video(self, owner_id, video_id, access_key):
+    @staticmethod
+    def needs_ytdlp(url, path, video_format=None):
+        # Прямые mp4 из video.get(mobile=1) качаются обычным чанковым загрузчиком,
+        # yt-dlp нужен только для HLS и внешних плееров. Решает ключ files
+        # (video_format), а не вид ссылки: у CDN формат бывает только в query.
+        # По ссылке — только если ключа нет (ссылку не удалось обновить)
+        if video_format is not None:
+            return not video_format.startswith('mp4_')
+        return '.m3u8' in url or (path.lower().endswith('.mp4') and '.mp4' not in url)
+
+    def _get_ytdlp(self):
+        """
+        Один YoutubeDL на поток загрузки: создание экземпляра дорогое,
+        а общий экземпляр с разным outtmpl из нескольких потоков — гонка.
+        """
+        ydl = getattr(self._ydl_local, 'ydl', None)
+        if ydl is None:
+            ydl = self._ydl_local.ydl = yt_dlp.YoutubeDL(dict(self.ydl_opts))
+            ydl.add_progress_hook(self._ytdlp_progress_hook)
+        return ydl
+
+    def _ytdlp_progress_hook(self, status):
+        cancel_event = getattr(self._ydl_local, 'cancel_event', None)
+        if cancel_event is not None and cancel_event.is_set():
+            raise DownloadCancelled()
+
+    def download_with_ytdlp(self, url, path, cancel_event=None):
+        ydl = self._get_ytdlp()
+        ydl.params['outtmpl']['default'] = path.rsplit('.', 1)[0] + '.%(ext)s'
+        self._ydl_local.cancel_event = cancel_event
         try:
-            logger.debug(f"_download_private_video: {owner_id}_{video_id}_{access_key}")
-            resp = requests.get(
-                "https://api.vk.com/method/video.get",
-                params={
-                    'access_token': self.token,
-                    'v': '5.131',
-                    'videos': f"{owner_id}_{video_id}_{access_key}",
-                    'mobile': 1
-                },
-                timeout=10
-            )
-            data = resp.json()
-
-            if 'error' in data:
-                err = data['error']
-                logger.warning(f"Ошибка mobile API: {err.get('error_code')} - {err.get('error_msg')}")
-                return None
+            ydl.download([url])
+        finally:
+            self._ydl_local.cancel_event = None
 
-            items = data.get('response', {}).get('items', [])
-            if not items:
-                logger.warning("video.get (mobile=1) не вернул items. Нет доступа или видео удалено.")
-                return None
-
-            # Ищем ссылки в 'files'
-            files_dict = items[0].get('files', {})
-
-            direct_url = (files_dict.get('mp4_1080') or
-                          files_dict.get('mp4_720') or
-                          files_dict.get('mp4_480') or
-                          files_dict.get('mp4_360') or
-                          files_dict.get('mp4_240') or
-                          files_dict.get('external'))
-            if not direct_url:
-                logger.warning("Поле files есть, но прямых ссылок не найдено.")
-                return None
-            logger.debug(f"hui nya {direct_url}")
-            return direct_url
+    @staticmethod
+    def has_direct_url(url):
+        # vk.com/video... — fallback без прямой ссылки, скачать его нельзя
+        return bool(url) and 'vk.com/video' not in url
 
-        except Exception as e:
-            logger.exception(f"Исключение в _download_private_video: {e}")
-            return None
-
-    def download_file(self, url, path, item_date=None):
+    def download_file(self, url, path, item_date=None, cancel_event=None, on_chunk=None,
+                      stamp=True, video_format=None):
+        """
+        stamp=False — теги MP4 и mtime видео не ставятся здесь, их делает
+        отдельный этап пост-обработки (PostProcessor). EXIF и mtime фото
+        ставятся всегда: splice в буфер до записи на диск (save_photo).
+        """
         try:
-            if not url:
+            if not self.has_direct_url(url):
+                logger.warning(f"Прямая ссылка недоступна, пропускаем: {url}")
                 return False
 
-            if 'vk.com/video' in url:
-                logger.warning(f"Прямая ссылка недоступна, пропускаем: {url}")
+            if cancel_event is not None and cancel_event.is_set():
+                return False
+
+            if not self._fetch_with_retries(url, path, item_date, cancel_event, on_chunk, video_format):
                 return False
 
-            if any(fmt in url for fmt in ('.mp4', '.m3u8')):
-                self.ydl_opts['outtmpl'] = path.rsplit('.', 1)[0] + '.%(ext)s'
-                with yt_dlp.YoutubeDL(self.ydl_opts) as ydl:
-                    ydl.download([url])
-            else:
-                r = requests.get(url, stream=True)
-                with open(path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-
-            if item_date:
-                if path.lower().endswith(('.jpg', '.jpeg')):
-                    self._add_photo_metadata(path, item_date)
-                elif path.lower().endswith('.mp4'):
+            if item_date and stamp and not is_photo_path(path):
+                if path.lower().endswith('.mp4'):
                     self._add_video_metadata(path, item_date)
 
                 self._set_file_mtime(path, item_date)
@@ -272,56 +648,99 @@ class AppSaver:
             return True
 
         except Exception as e:
+            metrics.incr('download.errors', host=urlsplit(url).hostname or '')
             logger.error(f"Ошибка при скачивании {url} -> {path}: {e}")
             return False
 
-    def _add_video_metadata(self, file_path, create_date):
-        try:
-            video = MP4(file_path)
-            date_iso = datetime.datetime.utcfromtimestamp(create_date).isoformat()
-
-            video["\xa9day"] = [date_iso]
-            video["\xa9too"] = ["VK Media Saver"]
-            video["\xa9nam"] = ["Media from VK"]
-            video["\xa9cmt"] = [f"Original VK upload date: {date_iso}"]
-            video.save()
-
-            logger.info(f"Метаданные видео успешно добавлены: {file_path}")
-            return True
+    def _fetch_with_retries(self, url, path, item_date, cancel_event, on_chunk, video_format=None):
+        """
+        Повторяет загрузку при временных ошибках (429/5xx, обрыв, таймаут) с
+        экспоненциальным backoff или по Retry-After. Хост, который подряд
+        отвечает ошибками, circuit breaker отключает на время — его файлы ждут
+        пробной попытки, а не таймаутов каждый.
+        """
+        for attempt in DownloadRetry(url, DOWNLOAD_RETRIES, TRANSIENT_ERRORS, requests.HTTPError):
+            for pause in attempt.breaker_pauses():
+                if self._wait_cancelled(cancel_event, pause):
+                    return False
+            with attempt:
+                if self.needs_ytdlp(url, path, video_format):
+                    self.download_with_ytdlp(url, path, cancel_event)
+                    ok = True
+                elif is_photo_path(path):
+                    # Фото небольшие: EXIF вставляется в буфер до первой записи на диск
+                    ok = self._download_photo(url, path, item_date, cancel_event, on_chunk)
+                else:
+                    ok = self._download_resumable(url, path, cancel_event, on_chunk)
+                if ok:
+                    attempt.succeeded()
+                return ok
+            if self._wait_cancelled(cancel_event, attempt.delay):
+                return False
 
-        except Exception as e:
-            logger.error(f"Ошибка записи метаданных видео: {str(e)}")
+    @staticmethod
+    def _wait_cancelled(cancel_event, delay):
+        if cancel_event is None:
+            time.sleep(delay)
             return False
+        return cancel_event.wait(delay)
+
+    def _download_photo(self, url, path, item_date=None, cancel_event=None, on_chunk=None):
+        buffer = bytearray()
+        started = time.monotonic()
+        with self.http.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+            self._observe_ttfb(url, started)
+            check_response(r)
+            expected = expected_size(r.status_code, r.headers)
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if cancel_event is not None and cancel_event.is_set():
+                    logger.debug(f"Загрузка отменена: {path}")
+                    return False
+                buffer.extend(chunk)
+                if on_chunk:
+                    on_chunk(len(chunk))
+
+        save_photo(path, bytes(buffer), item_date, expected)
+        return True
+
+    def _download_resumable(self, url, path, cancel_event=None, on_chunk=None):
+        """Качает в path + '.part' и докачивает через Range после обрыва (ResumableDownload)"""
+        for attempt in ResumableDownload(url, path):
+            if attempt.delay is not None and self._wait_cancelled(cancel_event, attempt.delay):
+                return False
+            headers = attempt.start()
+            started = time.monotonic()
+            try:
+                with self.http.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers) as r:
+                    self._observe_ttfb(url, started)
+                    if not attempt.accept(r.status_code, r.headers):
+                        continue
+                    check_response(r)
+
+                    with open(attempt.part_path, attempt.mode) as f:
+                        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            if cancel_event is not None and cancel_event.is_set():
+                                logger.debug(f"Загрузка отменена, частичный файл сохранён: {attempt.part_path}")
+                                return False
+                            f.write(chunk)
+                            if on_chunk:
+                                on_chunk(len(chunk))
+
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                attempt.interrupted(e)
+                continue
 
-    def _set_file_mtime(self, file_path, timestamp):
-        try:
-            os.utime(file_path, (timestamp, timestamp))
-        except Exception as e:
-            logger.warning(f"Не удалось установить время файла: {e}")
-
-    def _add_photo_metadata(self, file_path, create_date):
-        try:
-            date_str = datetime.datetime.utcfromtimestamp(create_date).strftime('%Y:%m:%d %H:%M:%S')
-
-            exif_dict = {
-                "0th": {
-                    piexif.ImageIFD.DateTime: date_str,
-                    piexif.ImageIFD.Software: "VK Media Saver",
-                },
-                "Exif": {
-                    piexif.ExifIFD.DateTimeOriginal: date_str,
-                    piexif.ExifIFD.DateTimeDigitized: date_str,
-                },
-                "GPS": {},
-            }
+            if attempt.finish():
+                return True
 
-            exif_bytes = piexif.dump(exif_dict)
-            with Image.open(file_path) as img:
-                img.save(file_path, exif=exif_bytes, quality=95)
+    @staticmethod
+    def _observe_ttfb(url, started):
+        # Время до заголовков ответа — задержка CDN без учёта объёма файла
+        metrics.observe('download.ttfb', time.monotonic() - started, host=urlsplit(url).hostname or '')
 
-            logger.info(f"EXIF-данные успешно добавлены: {file_path}")
-            return True
+    def _add_video_metadata(self, file_path, create_date):
+        return add_video_metadata(file_path, create_date)
 
-        except Exception as e:
-            logger.error(f"Ошибка записи EXIF: {str(e)}")
-            return False
+    def _set_file_mtime(self, file_path, timestamp):
+        set_file_mtime(file_path, timestamp)
@@ -0,0 +1,211 @@
+import logging
+import queue
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Сколько аттачей может ждать загрузки; дальше перечисление встаёт на паузу
+DEFAULT_QUEUE_SIZE = 500
+QUEUE_POLL_INTERVAL = 0.2
+
+# Сколько диалогов перечисляются одновременно и сколько элементов берётся
+# из одного за раз при обходе по кругу
+DEFAULT_CONCURRENCY = 3
+ROUND_ROBIN_QUANTUM = 20
+
+_DONE = object()
+
+
+class MediaStream:
+    """
+    Перечисление аттачей диалога в отдельном потоке с ограниченной очередью.
+    Итерация по объекту отдаёт элементы, как только они пришли из API,
+    а заполненная очередь притормаживает producer (backpressure).
+    """
+
+    def __init__(self, items, is_running=None, queue_size=DEFAULT_QUEUE_SIZE, ready=None):
+        self._items = items
+        self._is_running = is_running or (lambda: True)
+        self._queue = queue.Queue(maxsize=queue_size)
+        # ready — общее событие нескольких потоков: «где-то появился элемент»
+        self._ready = ready
+        self._error = None
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self.finished = False
+
+    def __iter__(self):
+        self.start()
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=QUEUE_POLL_INTERVAL)
+                except queue.Empty:
+                    if not self._is_running():
+                        break
+                    continue
+
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            # Потребитель ушёл (стоп или исключение) — producer не должен висеть на полной очереди
+            self._closed.set()
+            self._thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+    @property
+    def qsize(self):
+        return self._queue.qsize()
+
+    @property
+    def error(self):
+        return self._error
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def get_nowait(self):
+        """
+        Для обхода нескольких потоков без блокировки: queue.Empty, если элементов
+        пока нет, None — поток закончился (тогда finished и error выставлены).
+        """
+        item = self._queue.get_nowait()
+        if item is _DONE:
+            self.finished = True
+            self.close()
+            return None
+        return item
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+
+    def _produce(self):
+        try:
+            for item in self._items:
+                if item is None:
+                    continue
+                if not self._put(item):
+                    return
+        except Exception as e:
+            logger.error(f"Ошибка перечисления аттачей: {e}")
+            self._error = e
+        finally:
+            self._put(_DONE, force=True)
+
+    def _put(self, item, force=False):
+        while not self._closed.is_set():
+            if not force and not self._is_running():
+                return False
+            try:
+                self._queue.put(item, timeout=QUEUE_POLL_INTERVAL)
+            except queue.Full:
+                continue
+            if self._ready is not None:
+                self._ready.set()
+            return True
+        return False
+
+
+class InterleavedStreams:
+    """
+    Перечисление нескольких диалогов сразу: следующий диалог не ждёт, пока
+    докачается предыдущий. Элементы выдаются по кругу, не больше quantum
+    подряд из одного диалога, так что гигантская беседа не задерживает
+    остальные. API-лимит общий (token bucket на токен), поэтому параллельные
+    producer'ы его не превышают, а делят между собой.
+
+    sources — пары (key, factory), factory() возвращает итератор элементов и
+    вызывается, только когда до диалога доходит очередь. Итерация отдаёт
+    (key, item); on_finished(key, error) — когда диалог перечислен целиком.
+    promote(key) можно вызвать из другого потока: диалог начинает
+    перечисляться сразу, сверх concurrency, и выдаётся без квоты.
+    """
+
+    def __init__(self, sources, concurrency=DEFAULT_CONCURRENCY, is_running=None,
+                 queue_size=DEFAULT_QUEUE_SIZE, quantum=ROUND_ROBIN_QUANTUM, on_finished=None):
+        self._sources = deque(sources)
+        self.concurrency = max(1, concurrency)
+        self._is_running = is_running or (lambda: True)
+        self._queue_size = queue_size
+        self._quantum = quantum
+        self._on_finished = on_finished
+        self._ready = threading.Event()
+        self._active = deque()
+        self._promotions = queue.Queue()
+        self._urgent = set()
+
+    @property
+    def qsize(self):
+        return sum(stream.qsize for _, stream in self._active)
+
+    def promote(self, key):
+        self._promotions.put(key)
+        self._ready.set()
+
+    def __iter__(self):
+        try:
+            self._fill()
+            while self._active:
+                if not self._is_running():
+                    break
+
+                self._ready.clear()
+                self._apply_promotions()
+                produced = False
+                for _ in range(len(self._active)):
+                    if not self._active:
+                        break
+                    key, stream = self._active[0]
+                    self._active.rotate(-1)
+                    quantum = self._queue_size if key in self._urgent else self._quantum
+                    for _ in range(quantum):
+                        try:
+                            item = stream.get_nowait()
+                        except queue.Empty:
+                            break
+                        produced = True
+                        if item is None:
+                            self._finish(key, stream)
+                            break
+                        yield key, item
+
+                if not produced:
+                    self._ready.wait(QUEUE_POLL_INTERVAL)
+        finally:
+            for _, stream in self._active:
+                stream.close()
+            self._active.clear()
+
+    def _fill(self):
+        while len(self._active) < self.concurrency and self._sources and self._is_running():
+            self._start(*self._sources.popleft())
+
+    def _start(self, key, factory):
+        stream = MediaStream(factory(), is_running=self._is_running,
+                             queue_size=self._queue_size, ready=self._ready)
+        self._active.append((key, stream.start()))
+
+    def _apply_promotions(self):
+        while True:
+            try:
+                key = self._promotions.get_nowait()
+            except queue.Empty:
+                return
+            self._urgent.add(key)
+            for source in self._sources:
+                if source[0] == key:
+                    self._sources.remove(source)
+                    self._start(*source)
+                    break
+
+    def _finish(self, key, stream):
+        self._active.remove((key, stream))
+        if self._on_finished:
+            self._on_finished(key, stream.error)
+        self._fill()
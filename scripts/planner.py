@@ -0,0 +1,202 @@
+import logging
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from scripts.parse_vk_dialogs import DOWNLOAD_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Стартовые коэффициенты, пока нет замеров HEAD: JPEG от VK — около
+# 0.15 байта на пиксель, mp4 mobile-качества — порядка 1.2 Мбит/с
+PHOTO_BYTES_PER_PIXEL = 0.15
+VIDEO_BYTES_PER_SECOND = 150 * 1024
+# Когда в метаданных нет ни размеров фото, ни длительности видео
+DEFAULT_SIZES = {'photo': 150 * 1024, 'video': 10 * 1048576}
+
+# HEAD-запросов на тип аттача за весь план; берутся случайно из всех диалогов
+PROBES_PER_TYPE = 20
+PROBE_WORKERS = 4
+# В режиме выборки из диалога перечисляется не больше стольких аттачей
+DEFAULT_SAMPLE_LIMIT = 1000
+
+
+def metadata_size(item):
+    """Оценка по метаданным аттача или None, если их нет"""
+    if item['type'] == 'photo' and item.get('width') and item.get('height'):
+        return item['width'] * item['height'] * PHOTO_BYTES_PER_PIXEL
+    if item['type'] == 'video' and item.get('duration'):
+        return item['duration'] * VIDEO_BYTES_PER_SECOND
+    return None
+
+
+class DownloadPlanner:
+    """
+    Оценка объёма до загрузки: аттачи перечисляются тем же iter_media
+    (с теми же фильтрами и курсором), размер каждого — по метаданным
+    (пиксели фото, длительность видео), а коэффициенты калибруются
+    HEAD-запросами (Content-Length) к случайной выборке файлов.
+    sample_limit — режим выборки для огромных бесед: из диалога берутся
+    первые sample_limit аттачей (самые новые), остальное экстраполируется
+    по датам до первого сообщения диалога. Это оценка, а не точный счёт:
+    в ней отмечено, какие диалоги посчитаны выборкой.
+    """
+
+    def __init__(self, saver, include_forwarded=True, manifest=None, sample_limit=None,
+                 probes=PROBES_PER_TYPE, is_running=None, on_progress=None):
+        self.saver = saver
+        self.include_forwarded = include_forwarded
+        # С манифестом — только то, что докачает --incremental
+        self.manifest = manifest
+        self.sample_limit = sample_limit
+        self.probes = probes
+        self._is_running = is_running or (lambda: True)
+        self.on_progress = on_progress
+        self._offered = {}
+
+    def plan(self, dialogs):
+        seen = set()
+        candidates = {'photo': [], 'video': []}
+        self._offered = {'photo': 0, 'video': 0}
+        planned = []
+
+        for index, dialog in enumerate(dialogs):
+            if not self._is_running():
+                break
+            planned.append(self._plan_dialog(dialog, seen, candidates))
+            if self.on_progress:
+                self.on_progress(int((index + 1) / len(dialogs) * 100))
+
+        ratios, fallback = self._calibrate(candidates)
+        result = {'dialogs': [], 'items': 0, 'bytes': 0, 'duplicates': 0, 'sampled': False}
+        for dialog in planned:
+            dialog['bytes'] = int(sum(
+                (estimate * ratios[kind] if estimate is not None else fallback[kind]) * scale
+                for kind, estimate, scale in dialog.pop('sizes')
+            ))
+            dialog['items'] = int(dialog['items'])
+            result['dialogs'].append(dialog)
+            result['items'] += dialog['items']
+            result['bytes'] += dialog['bytes']
+            result['duplicates'] += dialog['duplicates']
+            result['sampled'] = result['sampled'] or dialog['sampled']
+
+        result['probes'] = {kind: len(items) for kind, items in candidates.items()}
+        return result
+
+    def _plan_dialog(self, dialog, seen, candidates):
+        peer_id = dialog['peer_id']
+        plan = {'peer_id': peer_id, 'title': dialog.get('title'), 'items': 0, 'duplicates': 0,
+                'sampled': False, 'sizes': []}
+
+        if self.sample_limit:
+            # Типы перечисляются по очереди, поэтому выборка — отдельно по каждому:
+            # иначе лимит выберут фото и видео в оценку не попадут
+            streams = [{'types': (kind,), 'include_forwarded': False} for kind in self.saver.media_types]
+            if self.include_forwarded:
+                streams.append({'types': (), 'include_forwarded': True})
+        else:
+            streams = [{'include_forwarded': self.include_forwarded}]
+
+        try:
+            for options in streams:
+                self._plan_stream(plan, options, seen, candidates)
+        except Exception as e:
+            logger.error(f"Оценка диалога {peer_id} прервана: {e}")
+        plan.pop('first_date', None)
+        return plan
+
+    def _plan_stream(self, plan, options, seen, candidates):
+        peer_id = plan['peer_id']
+        min_message_id = self.manifest.last_message_id(peer_id) if self.manifest else None
+        sizes = []
+        sampled = False
+        newest = oldest = None
+
+        for item in self.saver.iter_media(peer_id, min_message_id=min_message_id, **options):
+            if not self._is_running():
+                break
+            if self.sample_limit and len(sizes) >= self.sample_limit:
+                sampled = True
+                break
+            if not self.saver.has_direct_url(item['url']):
+                continue
+            if item['id'] in seen:
+                # Повтор из другого диалога станет ссылкой (DedupIndex), места не займёт
+                plan['duplicates'] += 1
+                continue
+            seen.add(item['id'])
+
+            sizes.append((item['type'], metadata_size(item)))
+            self._reservoir(candidates[item['type']], item)
+            if item.get('date'):
+                newest = max(newest or item['date'], item['date'])
+                oldest = min(oldest or item['date'], item['date'])
+
+        scale = self._extrapolate(plan, newest, oldest) if sampled and newest and oldest else 1.0
+        plan['sampled'] = plan['sampled'] or sampled
+        plan['items'] += len(sizes) * scale
+        plan['sizes'].extend((kind, estimate, scale) for kind, estimate in sizes)
+
+    def _reservoir(self, bucket, item):
+        # Равномерная выборка кандидатов для HEAD по всем диалогам без хранения всех ссылок
+        if self.saver.needs_ytdlp(item['url'], f"probe.{'jpg' if item['type'] == 'photo' else 'mp4'}",
+                                   item.get('video_format')):
+            return
+        entry = (item['url'], metadata_size(item))
+        self._offered[item['type']] += 1
+        if len(bucket) < self.probes:
+            bucket.append(entry)
+        else:
+            index = random.randrange(self._offered[item['type']])
+            if index < self.probes:
+                bucket[index] = entry
+
+    def _extrapolate(self, plan, newest, oldest):
+        """Во сколько раз вся история диалога длиннее выборки (по датам)"""
+        if 'first_date' not in plan:
+            try:
+                first = self.saver.api.call('messages.getHistory', peer_id=plan['peer_id'], count=1, rev=1)
+                plan['first_date'] = first['items'][0]['date']
+            except Exception as e:
+                logger.warning(f"Не удалось узнать начало диалога {plan['peer_id']}: {e}")
+                plan['first_date'] = None
+        first_date = plan['first_date']
+        if first_date is None:
+            return 1.0
+
+        date_from = self.saver.media_filter.date_from
+        if date_from is not None:
+            first_date = max(first_date, date_from)
+        sampled_span = max(newest - oldest, 1)
+        return max((newest - first_date) / sampled_span, 1.0)
+
+    def _calibrate(self, candidates):
+        ratios = {'photo': 1.0, 'video': 1.0}
+        fallback = dict(DEFAULT_SIZES)
+
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix='probe') as executor:
+            for kind, entries in candidates.items():
+                if not entries:
+                    continue
+                sizes = list(executor.map(self._probe, [url for url, _ in entries]))
+                measured = [(size, estimate) for size, (_, estimate) in zip(sizes, entries) if size]
+                if not measured:
+                    continue
+
+                fallback[kind] = sum(size for size, _ in measured) / len(measured)
+                with_metadata = [(size, estimate) for size, estimate in measured if estimate]
+                if with_metadata:
+                    ratios[kind] = (sum(size for size, _ in with_metadata)
+                                    / sum(estimate for _, estimate in with_metadata))
+                logger.info(f"Калибровка {kind}: {len(measured)} HEAD, коэффициент {ratios[kind]:.2f}")
+        return ratios, fallback
+
+    def _probe(self, url):
+        try:
+            response = self.saver.http.head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+            length = response.headers.get('Content-Length')
+            if response.ok and length and length.isdigit():
+                return int(length)
+        except Exception as e:
+            logger.debug(f"HEAD {url}: {e}")
+        return None
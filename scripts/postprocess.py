@@ -0,0 +1,138 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+
+from scripts.metadata import timed_stamp_file
+from scripts.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class PostProcessor:
+    """
+    Отдельный этап конвейера: теги MP4 и mtime видео (фото получают EXIF и
+    mtime сразу при записи). Потоки загрузки только кладут (path, date) в
+    очередь и сразу берут следующий файл, а CPU-работа идёт в пуле процессов
+    по числу ядер.
+    """
+
+    def __init__(self, workers=None, on_progress=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.on_progress = on_progress
+
+        self._queue = queue.Queue()
+        # spawn, а не fork: воркеры создаются лениво из потока-диспетчера, пока
+        # потоки загрузки и Qt держат локи — форк унёс бы их запертыми в дочерний процесс
+        self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        # Не больше двух задач на процесс — остальное ждёт в очереди, а не в пуле
+        self._slots = threading.BoundedSemaphore(self.workers * 2)
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._busy_time = 0.0
+        # path -> колбэки when_done, пока файл в очереди или в работе
+        self._pending = {}
+
+        self.submitted = 0
+        self.done = 0
+        self.failed = 0
+        self.errors = []
+
+        self._dispatcher = threading.Thread(target=self._dispatch, name='postprocess', daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, path, create_date, photo_exif=False):
+        if not create_date:
+            return
+        with self._lock:
+            self.submitted += 1
+            self._pending.setdefault(path, [])
+        self._queue.put((path, create_date, photo_exif))
+        metrics.gauge('queue.postprocess', self._queue.qsize())
+
+    def when_done(self, path, callback):
+        """
+        callback() после пост-обработки path (с ошибкой или без); сразу, если
+        файл не в очереди. Файлы, снятые отменой, колбэк не получают.
+        """
+        with self._lock:
+            callbacks = self._pending.get(path)
+            if callbacks is not None:
+                callbacks.append(callback)
+                return
+        callback()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'submitted': self.submitted,
+                'done': self.done,
+                'failed': self.failed,
+                'queued': self._queue.qsize(),
+                'busy_time': self._busy_time,
+            }
+
+    def close(self, cancel=False):
+        if cancel:
+            self._drain()
+        self._queue.put(_STOP)
+        self._dispatcher.join()
+        self._executor.shutdown(wait=True, cancel_futures=cancel)
+
+        if self.failed:
+            logger.warning(f"Пост-обработка: ошибок {self.failed} из {self.submitted}")
+
+    def _drain(self):
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def _dispatch(self):
+        while True:
+            task = self._queue.get()
+            if task is _STOP:
+                return
+
+            self._slots.acquire()
+            path = task[0]
+            started = time.monotonic()
+            try:
+                future = self._executor.submit(timed_stamp_file, *task)
+            except RuntimeError as e:
+                # Пул уже закрыт (отмена) — файл остаётся без тегов
+                self._task_done(path, started, e)
+                continue
+            future.add_done_callback(lambda f, path=path, started=started: self._task_done(
+                path, started, CancelledError() if f.cancelled() else f.exception(),
+                None if f.cancelled() or f.exception() else f.result()
+            ))
+
+    def _task_done(self, path, started, error, cpu_time=None):
+        self._slots.release()
+        if cpu_time is not None:
+            # Чистое время в процессе, без ожидания свободного воркера
+            metrics.observe('postprocess.seconds', cpu_time, kind=os.path.splitext(path)[1].lower())
+        with self._lock:
+            self._busy_time += time.monotonic() - started
+            if error is None:
+                self.done += 1
+            else:
+                self.failed += 1
+                self.errors.append((path, str(error)))
+                logger.error(f"Ошибка пост-обработки {path}: {error!r}")
+            callbacks = self._pending.pop(path, [])
+
+        if not isinstance(error, CancelledError):
+            for callback in callbacks:
+                callback()
+
+        if self.on_progress:
+            self.on_progress(self.stats())
@@ -0,0 +1,254 @@
+import email.utils
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+from scripts.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Коды VK, после которых запрос имеет смысл повторить:
+# 6 — слишком много запросов, 9 — flood control, 10 — внутренняя ошибка сервера
+TOO_MANY_REQUESTS = 6
+FLOOD_CONTROL = 9
+INTERNAL_SERVER_ERROR = 10
+RETRYABLE_API_ERRORS = frozenset((TOO_MANY_REQUESTS, FLOOD_CONTROL, INTERNAL_SERVER_ERROR))
+
+RETRYABLE_HTTP_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
+# Circuit breaker: после стольких ошибок подряд хост считается недоступным
+# на BREAKER_RESET_TIMEOUT секунд, затем пропускается одна пробная попытка
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30.0
+# Загрузка ждёт открытый breaker своего хоста не дольше этого, потом сдаётся;
+# пока идёт чужая пробная попытка, исход проверяется раз в BREAKER_POLL_INTERVAL
+BREAKER_MAX_WAIT = 4 * BREAKER_RESET_TIMEOUT
+BREAKER_POLL_INTERVAL = 1.0
+
+
+class RetryableHTTPError(IOError):
+    def __init__(self, status, url, retry_after=None):
+        super().__init__(f"HTTP {status}: {url}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class IncompleteDownloadError(IOError):
+    """Соединение закрылось раньше, чем пришёл весь файл"""
+
+
+# Сетевые ошибки, которые лечатся повтором; остальные HTTPError (403, 404) — нет
+TRANSIENT_ERRORS = (
+    RetryableHTTPError,
+    IncompleteDownloadError,
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Экспоненциальная задержка с полным jitter: повторы разных потоков не совпадают"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def parse_retry_after(value):
+    """Retry-After: число секунд или HTTP-дата"""
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        moment = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(moment.timestamp() - time.time(), 0.0)
+
+
+def check_status(status, url, headers):
+    """429 и 5xx — RetryableHTTPError с Retry-After; остальное проверяет raise_for_status транспорта"""
+    if status in RETRYABLE_HTTP_STATUSES:
+        raise RetryableHTTPError(status, url, parse_retry_after(headers.get('Retry-After')))
+
+
+def check_response(response):
+    """raise_for_status, но 429 и 5xx — как RetryableHTTPError с Retry-After"""
+    check_status(response.status_code, response.url, response.headers)
+    response.raise_for_status()
+
+
+def retry_delay(error, attempt):
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is not None:
+        return min(retry_after, BACKOFF_CAP)
+    return backoff_delay(attempt)
+
+
+class CircuitBreaker:
+    """
+    Закрыт — запросы идут; после threshold ошибок подряд открывается, и
+    запросы к хосту отклоняются (ждут retry_in()); через reset_timeout пропускает одну
+    пробную попытку (half-open): успех закрывает, ошибка снова открывает.
+    Попытку, которая не дала ответа о хосте (отмена, ошибка записи), нужно
+    завершить release(), иначе хост останется заблокированным до конца прогона.
+    """
+
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._probing = True
+            return True
+
+    def retry_in(self):
+        """Через сколько секунд allow() может пропустить: 0 — уже сейчас"""
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            remaining = self.reset_timeout - (time.monotonic() - self._opened_at)
+            if remaining > 0:
+                return remaining
+            # Пробная попытка уже идёт — её исход станет известен позже
+            return BREAKER_POLL_INTERVAL if self._probing else 0.0
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def release(self):
+        """Пробная попытка закончилась ничем: следующая allow() пробует снова"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(host):
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker()
+        return breaker
+
+
+def reset_breakers():
+    """Новый запуск начинает с закрытых breaker'ов: прошлые отказы хоста не в счёт"""
+    with _breakers_lock:
+        _breakers.clear()
+
+
+class DownloadRetry:
+    """
+    Повторы одной загрузки, общие для обоих движков: breaker хоста, число
+    попыток и пауза между ними. Движок только качает и ждёт delay своим
+    способом (cancel_event.wait или asyncio.sleep):
+
+        for attempt in DownloadRetry(url, retries, TRANSIENT_ERRORS, HTTPError):
+            for pause in attempt.breaker_pauses():
+                wait(pause)                      # breaker хоста открыт
+            with attempt:
+                ok = download()
+                if ok:
+                    attempt.succeeded()
+                return ok
+            wait(attempt.delay)
+
+    Временную ошибку with записывает в breaker и гасит, на последней попытке
+    пробрасывает. HTTP-ошибка (403, 404) хост не винит. Выход без
+    succeeded() (отмена, ошибка записи) только снимает пробную попытку.
+    Пока breaker хоста открыт, загрузка ждёт half-open, а не падает сразу:
+    короткий сбой CDN не должен сбрасывать очередь хоста в неудачные.
+    """
+
+    def __init__(self, url, retries, transient_errors, http_errors):
+        self.url = url
+        self.host = urlsplit(url).hostname or ''
+        self.breaker = get_breaker(self.host)
+        self.retries = retries
+        self.transient_errors = transient_errors
+        self.http_errors = http_errors
+        self.attempt = 0
+        self.delay = None
+        self._started = None
+        self._resolved = False
+        self._breaker_wait = 0.0
+
+    def __iter__(self):
+        for attempt in range(self.retries + 1):
+            self.attempt = attempt
+            self.delay = None
+            self._resolved = False
+            yield self
+
+    def breaker_pauses(self):
+        """
+        Паузы до разрешения breaker'а; после них попытка может начинаться.
+        Ждать дольше BREAKER_MAX_WAIT за всю загрузку не станет — IOError
+        """
+        while not self.breaker.allow():
+            if self._breaker_wait >= BREAKER_MAX_WAIT:
+                raise IOError(f"CDN {self.host} временно недоступен (circuit breaker)")
+            pause = min(self.breaker.retry_in() or BREAKER_POLL_INTERVAL, BREAKER_MAX_WAIT - self._breaker_wait)
+            if not self._breaker_wait:
+                metrics.incr('download.circuit_open', host=self.host)
+                logger.warning(f"CDN {self.host} временно недоступен (circuit breaker), ожидание {pause:.0f} с")
+            self._breaker_wait += pause
+            yield pause
+
+    def __enter__(self):
+        self._started = time.monotonic()
+        return self
+
+    def succeeded(self):
+        self._resolved = True
+        self.breaker.record_success()
+        metrics.observe('download.latency', time.monotonic() - self._started, host=self.host)
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and issubclass(exc_type, self.transient_errors):
+            self.breaker.record_failure()
+            if self.attempt == self.retries:
+                return False
+            self.delay = retry_delay(exc, self.attempt)
+            logger.warning(f"Ошибка загрузки {self.url} ({exc!r}), повтор через {self.delay:.1f} с")
+            metrics.incr('download.retries', host=self.host)
+            return True
+        if exc_type is not None and issubclass(exc_type, self.http_errors):
+            # Хост отвечает, недоступен только этот файл
+            self.breaker.record_success()
+        elif not self._resolved:
+            self.breaker.release()
+        return False
@@ -0,0 +1,266 @@
+import logging
+import os
+import queue
+import sqlite3
+import tarfile
+import threading
+import time
+
+from scripts.dedup import file_sha256
+
+logger = logging.getLogger(__name__)
+
+SHARDS_DIR = 'shards'
+# Скачанные, но ещё не упакованные файлы — по папкам диалогов
+STAGING_DIR = 'staging'
+INDEX_NAME = 'index.sqlite'
+SHARD_NAME = 'media-{:05d}.tar'
+# Шард закрывается для записи, когда перевалит за этот размер
+DEFAULT_SHARD_SIZE = 1024 ** 3
+
+BLOCK = tarfile.BLOCKSIZE
+END_OF_ARCHIVE = b'\0' * (2 * BLOCK)
+COPY_CHUNK = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    shard_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS objects (
+    media_id TEXT PRIMARY KEY,
+    shard_id INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    name TEXT NOT NULL,
+    stored_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_sha256 ON objects (sha256);
+CREATE TABLE IF NOT EXISTS entries (
+    peer_id INTEGER NOT NULL,
+    media_id TEXT NOT NULL,
+    type TEXT,
+    message_id INTEGER,
+    date INTEGER,
+    PRIMARY KEY (peer_id, media_id)
+);
+CREATE INDEX IF NOT EXISTS entries_date ON entries (date);
+CREATE INDEX IF NOT EXISTS entries_media ON entries (media_id);
+"""
+
+ENTRY_COLUMNS = ('peer_id', 'media_id', 'type', 'message_id', 'date', 'size', 'sha256', 'shard', 'offset', 'name')
+
+_STOP = object()
+
+
+class ShardIndex:
+    """
+    SQLite-индекс шардов: objects — где лежат байты объекта (шард, смещение
+    данных, размер, sha256), entries — в каких диалогах и сообщениях он
+    встречался. Один объект из нескольких диалогов хранится один раз.
+    Шарды — обычные tar: `tar xf media-00001.tar` распакует всё и без индекса.
+    """
+
+    def __init__(self, save_path):
+        self.path = os.path.join(save_path, SHARDS_DIR)
+        self.staging_path = os.path.join(self.path, STAGING_DIR)
+        os.makedirs(self.path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(self.path, INDEX_NAME), check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def has_entry(self, peer_id, media_id):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT 1 FROM entries WHERE peer_id = ? AND media_id = ?', (peer_id, media_id)
+            ).fetchone() is not None
+
+    def has_object(self, media_id):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT 1 FROM objects WHERE media_id = ?', (media_id,)
+            ).fetchone() is not None
+
+    def add_entry(self, peer_id, item):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO entries (peer_id, media_id, type, message_id, date) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (peer_id, item['id'], item.get('type'), item.get('message_id'), item.get('date'))
+            )
+            self._conn.commit()
+
+    def find_sha256(self, sha256):
+        """(shard_id, offset, size) объекта с тем же содержимым или None"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT shard_id, offset, size FROM objects WHERE sha256 = ?', (sha256,)
+            ).fetchone()
+
+    def store_object(self, media_id, shard_id, offset, size, sha256, name):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO objects (media_id, shard_id, offset, size, sha256, name, stored_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (media_id, shard_id, offset, size, sha256, name, int(time.time()))
+            )
+            self._conn.commit()
+
+    def open_shard(self, shard_size):
+        """(shard_id, имя, длина без конца архива) шарда для дозаписи; при переполнении — новый"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT shard_id, name, size FROM shards ORDER BY shard_id DESC LIMIT 1'
+            ).fetchone()
+            if row and row[2] < shard_size:
+                return row
+            shard_id = (row[0] + 1) if row else 1
+            name = SHARD_NAME.format(shard_id)
+            self._conn.execute('INSERT INTO shards (shard_id, name, size) VALUES (?, ?, 0)', (shard_id, name))
+            self._conn.commit()
+        logger.info(f"Новый шард: {name}")
+        return shard_id, name, 0
+
+    def set_shard_size(self, shard_id, size):
+        with self._lock:
+            self._conn.execute('UPDATE shards SET size = ? WHERE shard_id = ?', (size, shard_id))
+            self._conn.commit()
+
+    def find(self, peer_id=None, date_from=None, date_to=None, media_type=None):
+        """Записи с расположением в шардах, от новых к старым"""
+        conditions, params = [], []
+        for column, op, value in (('e.peer_id', '=', peer_id), ('e.date', '>=', date_from),
+                                  ('e.date', '<=', date_to), ('e.type', '=', media_type)):
+            if value is not None:
+                conditions.append(f'{column} {op} ?')
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT e.peer_id, e.media_id, e.type, e.message_id, e.date, o.size, o.sha256, '
+                's.name, o.offset, o.name FROM entries e '
+                'JOIN objects o ON o.media_id = e.media_id JOIN shards s ON s.shard_id = o.shard_id '
+                f'{where} ORDER BY e.date DESC', params
+            ).fetchall()
+        return [dict(zip(ENTRY_COLUMNS, row)) for row in rows]
+
+    def read(self, media_id):
+        """Байты объекта: одно чтение по смещению, без обхода tar"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT s.name, o.offset, o.size FROM objects o JOIN shards s ON s.shard_id = o.shard_id '
+                'WHERE o.media_id = ?', (media_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        name, offset, size = row
+        with open(os.path.join(self.path, name), 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ShardWriter:
+    """
+    Упаковка скачанных файлов в append-only tar-шарды вместо россыпи мелких
+    файлов. Пишет один поток: add() только ставит файл в очередь. Запись
+    идёт с длины шарда из индекса, а не с конца файла, так что хвост
+    прерванной записи просто перезаписывается следующей. Упакованный файл
+    удаляется из папки диалога.
+    """
+
+    def __init__(self, index, shard_size=DEFAULT_SHARD_SIZE):
+        self.index = index
+        self.shard_size = shard_size
+        self.packed = 0
+        self.bytes_packed = 0
+        self.failed = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='shards', daemon=True)
+        self._thread.start()
+
+    def add(self, path, peer_id, item):
+        self._queue.put((path, peer_id, item))
+
+    def pack(self, path, peer_id, item):
+        """Упаковать сразу, в вызывающем потоке; False — файл остался на месте"""
+        try:
+            self._pack(path, peer_id, item)
+            return True
+        except Exception as e:
+            # Файл остаётся на месте, следующий запуск упакует его заново
+            self.failed += 1
+            logger.error(f"Не удалось упаковать {path}: {e!r}")
+            return False
+
+    def stats(self):
+        return {'packed': self.packed, 'bytes_packed': self.bytes_packed,
+                'queued': self._queue.qsize(), 'failed': self.failed}
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+        # Опустевшие после упаковки папки; неупакованное остаётся до следующего запуска
+        staging = self.index.staging_path
+        for root, _, _ in sorted(os.walk(staging), key=lambda entry: -len(entry[0])):
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is _STOP:
+                return
+            self.pack(*task)
+
+    def _pack(self, path, peer_id, item):
+        index = self.index
+        if not index.has_object(item['id']):
+            sha256 = file_sha256(path)
+            same = index.find_sha256(sha256)
+            if same:
+                # Другой id, то же содержимое — ещё одна ссылка на уже записанные байты
+                index.store_object(item['id'], *same, sha256, os.path.basename(path))
+            else:
+                self._append(path, item, sha256)
+
+        index.add_entry(peer_id, item)
+        os.remove(path)
+
+    def _append(self, path, item, sha256):
+        size = os.path.getsize(path)
+        shard_id, name, end = self.index.open_shard(self.shard_size)
+        member = os.path.join(os.path.basename(os.path.dirname(path)), os.path.basename(path))
+
+        info = tarfile.TarInfo(member.replace(os.sep, '/'))
+        info.size = size
+        info.mtime = item.get('date') or int(os.path.getmtime(path))
+        header = info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8')
+
+        shard_path = os.path.join(self.index.path, name)
+        with open(shard_path, 'r+b' if os.path.exists(shard_path) else 'wb') as f:
+            f.seek(end)
+            f.write(header)
+            offset = f.tell()
+            with open(path, 'rb') as src:
+                for chunk in iter(lambda: src.read(COPY_CHUNK), b''):
+                    f.write(chunk)
+            padding = -size % BLOCK
+            f.write(b'\0' * padding)
+            new_end = f.tell()
+            # Конец архива пишется каждый раз: шард — валидный tar в любой момент
+            f.write(END_OF_ARCHIVE)
+            f.truncate()
+
+        self.index.set_shard_size(shard_id, new_end)
+        self.index.store_object(item['id'], shard_id, offset, size, sha256, info.name)
+        self.packed += 1
+        self.bytes_packed += size
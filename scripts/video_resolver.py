@@ -0,0 +1,164 @@
+import logging
+import threading
+import time
+
+from vk_api import ApiError
+
+from scripts.vk_scheduler import STEP_ITEM, RequestCancelled, advance
+
+logger = logging.getLogger(__name__)
+
+# video.get принимает до 200 id за вызов; до 25 вызовов уходят одним execute
+VIDEO_GET_LIMIT = 200
+RESOLVE_BATCH_SIZE = 200
+
+# Прямые ссылки mp4 живут ограниченное время — кэш не должен их пережить
+DEFAULT_TTL = 3600
+MISSING_TTL = 300
+
+VIDEO_QUALITIES = ('mp4_1080', 'mp4_720', 'mp4_480', 'mp4_360', 'mp4_240', 'mp4_144')
+
+
+def pick_video_file(files, max_height=None):
+    """
+    (ключ files, url): mp4_* качается напрямую, hls и external — через yt-dlp.
+    max_height — предел качества; если ничего в него не укладывается, берётся самое низкое
+    """
+    available = [quality for quality in VIDEO_QUALITIES if files.get(quality)]
+    if max_height:
+        fitting = [quality for quality in available if int(quality[4:]) <= max_height]
+        available = fitting or available[-1:]
+    for key in available[:1] + ['external', 'hls']:
+        if files.get(key):
+            return key, files[key]
+    return None, None
+
+
+def apply_video_file(item, files, max_height=None):
+    """url и video_format аттача из ответа video.get; False — прямой ссылки нет"""
+    video_format, url = pick_video_file(files, max_height) if files else (None, None)
+    if not url:
+        return False
+    item['url'] = url
+    item['video_format'] = video_format
+    return True
+
+
+class VideoResolver:
+    """
+    Получение прямых ссылок на видео отдельно от разбора истории:
+    ключи owner_id_video_id_access_key копятся и уходят пачками в video.get(mobile=1),
+    результат кэшируется с TTL. Запросы — шагами VkRequestPolicy (*_steps),
+    так что тот же код выполняют и потоковый, и асинхронный транспорт.
+    """
+
+    def __init__(self, api, ttl=DEFAULT_TTL, max_height=None):
+        self.api = api
+        self.ttl = ttl
+        # Предел качества mp4 (MediaFilter.max_video_height)
+        self.max_height = max_height
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, keys):
+        """Возвращает {key: files}; для недоступных видео files = None"""
+        return self.api.run(self.resolve_steps(keys))
+
+    def resolve_steps(self, keys):
+        now = time.monotonic()
+        result = {}
+        missing = []
+
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                cached = self._cache.get(key)
+                if cached and cached[1] > now:
+                    result[key] = cached[0]
+                else:
+                    missing.append(key)
+
+        if missing:
+            try:
+                fetched = yield from self._fetch_steps(missing)
+            except RequestCancelled:
+                # Загрузку остановили: недоступными эти видео не запоминаем
+                return result
+            now = time.monotonic()
+            with self._lock:
+                for key in missing:
+                    files = fetched.get(key)
+                    self._cache[key] = (files, now + (self.ttl if files else MISSING_TTL))
+                    result[key] = files
+
+        return result
+
+    def refresh_steps(self, items):
+        """Свежие ссылки для аттачей из сохранённой очереди или списка неудачных"""
+        videos = [item for item in items if item.get('video_key')]
+        resolved = yield from self.resolve_steps([item['video_key'] for item in videos])
+        for item in videos:
+            apply_video_file(item, resolved.get(item['video_key']), self.max_height)
+
+    def resolved_steps(self, steps, batch_size=RESOLVE_BATCH_SIZE):
+        """
+        Обёртка над шагами перечисления: запросы проходят насквозь, фото —
+        сразу, видео копятся до batch_size и получают url одним пакетным запросом.
+        """
+        pending = []
+        reply = error = None
+        while True:
+            try:
+                step = advance(steps, reply, error)
+            except StopIteration:
+                break
+            reply = error = None
+            if step[0] != STEP_ITEM or step[1].get('type') != 'video' or not step[1].get('video_key'):
+                try:
+                    reply = yield step
+                except Exception as e:
+                    error = e
+                continue
+
+            pending.append(step[1])
+            if len(pending) >= batch_size:
+                yield from self._apply_steps(pending)
+                pending = []
+
+        if pending:
+            yield from self._apply_steps(pending)
+
+    def _apply_steps(self, items):
+        resolved = yield from self.resolve_steps([item['video_key'] for item in items])
+        for item in items:
+            # Если не удалось добыть прямой URL, остаётся fallback ссылка (не скачивается)
+            if not apply_video_file(item, resolved.get(item['video_key']), self.max_height):
+                logger.warning(f"Прямая ссылка на видео {item['id']} не получена")
+            yield STEP_ITEM, item
+
+    def _fetch_steps(self, keys):
+        calls = [
+            ('video.get', {'videos': ','.join(keys[i:i + VIDEO_GET_LIMIT]), 'mobile': 1})
+            for i in range(0, len(keys), VIDEO_GET_LIMIT)
+        ]
+        try:
+            responses = yield from self.api.batch_steps(calls, raise_errors=False)
+        except RequestCancelled:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка пакетного video.get: {e}")
+            return {}
+
+        by_id = {key.rsplit('_', 1)[0] if key.count('_') > 1 else key: key for key in keys}
+        fetched = {}
+
+        for response in responses:
+            if isinstance(response, ApiError):
+                logger.warning(f"Ошибка mobile API: {response.code} - {response.error.get('error_msg')}")
+                continue
+            for video in response.get('items', []):
+                key = by_id.get(f"{video['owner_id']}_{video['id']}")
+                if key and video.get('files'):
+                    fetched[key] = video['files']
+
+        logger.debug(f"video.get: получено {len(fetched)} из {len(keys)} ссылок")
+        return fetched
@@ -0,0 +1,298 @@
+import json
+import logging
+import threading
+import time
+
+import requests
+from vk_api import ApiError
+
+from scripts.metrics import metrics
+from scripts.retry import (RETRYABLE_API_ERRORS, TOO_MANY_REQUESTS, TRANSIENT_ERRORS, backoff_delay,
+                           check_response, retry_delay)
+
+logger = logging.getLogger(__name__)
+
+API_URL = 'https://api.vk.com/method/'
+API_VERSION = '5.131'
+
+# Лимит VK: пользовательский токен — 3 запроса в секунду, execute — до 25 вызовов
+USER_TOKEN_RPS = 3
+EXECUTE_MAX_CALLS = 25
+
+# Повторы при ошибках 6/9/10, 429/5xx и обрывах сети
+API_RETRIES = 5
+
+
+class TokenBucket:
+    """
+    Token bucket на один токен VK. capacity=1 не даёт накопить «всплеск»,
+    иначе за скользящую секунду можно превысить лимит.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Неблокирующая попытка: 0 — токен взят, иначе сколько подождать.
+        Ждёт транспорт (шаг STEP_SLEEP в VkRequestPolicy) — time.sleep в потоке
+        или пауза в event loop, лимит на токен при этом общий.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def penalize(self):
+        """После ошибки 6 забираем накопленное, чтобы следующий запрос подождал"""
+        with self._lock:
+            self._tokens = min(self._tokens, 0) - 1
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_rate_limiter(token, rps=USER_TOKEN_RPS):
+    # Один bucket на токен: ConversationThread и DownloadThread делят общий лимит
+    with _buckets_lock:
+        bucket = _buckets.get(token)
+        if bucket is None:
+            bucket = _buckets[token] = TokenBucket(rps)
+        return bucket
+
+
+def execute_code(calls):
+    return 'return [{}];'.format(','.join(
+        f"API.{method}({json.dumps(params, ensure_ascii=False)})" for method, params in calls
+    ))
+
+
+def execute_results(calls, raw):
+    """Ответ execute по вызовам: упавшие (false в response) — объекты ApiError"""
+    responses = raw.get('response') or []
+    errors = iter(raw.get('execute_errors', []))
+    results = []
+
+    for (method, params), response in zip(calls, responses):
+        if response is False:
+            error = next(errors, {'error_code': 0, 'error_msg': 'execute: unknown error'})
+            results.append(ApiError(None, method, params, raw, error))
+        else:
+            results.append(response)
+    return results
+
+
+# Шаги политики запросов (см. VkRequestPolicy): транспорт выполняет их и
+# отправляет результат обратно в генератор
+STEP_SLEEP = 'sleep'
+STEP_POST = 'post'
+# Не запрос, а найденный аттач — его отдаёт наружу iterate()
+STEP_ITEM = 'item'
+
+
+class RequestCancelled(Exception):
+    """Пауза перед запросом прервана остановкой загрузки"""
+
+
+def advance(steps, reply=None, error=None):
+    """Следующий шаг генератора: ответ транспорта уходит в него через send, ошибка — через throw"""
+    if error is not None:
+        return steps.throw(error)
+    return steps.send(reply)
+
+
+class VkRequestPolicy:
+    """
+    Политика запросов к VK API без ввода-вывода: token bucket, execute-пачки и
+    повторы записаны генераторами шагов (STEP_SLEEP, секунды) и
+    (STEP_POST, method, values). Их выполняет транспорт — VkRequestScheduler
+    на requests или async_engine.AsyncVkApi на aiohttp, — отвечая разобранным
+    JSON или бросая в генератор сетевую ошибку. Результат шагов — значение
+    StopIteration, так что политики вкладываются через yield from, как и
+    перечисление истории в AppSaver.media_steps.
+    """
+
+    # Сетевые ошибки транспорта, которые лечатся повтором
+    transient_errors = TRANSIENT_ERRORS
+
+    def __init__(self, token, rps=USER_TOKEN_RPS, api_url=API_URL, api_version=API_VERSION):
+        self.token = token
+        self.api_url = api_url
+        self.api_version = api_version
+        self.limiter = get_rate_limiter(token, rps)
+
+    def call_steps(self, method, params):
+        metrics.incr('api.calls', method=method)
+        return (yield from self.request_steps(method, params))
+
+    def execute_steps(self, code):
+        """Произвольный VKScript, например цикл по курсору next_from"""
+        metrics.incr('api.calls', method='execute')
+        return (yield from self.request_steps('execute', {'code': code}))
+
+    def batch_steps(self, calls, raise_errors=True):
+        """
+        calls — список пар (method, params). Возвращает результаты в том же порядке.
+        При raise_errors=False упавшие вызовы возвращаются объектами ApiError.
+        """
+        results = []
+        for i in range(0, len(calls), EXECUTE_MAX_CALLS):
+            chunk = calls[i:i + EXECUTE_MAX_CALLS]
+            if len(chunk) == 1:
+                method, params = chunk[0]
+                metrics.incr('api.calls', method=method)
+                try:
+                    results.append((yield from self.request_steps(method, params)))
+                except ApiError as e:
+                    if raise_errors:
+                        raise
+                    results.append(e)
+                continue
+            results.extend((yield from self._execute_steps(chunk, raise_errors)))
+        return results
+
+    def _execute_steps(self, calls, raise_errors):
+        for method, _ in calls:
+            metrics.incr('api.calls', method=method)
+        results = yield from self._execute_once_steps(calls)
+
+        # Вызовы внутри execute падают по отдельности (execute_errors) — повторяем
+        # только их, а не всю пачку
+        for attempt in range(API_RETRIES):
+            retry = [i for i, result in enumerate(results)
+                     if isinstance(result, ApiError) and result.code in RETRYABLE_API_ERRORS]
+            if not retry:
+                break
+            logger.warning(f"VK API: повтор {len(retry)} вызовов из execute")
+            metrics.incr('api.retries', len(retry), method='execute')
+            yield STEP_SLEEP, backoff_delay(attempt)
+            for i, result in zip(retry, (yield from self._execute_once_steps([calls[i] for i in retry]))):
+                results[i] = result
+
+        for result in results:
+            if isinstance(result, ApiError):
+                metrics.incr('api.errors', method=result.method, code=result.code)
+                if raise_errors:
+                    raise result
+        return results
+
+    def _execute_once_steps(self, calls):
+        raw = yield from self.request_steps('execute', {'code': execute_code(calls)}, raw=True)
+        return execute_results(calls, raw)
+
+    def request_steps(self, method, params, raw=False):
+        values = {k: v for k, v in params.items() if v is not None}
+        values.setdefault('v', self.api_version)
+        values['access_token'] = self.token
+
+        for attempt in range(API_RETRIES + 1):
+            waited = 0.0
+            delay = self.limiter.reserve()
+            while delay:
+                yield STEP_SLEEP, delay
+                waited += delay
+                delay = self.limiter.reserve()
+            if waited:
+                metrics.incr('api.rate_limit_wait_seconds', waited)
+            metrics.incr('api.requests', method=method)
+            try:
+                data = yield STEP_POST, method, values
+            except self.transient_errors as e:
+                if attempt == API_RETRIES:
+                    raise
+                delay = retry_delay(e, attempt)
+                logger.warning(f"VK API: {method} не ответил ({e!r}), повтор через {delay:.1f} с")
+                metrics.incr('api.retries', method=method, code='http')
+                yield STEP_SLEEP, delay
+                continue
+
+            error = data.get('error')
+            if not error:
+                return data if raw else data['response']
+
+            code = error.get('error_code')
+            if code in RETRYABLE_API_ERRORS and attempt < API_RETRIES:
+                metrics.incr('api.retries', method=method, code=code)
+                if code == TOO_MANY_REQUESTS:
+                    # Темп задаёт bucket: забираем токены, следующий запрос подождёт
+                    logger.warning(f"VK API: слишком много запросов ({method}), повтор")
+                    self.limiter.penalize()
+                else:
+                    delay = backoff_delay(attempt, base=1.0)
+                    logger.warning(f"VK API: ошибка {code} ({method}), повтор через {delay:.1f} с")
+                    yield STEP_SLEEP, delay
+                continue
+
+            metrics.incr('api.errors', method=method, code=code)
+            raise ApiError(None, method, values, data, error)
+
+
+class VkRequestScheduler(VkRequestPolicy):
+    """
+    Все обращения к VK API идут через этот класс: одиночные вызовы через call(),
+    пачки — через batch(), который упаковывает до 25 вызовов в один execute.
+    Шаги политики (VkRequestPolicy) выполняются на requests в текущем потоке.
+    """
+
+    def __init__(self, token, rps=USER_TOKEN_RPS, api_url=API_URL, api_version=API_VERSION):
+        super().__init__(token, rps=rps, api_url=api_url, api_version=api_version)
+        self.http = requests.Session()
+
+    def call(self, method, **params):
+        return self.run(self.call_steps(method, params))
+
+    def execute(self, code):
+        return self.run(self.execute_steps(code))
+
+    def batch(self, calls, raise_errors=True):
+        return self.run(self.batch_steps(calls, raise_errors))
+
+    def run(self, steps):
+        """Выполняет шаги и возвращает их результат"""
+        reply = error = None
+        while True:
+            try:
+                step = advance(steps, reply, error)
+            except StopIteration as stop:
+                return stop.value
+            reply, error = self._perform(step)
+
+    def iterate(self, steps):
+        """Выполняет шаги, найденные аттачи (STEP_ITEM) отдаёт по одному"""
+        reply = error = None
+        while True:
+            try:
+                step = advance(steps, reply, error)
+            except StopIteration:
+                return
+            if step[0] == STEP_ITEM:
+                reply = error = None
+                yield step[1]
+            else:
+                reply, error = self._perform(step)
+
+    def _perform(self, step):
+        """(ответ, ошибка) шага — ошибка уходит обратно в генератор"""
+        try:
+            if step[0] == STEP_SLEEP:
+                time.sleep(step[1])
+                return None, None
+            return self._post(step[1], step[2]), None
+        except Exception as e:
+            return None, e
+
+    def _post(self, method, values):
+        with metrics.timer('api.latency', method=method):
+            response = self.http.post(self.api_url + method, data=values, timeout=30)
+            check_response(response)
+            return response.json()
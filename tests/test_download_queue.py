@@ -0,0 +1,100 @@
+from scripts.download_queue import COST_UNIT, PHOTO_LANE, VIDEO_LANE, DownloadQueue
+
+
+def photo(name):
+    return {'id': name, 'type': 'photo'}
+
+
+def video(name):
+    return {'id': name, 'type': 'video'}
+
+
+def pop_all(queue):
+    tasks = []
+    while True:
+        task = queue.pop()
+        if task is None:
+            return tasks
+        tasks.append(task['id'])
+
+
+def test_small_photos_overtake_large_ones():
+    queue = DownloadQueue(video_slots=1)
+    queue.push(photo('large'), cost=10 * COST_UNIT[PHOTO_LANE])
+    queue.push(photo('small'), cost=0)
+    queue.push(photo('medium'), cost=2 * COST_UNIT[PHOTO_LANE])
+    assert pop_all(queue) == ['small', 'medium', 'large']
+
+
+def test_equal_virtual_time_keeps_arrival_order():
+    # 'b' пришёл на один шаг позже, но на шаг дешевле — время совпадает с 'a',
+    # и heapq не должен доходить до сравнения самих задач
+    queue = DownloadQueue(video_slots=1)
+    queue.push(photo('a'), peer_id=1, cost=COST_UNIT[PHOTO_LANE])
+    queue.push(photo('b'), peer_id=1, cost=0)
+    queue.push(photo('c'), peer_id=1, cost=0)
+    assert pop_all(queue) == ['a', 'b', 'c']
+    assert queue.drain() == []
+
+
+def test_drain_with_equal_keys():
+    queue = DownloadQueue(video_slots=1)
+    queue.push(photo('a'), peer_id=1, cost=COST_UNIT[PHOTO_LANE])
+    queue.push(photo('b'), peer_id=1, cost=0)
+    assert [task['id'] for task in queue.drain()] == ['a', 'b']
+    assert len(queue) == 0
+
+
+def test_video_lane_is_capped_while_photos_wait():
+    queue = DownloadQueue(video_slots=1)
+    queue.push(video('v1'), lane=VIDEO_LANE)
+    queue.push(video('v2'), lane=VIDEO_LANE)
+    queue.push(photo('p1'), cost=1000 * COST_UNIT[PHOTO_LANE])
+    queue.push(photo('p2'), cost=1000 * COST_UNIT[PHOTO_LANE])
+    assert queue.pop()['id'] == 'v1'
+    # Полоса видео занята — дальше только фото
+    assert queue.pop()['id'] == 'p1'
+    assert queue.pop()['id'] == 'p2'
+    queue.task_done(VIDEO_LANE)
+    assert queue.pop()['id'] == 'v2'
+
+
+def test_video_lane_opens_without_photos():
+    queue = DownloadQueue(video_slots=1)
+    queue.push(video('v1'), lane=VIDEO_LANE)
+    queue.push(video('v2'), lane=VIDEO_LANE)
+    assert queue.pop()['id'] == 'v1'
+    # Фото не ждут — держать загрузчики без дела незачем
+    assert queue.pop()['id'] == 'v2'
+    assert queue.stats()['videos_active'] == 2
+
+
+def test_video_lane_opens_after_close():
+    queue = DownloadQueue(video_slots=1)
+    queue.push(video('v1'), lane=VIDEO_LANE)
+    queue.push(video('v2'), lane=VIDEO_LANE)
+    queue.push(photo('p1'), cost=1000 * COST_UNIT[PHOTO_LANE])
+    assert queue.pop()['id'] == 'v1'
+    assert queue.pop()['id'] == 'p1'
+    queue.push(photo('p2'), cost=1000 * COST_UNIT[PHOTO_LANE])
+    queue.close()
+    assert pop_all(queue) == ['v2', 'p2']
+
+
+def test_set_priority_reorders_queued_tasks():
+    queue = DownloadQueue(video_slots=1)
+    queue.push(photo('a1'), peer_id=1)
+    queue.push(photo('b1'), peer_id=2)
+    queue.push(photo('a2'), peer_id=1)
+    queue.push(photo('b2'), peer_id=2)
+    queue.set_priority(2, 1)
+    assert queue.priority(2) == 1
+    assert pop_all(queue) == ['b1', 'b2', 'a1', 'a2']
+
+
+def test_set_priority_applies_to_later_pushes():
+    queue = DownloadQueue(video_slots=1)
+    queue.set_priority(2, 1)
+    queue.push(photo('a'), peer_id=1)
+    queue.push(photo('b'), peer_id=2, cost=100 * COST_UNIT[PHOTO_LANE])
+    assert pop_all(queue) == ['b', 'a']
@@ -0,0 +1,66 @@
+import pytest
+
+from scripts.manifest import SyncManifest
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    manifest = SyncManifest(str(tmp_path))
+    yield manifest
+    manifest.close()
+
+
+def item(item_id, **fields):
+    return dict({'id': item_id, 'type': 'photo', 'url': f'https://cdn.example/{item_id}.jpg',
+                 'date': 1700000000, 'message_id': 7}, **fields)
+
+
+def test_queue_round_trip_keeps_order(manifest):
+    manifest.save_queue(
+        [(1, item('b'), '/tmp/1/b.jpg'),
+         (2, item('v', type='video', video_key='1_2_abc'), '/tmp/2/v.mp4'),
+         (1, item('a'), '/tmp/1/a.jpg')],
+        {1: 100},
+    )
+    items, enumerated = manifest.take_queue([1, 2])
+    assert [(row['peer_id'], row['item_id'], row['path']) for row in items] == [
+        (1, 'b', '/tmp/1/b.jpg'), (2, 'v', '/tmp/2/v.mp4'), (1, 'a', '/tmp/1/a.jpg')
+    ]
+    assert items[1]['type'] == 'video'
+    assert items[1]['video_key'] == '1_2_abc'
+    assert items[0]['url'] == 'https://cdn.example/b.jpg'
+    assert items[0]['date'] == 1700000000
+    assert items[0]['message_id'] == 7
+    assert enumerated == {1: 100}
+
+
+def test_take_queue_removes_only_selected_dialogs(manifest):
+    manifest.save_queue([(1, item('a'), 'a.jpg'), (2, item('b'), 'b.jpg')], {1: 10, 2: 20})
+    items, enumerated = manifest.take_queue([2])
+    assert [row['item_id'] for row in items] == ['b']
+    assert enumerated == {2: 20}
+    assert manifest.take_queue([2]) == ([], {})
+    items, enumerated = manifest.take_queue([1])
+    assert [row['item_id'] for row in items] == ['a']
+    assert enumerated == {1: 10}
+
+
+def test_repeated_save_appends_after_previous(manifest):
+    manifest.save_queue([(1, item('a'), 'a.jpg')], {})
+    manifest.save_queue([(1, item('b'), 'b.jpg')], {1: 5})
+    items, enumerated = manifest.take_queue([1])
+    assert [row['item_id'] for row in items] == ['a', 'b']
+    assert enumerated == {1: 5}
+
+
+def test_queue_survives_reopen(tmp_path):
+    manifest = SyncManifest(str(tmp_path))
+    manifest.save_queue([(1, item('a'), 'a.jpg')], {1: 3})
+    manifest.close()
+    manifest = SyncManifest(str(tmp_path))
+    try:
+        items, enumerated = manifest.take_queue([1])
+    finally:
+        manifest.close()
+    assert [row['item_id'] for row in items] == ['a']
+    assert enumerated == {1: 3}
@@ -0,0 +1,23 @@
+from scripts.media_filter import MediaFilter
+
+
+def test_full_run_does_not_narrow_history():
+    assert not MediaFilter().narrows_history
+
+
+def test_size_choice_does_not_narrow_history():
+    # Предел размера выбирает меньшую копию, но ничего не отбрасывает
+    assert not MediaFilter(max_photo_size=1280, max_video_height=480).narrows_history
+
+
+def test_dropping_filters_narrow_history():
+    assert MediaFilter(types=('photo',)).narrows_history
+    assert MediaFilter(date_from=1700000000).narrows_history
+    assert MediaFilter(date_to=1700000000).narrows_history
+    assert MediaFilter(min_photo_size=200).narrows_history
+
+
+def test_min_photo_size_drops_small_photos():
+    media_filter = MediaFilter(min_photo_size=200)
+    assert media_filter.pick_photo_size([{'width': 100, 'height': 150}]) is None
+    assert media_filter.pick_photo_size([{'width': 100, 'height': 250}]) == {'width': 100, 'height': 250}
@@ -0,0 +1,51 @@
+from scripts.media_filter import MediaFilter
+from scripts.parse_vk_dialogs import AppSaver
+from scripts.vk_scheduler import VkRequestScheduler
+
+
+class FakeApi(VkRequestScheduler):
+    """Одна страница getHistoryAttachments, от новых сообщений к старым"""
+
+    def __init__(self, items):
+        super().__init__('test-parse', rps=1000)
+        self.items = items
+
+    def _post(self, method, values):
+        return {'response': {'items': self.items, 'next_from': None}}
+
+
+def photo_entry(photo_id, message_id, message_date=None, upload_date=None):
+    entry = {
+        'message_id': message_id,
+        'attachment': {'type': 'photo', 'photo': {
+            'id': photo_id, 'owner_id': 1, 'date': upload_date,
+            'sizes': [{'url': f'https://cdn.example/{photo_id}.jpg', 'width': 800, 'height': 600}],
+        }},
+    }
+    if message_date is not None:
+        entry['date'] = message_date
+    return entry
+
+
+def enumerate_ids(items, **filters):
+    saver = AppSaver('t', media_filter=MediaFilter(types=('photo',), **filters))
+    saver.api = FakeApi(items)
+    return [item['id'] for item in saver.iter_media(1, include_forwarded=False)]
+
+
+def test_attachment_date_prefers_message_date():
+    assert AppSaver.attachment_date(photo_entry(1, 10, message_date=500, upload_date=100)) == (500, True)
+    assert AppSaver.attachment_date(photo_entry(1, 10, upload_date=100)) == (100, False)
+
+
+def test_old_message_stops_pagination():
+    items = [photo_entry(1, 30, message_date=900), photo_entry(2, 20, message_date=100),
+             photo_entry(3, 10, message_date=900)]
+    assert enumerate_ids(items, date_from=500) == ['photo1_1']
+
+
+def test_old_upload_date_only_skips_the_attachment():
+    # Старое фото, переслано недавно: дата сообщения неизвестна, есть только дата загрузки
+    items = [photo_entry(1, 30, message_date=900), photo_entry(2, 20, upload_date=100),
+             photo_entry(3, 10, message_date=800)]
+    assert enumerate_ids(items, date_from=500) == ['photo1_1', 'photo1_3']
@@ -0,0 +1,180 @@
+import pytest
+
+from scripts import retry
+from scripts.retry import CircuitBreaker
+
+
+def make_clock(monkeypatch, start=1000.0):
+    clock = [start]
+    monkeypatch.setattr(retry.time, 'monotonic', lambda: clock[0])
+    return clock
+
+
+def test_breaker_opens_after_threshold(monkeypatch):
+    make_clock(monkeypatch)
+    breaker = CircuitBreaker(threshold=3, reset_timeout=10)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert not breaker.is_open
+    breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+
+
+def test_success_resets_failure_count(monkeypatch):
+    make_clock(monkeypatch)
+    breaker = CircuitBreaker(threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert not breaker.is_open
+
+
+def test_half_open_allows_single_probe(monkeypatch):
+    clock = make_clock(monkeypatch)
+    breaker = CircuitBreaker(threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    assert not breaker.allow()
+    clock[0] += 10
+    assert breaker.allow()
+    # Пока проба не завершилась, остальные запросы к хосту ждут
+    assert not breaker.allow()
+
+
+def test_probe_success_closes(monkeypatch):
+    clock = make_clock(monkeypatch)
+    breaker = CircuitBreaker(threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    clock[0] += 10
+    assert breaker.allow()
+    breaker.record_success()
+    assert not breaker.is_open
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_probe_failure_reopens(monkeypatch):
+    clock = make_clock(monkeypatch)
+    breaker = CircuitBreaker(threshold=5, reset_timeout=10)
+    for _ in range(5):
+        breaker.record_failure()
+    clock[0] += 10
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+    clock[0] += 10
+    assert breaker.allow()
+
+
+def test_probe_release_lets_next_attempt_probe(monkeypatch):
+    clock = make_clock(monkeypatch)
+    breaker = CircuitBreaker(threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    clock[0] += 10
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.is_open
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_get_breaker_is_per_host():
+    retry.reset_breakers()
+    assert retry.get_breaker('a.example') is retry.get_breaker('a.example')
+    assert retry.get_breaker('a.example') is not retry.get_breaker('b.example')
+    retry.reset_breakers()
+
+
+class Transient(IOError):
+    pass
+
+
+class NotFound(IOError):
+    pass
+
+
+def run_download(policy, outcomes, wait=lambda pause: None):
+    """Прогон по сценарию outcomes: True/False — результат попытки, класс — исключение"""
+    delays = []
+    for attempt in policy:
+        for pause in attempt.breaker_pauses():
+            wait(pause)
+        with attempt:
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, type):
+                raise outcome('boom')
+            if outcome:
+                attempt.succeeded()
+            return outcome, delays
+        delays.append(attempt.delay)
+
+
+def make_policy(monkeypatch, retries=2):
+    retry.reset_breakers()
+    monkeypatch.setattr(retry, 'retry_delay', lambda error, attempt: attempt + 1.0)
+    return retry.DownloadRetry('https://cdn.example/a.jpg', retries, (Transient,), NotFound)
+
+
+def test_download_retry_retries_transient_errors(monkeypatch):
+    policy = make_policy(monkeypatch)
+    assert run_download(policy, [Transient, Transient, True]) == (True, [1.0, 2.0])
+    assert not policy.breaker.is_open
+
+
+def test_download_retry_raises_after_last_attempt(monkeypatch):
+    policy = make_policy(monkeypatch, retries=1)
+    with pytest.raises(Transient):
+        run_download(policy, [Transient, Transient])
+
+
+def test_download_retry_http_error_is_not_retried(monkeypatch):
+    policy = make_policy(monkeypatch)
+    with pytest.raises(NotFound):
+        run_download(policy, [NotFound, True])
+
+
+def test_download_retry_waits_for_half_open(monkeypatch):
+    clock = make_clock(monkeypatch)
+    policy = make_policy(monkeypatch)
+    for _ in range(retry.BREAKER_FAILURE_THRESHOLD):
+        policy.breaker.record_failure()
+    clock[0] += 10
+
+    pauses = []
+
+    def wait(pause):
+        pauses.append(pause)
+        clock[0] += pause
+
+    assert run_download(policy, [True], wait) == (True, [])
+    assert pauses == [retry.BREAKER_RESET_TIMEOUT - 10]
+    assert not policy.breaker.is_open
+
+
+def test_download_retry_gives_up_after_max_breaker_wait(monkeypatch):
+    make_clock(monkeypatch)
+    policy = make_policy(monkeypatch)
+    for _ in range(retry.BREAKER_FAILURE_THRESHOLD):
+        policy.breaker.record_failure()
+    # Часы стоят: breaker так и не переходит в half-open
+    with pytest.raises(IOError, match='circuit breaker'):
+        run_download(policy, [True])
+
+
+def test_download_retry_resolves_half_open_probe(monkeypatch):
+    clock = make_clock(monkeypatch)
+    policy = make_policy(monkeypatch)
+    breaker = policy.breaker
+    for _ in range(retry.BREAKER_FAILURE_THRESHOLD):
+        breaker.record_failure()
+    clock[0] += retry.BREAKER_RESET_TIMEOUT
+
+    # Отмена (False) о хосте ничего не говорит — проба снята, breaker открыт
+    assert run_download(policy, [False]) == (False, [])
+    assert breaker.is_open
+    # 404 — хост отвечает: breaker закрывается
+    with pytest.raises(NotFound):
+        run_download(policy, [NotFound])
+    assert not breaker.is_open
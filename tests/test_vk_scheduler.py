@@ -0,0 +1,65 @@
+import pytest
+from vk_api import ApiError
+
+from scripts import vk_scheduler
+from scripts.retry import RetryableHTTPError
+from scripts.vk_scheduler import STEP_POST, STEP_SLEEP, VkRequestPolicy, advance
+
+
+def run_steps(steps, replies):
+    """Прогон шагов политики: на запрос — очередной ответ или исключение из replies"""
+    trace = []
+    reply = error = None
+    while True:
+        try:
+            step = advance(steps, reply, error)
+        except StopIteration as stop:
+            return stop.value, trace
+        reply = error = None
+        trace.append(step[0])
+        if step[0] == STEP_POST:
+            outcome = replies.pop(0)
+            if isinstance(outcome, Exception):
+                error = outcome
+            else:
+                reply = outcome
+
+
+@pytest.fixture
+def policy(monkeypatch):
+    monkeypatch.setattr(vk_scheduler, 'backoff_delay', lambda attempt, base=0.5: 0.1)
+    monkeypatch.setattr(vk_scheduler, 'retry_delay', lambda error, attempt: 0.2)
+    policy = VkRequestPolicy('test-policy')
+    # Паузы token bucket здесь не интересны — только паузы повторов
+    monkeypatch.setattr(policy.limiter, 'reserve', lambda: 0)
+    return policy
+
+
+def api_error(code):
+    return {'error': {'error_code': code, 'error_msg': 'boom'}}
+
+
+def test_request_retries_server_error(policy):
+    result, trace = run_steps(policy.call_steps('users.get', {}), [api_error(10), {'response': [1]}])
+    assert result == [1]
+    assert trace == [STEP_POST, STEP_SLEEP, STEP_POST]
+
+
+def test_request_retries_transport_error(policy):
+    replies = [RetryableHTTPError(503, 'https://api.example'), {'response': 'ok'}]
+    result, trace = run_steps(policy.call_steps('users.get', {}), replies)
+    assert result == 'ok'
+    assert trace == [STEP_POST, STEP_SLEEP, STEP_POST]
+
+
+def test_request_raises_permanent_error(policy):
+    with pytest.raises(ApiError):
+        run_steps(policy.call_steps('users.get', {}), [api_error(15)])
+
+
+def test_batch_retries_only_failed_execute_calls(policy):
+    calls = [('users.get', {'user_ids': 1}), ('users.get', {'user_ids': 2})]
+    first = {'response': [[1], False], 'execute_errors': [{'error_code': 10, 'error_msg': 'boom'}]}
+    result, trace = run_steps(policy.batch_steps(calls), [first, {'response': [[2]]}])
+    assert result == [[1], [2]]
+    assert trace == [STEP_POST, STEP_SLEEP, STEP_POST]